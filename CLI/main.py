@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 import os
+import re
 import sys
 import pickle
 import json
-from datetime import datetime, timedelta
+import time
+import argparse
+import fnmatch
+import itertools
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps, lru_cache
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import getpass
+import sqlite3
+import multiprocessing
 
-# MySQL
-import mysql.connector
-from mysql.connector import Error
-
-# Google API libraries
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+# MySQL and the Google API libraries take a few hundred milliseconds to import, so
+# they're loaded on first use (see load_mysql and authenticate_gmail) and the menu
+# shows up right away.
+mysql = Error = None
 
 # ----------------- Global Configuration -----------------
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
@@ -21,9 +31,87 @@ OAUTH_CREDENTIALS_FILE = "credentials.json"  # Default value; can be changed int
 TOKEN_FILE = "token.pickle"
 RULES_FILE = "rules.json"  # File that stores your rules
 DB_CONFIG = {}  # Will be set during setup
+DB_BACKEND = "mysql"  # "mysql" (server) or "sqlite" (local file, no server needed)
+SQLITE_PATH = "emails.db"  # Database file used when DB_BACKEND is "sqlite"
+RULE_WORKERS = 1  # Processes used to check emails against the rules (--workers)
+PROFILE_MODE = "off"  # "off", "full" (cProfile) or "sample" (low-overhead stack sampling)
+PROFILE_DIR = "profiles"  # Where profiling reports are written
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples in "sample" mode
+PROFILE_TOP_ALLOCATIONS = 25  # Allocation sites listed per memory report ("full" mode)
+report_numbers = itertools.count(1)  # Keeps report names unique within a second
+PATTERN_CACHE_SIZE = 256  # Compiled "matches regex"/"matches glob" patterns kept
+PATTERN_MAX_LENGTH = 500  # Longer patterns are refused
+PATTERN_MAX_TEXT = 20000  # Characters of a value a regex looks at
+REPEAT = re.compile(r"[+*]|\{\d*,\d*\}")  # Quantifiers that can repeat something more than once
+
+# ----------------- Profiling Functions -----------------
+def sample_stacks(thread_id, counts, stop_event):
+    while not stop_event.wait(PROFILE_SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            counts[";".join(reversed(stack))] += 1
+
+@contextmanager
+def profile_phase(name):
+    if PROFILE_MODE not in ("full", "sample"):
+        yield
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(report_numbers)}"
+    base_path = os.path.join(PROFILE_DIR, f"{name}-{stamp}")
+    profiler = sampler = None
+    owns_tracemalloc = False
+    counts, stop_event = Counter(), threading.Event()
+    if PROFILE_MODE == "full":
+        # Sample mode skips tracemalloc; tracing every allocation isn't cheap.
+        owns_tracemalloc = not tracemalloc.is_tracing()
+        if owns_tracemalloc:
+            tracemalloc.start(10)
+        start_snapshot = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), counts, stop_event), daemon=True)
+        sampler.start()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(f"{base_path}.pstats")
+            stats = tracemalloc.take_snapshot().compare_to(start_snapshot, "lineno")
+            with open(f"{base_path}.alloc.txt", "w") as f:
+                f.write(f"Top {PROFILE_TOP_ALLOCATIONS} allocation sites for phase '{name}'\n\n")
+                for stat in stats[:PROFILE_TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+            if owns_tracemalloc:
+                tracemalloc.stop()
+        if sampler:
+            stop_event.set()
+            sampler.join()
+            with open(f"{base_path}.samples.txt", "w") as f:
+                for stack, count in counts.most_common():
+                    f.write(f"{stack} {count}\n")
+
+def profiled(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # ----------------- Gmail API Functions -----------------
 def authenticate_gmail():
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    from googleapiclient.discovery import build
     creds = None
     if os.path.exists(TOKEN_FILE):
         with open(TOKEN_FILE, "rb") as token:
@@ -67,19 +155,41 @@ def get_email(service, msg_id):
         "from": headers.get("from", ""),
         "to": headers.get("to", ""),
         "subject": headers.get("subject", ""),
-        "received_date": parse_date(headers.get("date", "")),
+        "received_date": received_date(message, headers),
         "message": message.get("snippet", "")
     }
     return email_data
 
+def received_date(message, headers):
+    # Gmail's internalDate (epoch ms) needs no parsing; the Date header is only parsed without it.
+    internal_date = message.get("internalDate")
+    if internal_date:
+        try:
+            return datetime.fromtimestamp(int(internal_date) / 1000, timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            pass
+    return parse_date(headers.get("date", ""))
+
 def parse_date(date_str):
     try:
         return datetime.strptime(date_str[:31], '%a, %d %b %Y %H:%M:%S %z')
+    except Exception:
+        pass
+    # Other forms (no weekday, "(UTC)" comments, zone names) go through the standard library.
+    try:
+        parsed = parsedate_to_datetime(date_str)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
     except Exception:
         return None
 
 # ----------------- MySQL Functions -----------------
+def load_mysql():
+    global mysql, Error
+    import mysql.connector
+    from mysql.connector import Error
+
 def create_database_if_not_exists(config):
+    load_mysql()
     try:
         connection = mysql.connector.connect(
             host=config["host"],
@@ -98,6 +208,7 @@ def create_database_if_not_exists(config):
             connection.close()
 
 def create_mysql_table():
+    load_mysql()
     try:
         connection = mysql.connector.connect(**DB_CONFIG)
         cursor = connection.cursor()
@@ -123,6 +234,7 @@ def create_mysql_table():
             connection.close()
 
 def insert_email_mysql(email_data):
+    load_mysql()
     try:
         connection = mysql.connector.connect(**DB_CONFIG)
         cursor = connection.cursor()
@@ -154,6 +266,7 @@ def insert_email_mysql(email_data):
             connection.close()
 
 def fetch_emails_mysql():
+    load_mysql()
     emails = []
     try:
         connection = mysql.connector.connect(**DB_CONFIG)
@@ -176,6 +289,93 @@ def fetch_emails_mysql():
             cursor.close()
             connection.close()
 
+# ----------------- SQLite Functions -----------------
+sqlite_connection = None
+sqlite_connection_path = None  # SQLITE_PATH the open connection was made for
+
+def get_sqlite_connection():
+    # One long-lived connection in WAL mode; "?" statements are reused from sqlite3's statement cache.
+    # It's reopened if SQLITE_PATH has changed since (e.g. the setup menu picked another file).
+    global sqlite_connection, sqlite_connection_path
+    if sqlite_connection is not None and sqlite_connection_path != SQLITE_PATH:
+        sqlite_connection.close()
+        sqlite_connection = None
+    if sqlite_connection is None:
+        sqlite_connection = sqlite3.connect(SQLITE_PATH, cached_statements=256)
+        sqlite_connection_path = SQLITE_PATH
+        sqlite_connection.execute("PRAGMA journal_mode=WAL")
+        sqlite_connection.execute("PRAGMA synchronous=NORMAL")
+    return sqlite_connection
+
+def create_sqlite_table():
+    try:
+        connection = get_sqlite_connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS emails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email_id TEXT UNIQUE,
+                from_address TEXT,
+                to_address TEXT,
+                subject TEXT,
+                received_date TEXT,
+                snippet TEXT
+            );
+        """)
+        connection.commit()
+        return f"SQLite table 'emails' is ready in {SQLITE_PATH}."
+    except sqlite3.Error as e:
+        return f"Error creating SQLite table: {e}"
+
+def insert_email_sqlite(email_data):
+    try:
+        connection = get_sqlite_connection()
+        with connection:
+            connection.execute("""
+                INSERT INTO emails (email_id, from_address, to_address, subject, received_date, snippet)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(email_id) DO UPDATE SET
+                    from_address = excluded.from_address,
+                    to_address = excluded.to_address,
+                    subject = excluded.subject,
+                    received_date = excluded.received_date,
+                    snippet = excluded.snippet;
+            """, (
+                email_data["email_id"],
+                email_data.get("from", ""),
+                email_data.get("to", ""),
+                email_data.get("subject", ""),
+                email_data["received_date"].isoformat() if email_data.get("received_date") else None,
+                email_data.get("message", "")
+            ))
+        return f"Stored email {email_data['email_id']}"
+    except sqlite3.Error as e:
+        return f"Error inserting email: {e}"
+
+def fetch_emails_sqlite():
+    try:
+        rows = get_sqlite_connection().execute(
+            "SELECT email_id, from_address, subject, received_date, snippet FROM emails;"
+        ).fetchall()
+        return [{
+            "email_id": row[0],
+            "from": row[1],
+            "subject": row[2],
+            "received_date": datetime.fromisoformat(row[3]) if row[3] else None,
+            "message": row[4]
+        } for row in rows]
+    except sqlite3.Error as e:
+        return f"Error fetching emails: {e}"
+
+# ----------------- Storage Selection -----------------
+def create_table():
+    return create_sqlite_table() if DB_BACKEND == "sqlite" else create_mysql_table()
+
+def insert_email(email_data):
+    return insert_email_sqlite(email_data) if DB_BACKEND == "sqlite" else insert_email_mysql(email_data)
+
+def fetch_emails():
+    return fetch_emails_sqlite() if DB_BACKEND == "sqlite" else fetch_emails_mysql()
+
 # ----------------- Rules Engine Functions -----------------
 def load_rules():
     if not os.path.exists(RULES_FILE):
@@ -189,6 +389,71 @@ def load_rules():
             print("Error decoding rules file. Please check its contents.")
             return None
 
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(predicate, pattern):
+    # Regexes match anywhere in the text, globs (*, ?, [abc]) the whole value; both ignore case.
+    if len(pattern) > PATTERN_MAX_LENGTH:
+        raise ValueError(f"Pattern is longer than {PATTERN_MAX_LENGTH} characters.")
+    if predicate == "matches glob":
+        return re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+    if repeats_risky_group(pattern):
+        raise ValueError(f"Pattern '{pattern}' repeats a group with a quantifier or | inside, "
+                         "which can take forever to match.")
+    try:
+        search = re.compile(pattern, re.IGNORECASE).search
+    except re.error as e:
+        raise ValueError(f"Invalid pattern '{pattern}': {e}")
+    return lambda text: search(text[:PATTERN_MAX_TEXT])
+
+def repeats_risky_group(pattern):
+    # A repeated group with a quantifier or | inside, e.g. (a+)+ or (a|aa)+; these can backtrack for ages.
+    risky_groups = []  # One flag per open group
+    closed_risky = False  # The last thing seen was a risky group closing
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        repeat = REPEAT.match(pattern, i)
+        if char == "\\":
+            i += 2
+            closed_risky = False
+            continue
+        if char == "[":
+            i += 2 if pattern.startswith("[^", i) else 1
+            i += pattern.startswith("]", i)
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            closed_risky = False
+        elif char == "(":
+            risky_groups.append(False)
+            closed_risky = False
+        elif char == ")":
+            closed_risky = risky_groups.pop() if risky_groups else False
+            if closed_risky and risky_groups:
+                risky_groups[-1] = True
+        elif repeat or char == "|":
+            if repeat and closed_risky:
+                return True
+            if risky_groups:
+                risky_groups[-1] = True
+            closed_risky = False
+            if repeat:
+                i = repeat.end()
+                continue
+        else:
+            closed_risky = False
+        i += 1
+    return False
+
+def check_patterns(ruleset):
+    for condition in ruleset.get("rules", []):
+        predicate = condition.get("predicate", "").lower()
+        if predicate in ("matches regex", "matches glob"):
+            try:
+                compile_pattern(predicate, str(condition.get("value", "")))
+            except ValueError as e:
+                return f"Error in {condition.get('field')} condition: {e}"
+    return None
+
 def match_condition(email_value, condition):
     predicate = condition["predicate"].lower()
     value = condition["value"]
@@ -214,6 +479,8 @@ def match_condition(email_value, condition):
             return email_value.lower() == value.lower()
         elif predicate == "does not equal":
             return email_value.lower() != value.lower()
+        elif predicate in ("matches regex", "matches glob"):
+            return compile_pattern(predicate, str(value))(email_value) is not None
     return False
 
 def evaluate_email(email, ruleset):
@@ -232,6 +499,20 @@ def evaluate_email(email, ruleset):
     policy = ruleset.get("match_policy", "All").lower()
     return all(results) if policy == "all" else any(results)
 
+def evaluate_chunk(task):
+    # Runs in a worker process: return the IDs of the emails in this chunk that match.
+    emails, ruleset = task
+    return [email["email_id"] for email in emails if evaluate_email(email, ruleset)]
+
+def find_matching_ids(emails, ruleset):
+    if RULE_WORKERS <= 1:
+        return [email["email_id"] for email in emails if evaluate_email(email, ruleset)]
+    # Several chunks per worker so one slow chunk doesn't leave the others idle.
+    size = max(1, -(-len(emails) // (RULE_WORKERS * 4)))
+    tasks = [(emails[i:i + size], ruleset) for i in range(0, len(emails), size)]
+    with multiprocessing.get_context("spawn").Pool(RULE_WORKERS) as pool:
+        return [email_id for chunk in pool.map(evaluate_chunk, tasks) for email_id in chunk]
+
 def process_actions(service, email_id, actions):
     output = []
     LABEL_MAPPING = {
@@ -270,22 +551,26 @@ def process_actions(service, email_id, actions):
             output.append(f"Error processing action '{action_type}' on email {email_id}: {e}")
     return "\n".join(output)
 
+@profiled("process_email_rules")
 def process_email_rules():
     ruleset = load_rules()
     if not ruleset:
         return "Missing or invalid rules.json file."
-    emails = fetch_emails_mysql()
+    pattern_error = check_patterns(ruleset)
+    if pattern_error:
+        return pattern_error
+    emails = fetch_emails()
     if not emails or not isinstance(emails, list):
         return "No emails to process."
     service = authenticate_gmail()
     output = []
-    for email in emails:
-        if evaluate_email(email, ruleset):
-            output.append(f"Email {email['email_id']} matches rules. Executing actions...")
-            actions_output = process_actions(service, email["email_id"], ruleset["actions"])
-            output.append(actions_output)
+    for email_id in find_matching_ids(emails, ruleset):
+        output.append(f"Email {email_id} matches rules. Executing actions...")
+        actions_output = process_actions(service, email_id, ruleset["actions"])
+        output.append(actions_output)
     return "\n".join(output)
 
+@profiled("fetch_and_store_emails")
 def fetch_and_store_emails(message_count="10"):
     service = authenticate_gmail()
     messages = list_emails(service, message_count)
@@ -295,7 +580,7 @@ def fetch_and_store_emails(message_count="10"):
     for msg in messages:
         try:
             email_data = get_email(service, msg["id"])
-            result = insert_email_mysql(email_data)
+            result = insert_email(email_data)
             output.append(result)
         except Exception as e:
             output.append(f"Error processing message {msg['id']}: {e}")
@@ -307,28 +592,37 @@ def interactive_loop():
     while True:
         print("\nSelect an option:")
         print("1. Setup configuration and database")
-        print("2. Fetch emails from Gmail and store them in MySQL")
+        print("2. Fetch emails from Gmail and store them in the database")
         print("3. Process stored emails using rules")
         print("4. Exit")
         choice = input("Enter choice (1-4): ").strip()
 
         if choice == "1":
             # Setup configuration
-            host = input("Enter MySQL host [default: localhost]: ").strip() or "localhost"
-            user = input("Enter MySQL username [default: root]: ").strip() or "root"
-            password = getpass.getpass("Enter MySQL password : ").strip()
-            database = input("Enter MySQL database name [default: gmailcrud]: ").strip() or "gmailcrud"
+            global DB_BACKEND, SQLITE_PATH, DB_CONFIG, OAUTH_CREDENTIALS_FILE
+            backend = input(f"Storage backend, mysql or sqlite [default: {DB_BACKEND}]: ").strip().lower() or DB_BACKEND
+            if backend not in ("mysql", "sqlite"):
+                print("Invalid storage backend. Please enter mysql or sqlite.")
+                continue
+            DB_BACKEND = backend
+            if DB_BACKEND == "sqlite":
+                SQLITE_PATH = input(f"Enter SQLite database file [default: {SQLITE_PATH}]: ").strip() or SQLITE_PATH
+            else:
+                host = input("Enter MySQL host [default: localhost]: ").strip() or "localhost"
+                user = input("Enter MySQL username [default: root]: ").strip() or "root"
+                password = getpass.getpass("Enter MySQL password : ").strip()
+                database = input("Enter MySQL database name [default: gmailcrud]: ").strip() or "gmailcrud"
+                DB_CONFIG = {
+                    "host": host,
+                    "user": user,
+                    "password": password,
+                    "database": database
+                }
             oauth_file = input("Enter path to OAuth credentials file [default: credentials.json]: ").strip() or "credentials.json"
-            global DB_CONFIG, OAUTH_CREDENTIALS_FILE
-            DB_CONFIG = {
-                "host": host,
-                "user": user,
-                "password": password,
-                "database": database
-            }
             OAUTH_CREDENTIALS_FILE = oauth_file
-            print(create_database_if_not_exists(DB_CONFIG))
-            print(create_mysql_table())
+            if DB_BACKEND == "mysql":
+                print(create_database_if_not_exists(DB_CONFIG))
+            print(create_table())
 
         elif choice == "2":
             # Fetch emails
@@ -356,6 +650,21 @@ def interactive_loop():
             print("Invalid choice. Please enter a number between 1 and 4.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gmail CLI Application (MySQL & Rules Engine)")
+    parser.add_argument("--profile", choices=["off", "full", "sample"], default=PROFILE_MODE,
+                        help="Profile fetch and rule runs (full = cProfile, sample = low overhead)")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="Directory for profiling reports")
+    parser.add_argument("--db", choices=["mysql", "sqlite"], default=DB_BACKEND,
+                        help="Storage backend: a MySQL server or a local SQLite file")
+    parser.add_argument("--sqlite-path", default=SQLITE_PATH, help="SQLite database file (with --db sqlite)")
+    parser.add_argument("--workers", type=int, default=RULE_WORKERS,
+                        help="Processes used to check emails against the rules (default 1)")
+    args = parser.parse_args()
+    RULE_WORKERS = max(1, args.workers)
+    DB_BACKEND = args.db
+    SQLITE_PATH = args.sqlite_path
+    PROFILE_MODE = args.profile
+    PROFILE_DIR = args.profile_dir
     try:
         interactive_loop()
     except KeyboardInterrupt:
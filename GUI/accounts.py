@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""
+accounts.py
+
+Which Gmail account we're working on. Stored emails, queued actions, saved
+rule state and OAuth tokens are all kept per account, so one app (and one
+database) can look after several mailboxes.
+
+The active account is config.ACCOUNT unless a thread picks another one with
+using_account(); that's how scheduler.py syncs several accounts at once.
+"""
+
+import os
+import re
+import threading
+from contextlib import contextmanager
+import config
+
+DEFAULT_ACCOUNT = "default"
+# Account keys end up in file names, so keep them to plain characters (emails are fine).
+ACCOUNT_PATTERN = re.compile(r"^[A-Za-z0-9@._+-]+$")
+_local = threading.local()
+
+def check_account(account):
+    """Return the account key if it's valid; raise ValueError otherwise."""
+    if not account or not ACCOUNT_PATTERN.match(account):
+        raise ValueError(f"Invalid account name '{account}'. Use letters, digits and @ . _ + - only.")
+    return account
+
+def current_account():
+    """The account this thread is working on."""
+    return getattr(_local, "account", None) or config.ACCOUNT
+
+@contextmanager
+def using_account(account):
+    """Work on another account for the rest of the with-block (in this thread only)."""
+    previous = getattr(_local, "account", None)
+    _local.account = check_account(account)
+    try:
+        yield account
+    finally:
+        _local.account = previous
+
+def token_path(account=None):
+    """
+    Where an account's OAuth token is saved.
+
+    The default account keeps using token.pickle, so existing installs don't have
+    to sign in again; other accounts get their own file in config.TOKEN_DIR.
+    """
+    account = check_account(account or current_account())
+    if account == DEFAULT_ACCOUNT:
+        return "token.pickle"
+    return os.path.join(config.TOKEN_DIR, f"{account}.pickle")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+body_store.py
+
+Full message bodies for "Message Body" rules. The Message field is only
+Gmail's ~200 character snippet; bodies are much bigger, so they're handled
+separately:
+- They're only downloaded (messages.get with format="full") the first time a
+  rule actually needs one, and only the text is kept.
+- They're stored compressed in their own email_bodies table, so the emails
+  table and every scan over it stay small. zstd is used if the optional
+  `zstandard` package is installed, otherwise zlib.
+- Recently used bodies stay in memory (an LRU cache of config.BODY_CACHE_SIZE).
+"""
+
+import re
+import html
+import zlib
+import base64
+import threading
+from collections import OrderedDict
+import config
+import storage
+from accounts import current_account
+
+try:
+    import zstandard
+except ImportError:  # Optional; zlib is always there
+    zstandard = None
+
+_cache = OrderedDict()  # (account, email_id) -> body text
+_cache_lock = threading.Lock()
+TAG_PATTERN = re.compile(r"<(script|style)\b.*?</\1>|<[^>]+>", re.IGNORECASE | re.DOTALL)
+
+def compress(text):
+    """Compress body text. Returns (codec, data)."""
+    raw = text.encode("utf-8")
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=3).compress(raw)
+    return "zlib", zlib.compress(raw, 6)
+
+def decompress(codec, data):
+    """Turn what compress() returned back into text."""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This body was stored with zstd; install the zstandard package to read it.")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = zlib.decompress(data)
+    return raw.decode("utf-8")
+
+def decode_part(part):
+    """Decode one MIME part's base64url body data to text."""
+    data = part.get("body", {}).get("data", "")
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8", errors="replace")
+
+def extract_text(payload):
+    """
+    Pull the readable text out of a Gmail message payload.
+
+    Plain-text parts are used when there are any; otherwise HTML parts with the
+    tags stripped. Attachments are skipped.
+    """
+    plain, rich = [], []
+    parts = [payload]
+    while parts:
+        part = parts.pop(0)
+        parts.extend(part.get("parts", []))
+        if part.get("filename"):
+            continue
+        mime_type = part.get("mimeType", "")
+        if mime_type == "text/plain":
+            plain.append(decode_part(part))
+        elif mime_type == "text/html":
+            rich.append(html.unescape(TAG_PATTERN.sub(" ", decode_part(part))))
+    text = "\n".join(plain or rich)
+    return text[:config.BODY_MAX_CHARS]
+
+def fetch_body(service, email_id):
+    """Download one message with format="full" and return its body text."""
+    message = service.users().messages().get(userId="me", id=email_id, format="full").execute()
+    return extract_text(message.get("payload", {}))
+
+def remember(key, text):
+    with _cache_lock:
+        _cache[key] = text
+        _cache.move_to_end(key)
+        while len(_cache) > config.BODY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def get_body(email_id, get_service):
+    """
+    Return the body text of a stored email, from the cheapest place that has it:
+    the in-memory cache, the email_bodies table, or (only then) Gmail.
+
+    Args:
+        email_id (str): Gmail message ID.
+        get_service (callable): Returns a Gmail service; only called if the body
+            has to be downloaded. Pass None to never download; then it returns
+            None for bodies that aren't stored yet.
+    """
+    key = (current_account(), email_id)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    stored = storage.load_body(email_id)
+    if stored is not None:
+        text = decompress(*stored)
+    elif get_service is None:
+        return None
+    else:
+        text = fetch_body(get_service(), email_id)
+        storage.save_body(email_id, *compress(text))
+    remember(key, text)
+    return text
+
+def clear_cache():
+    """Forget the in-memory bodies (the stored ones stay)."""
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+browser.py
+
+What's behind the Browse Emails window (see BrowseEmailsWindow in gui_components):
+a sliding window over the stored emails that only ever holds a few pages.
+
+- Pages come from storage.page_emails, newest first, with keyset pagination on
+  (received_ts, id): each page starts right after the last email of the one
+  before, so page 500 costs the same single indexed query as page 1.
+- Scrolling down loads the next (older) page; once more than
+  config.BROWSE_MAX_ROWS emails are held, the newest ones are dropped, and
+  scrolling back up loads them again. Memory stays the same however big the
+  table is.
+- Filters run in the database (the window's search becomes a LIKE on the
+  case-folded column, with % and _ taken literally), so only matching emails
+  are ever loaded.
+- Each loaded email is checked against the saved rules (rules.json), so you can
+  see what they would act on. Message Body conditions only use bodies that are
+  already stored; browsing never downloads anything from Gmail.
+"""
+
+import config
+import storage
+import body_store
+from accounts import current_account
+from normalize import casefold
+from rules_engine import load_rules, compile_ruleset, evaluate_email, NORMALIZED_FIELDS
+from patterns import check_patterns
+
+SEARCH_FIELDS = ["From", "To", "Subject", "Message"]
+
+def search_filters(field, text):
+    """Storage filters for the current account's emails, narrowed to `field` containing `text` (if any)."""
+    filters = [("account", "=", current_account())]
+    text = casefold(text.strip())
+    if text:
+        filters.append((NORMALIZED_FIELDS[field.lower()][1], "like", storage.like_pattern(text)))
+    return filters
+
+def load_ruleset():
+    """The saved rules compiled for checking, or None if there aren't any usable ones."""
+    ruleset = load_rules()
+    if not ruleset or check_patterns(ruleset):
+        return None
+    return compile_ruleset(ruleset)
+
+def stored_body(email):
+    return body_store.get_body(email["email_id"], None)
+
+def matches_rules(email, ruleset):
+    """Whether the saved rules match an email, or None if there are no rules."""
+    if ruleset is None:
+        return None
+    return evaluate_email(email, ruleset, load_body=stored_body)
+
+class EmailPager:
+    """
+    A window of at most `max_rows` stored emails, moved along a page at a time.
+
+    `rows` holds the loaded emails newest first. older() and newer() load the next
+    page in that direction and drop emails from the other end if the window gets
+    too big; they return (emails added, emails dropped) so a view can update in place.
+    """
+    def __init__(self, filters=None, page_size=None, max_rows=None):
+        self.filters = filters or []
+        self.page_size = page_size or config.BROWSE_PAGE_SIZE
+        self.max_rows = max(max_rows or config.BROWSE_MAX_ROWS, 2 * self.page_size)
+        self.rows = []
+        self.more_older = True  # There may be older emails past the last row
+        self.more_newer = False  # Newer emails were dropped from the top
+
+    def older(self):
+        if not self.more_older:
+            return [], []
+        after = storage.page_key(self.rows[-1]) if self.rows else None
+        page = storage.page_emails(self.filters, after=after, limit=self.page_size)
+        self.more_older = len(page) == self.page_size
+        self.rows.extend(page)
+        dropped = self.rows[:max(len(self.rows) - self.max_rows, 0)]
+        if dropped:
+            del self.rows[:len(dropped)]
+            self.more_newer = True
+        return page, dropped
+
+    def newer(self):
+        if not self.more_newer or not self.rows:
+            return [], []
+        page = storage.page_emails(self.filters, before=storage.page_key(self.rows[0]), limit=self.page_size)
+        self.more_newer = len(page) == self.page_size
+        self.rows[:0] = page
+        dropped = self.rows[self.max_rows:]
+        if dropped:
+            del self.rows[self.max_rows:]
+            self.more_older = True
+        return page, dropped
@@ -4,5 +4,51 @@
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']  # Permissions for Gmail API actions.
 DB_CONFIG = {}  # This will be filled in with database settings later by the GUI.
+DB_BACKEND = "mysql"  # Where emails are stored: "mysql" (server) or "sqlite" (local file, see storage.py).
+SQLITE_PATH = "emails.db"  # Database file used when DB_BACKEND is "sqlite".
+DB_BATCH_SIZE = 1000  # Rows read per query when streaming stored emails.
+BROWSE_PAGE_SIZE = 200  # Emails loaded per query in the Browse Emails window.
+BROWSE_MAX_ROWS = 1000  # Most emails the Browse Emails window holds at once; it drops the far end as you scroll.
+MESSAGE_CACHE_FILE = "message_cache.bin"  # On-disk cache of downloaded messages (None = off, see message_cache.py).
+MESSAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Size the message cache file is kept under.
+REFRESH_AFTER_DAYS = 30  # Stored emails older than this get fetched again (None = never refresh).
+RETENTION_DAYS = None  # Emails received longer ago than this leave the emails table (None = keep all, see retention.py).
+RETENTION_ARCHIVE = "table"  # Where they go: "table" (emails_archive) or "export" (gzip'd JSON lines in ARCHIVE_DIR).
+ARCHIVE_DIR = "archive"  # Folder for exported emails.
+HISTORY_STATE_FILE = "history_state.json"  # Last Gmail historyId checked for deleted emails, per account.
+HTTP_POOL_SIZE = 10  # Keep-alive connections to each Google host, shared by every thread (see gmail_api.PooledHttp).
+HTTP_CONNECT_TIMEOUT = 10  # Seconds to wait for a connection to Gmail.
+HTTP_READ_TIMEOUT = 60  # Seconds to wait for Gmail to answer a request.
+BATCH_MODIFY_SIZE = 1000  # Emails per messages.batchModify call (the Gmail API maximum).
+THREAD_MODE = False  # Fetch whole conversations with threads.get and run actions on them with threads.modify.
+THREAD_MATCH = "any"  # In thread mode, a thread matches if "any" of its stored emails do, or only if "all" do.
+LABEL_CACHE_TTL = 3600  # Seconds the Gmail label list is cached before it's loaded again.
+BODY_CACHE_SIZE = 500  # Message bodies kept in memory for "Message Body" rules (see body_store.py).
+BODY_MAX_CHARS = 100000  # Longest body text kept per email.
+PATTERN_CACHE_SIZE = 256  # Compiled "matches regex"/"matches glob" patterns kept (see patterns.py).
+PATTERN_MAX_LENGTH = 500  # Longer patterns are refused.
+PATTERN_MAX_TEXT = 20000  # Characters of a value a regex looks at.
+PATTERN_TIMEOUT = 0.05  # Seconds one match may take (only enforced if the regex package is installed).
+FULLTEXT_MIN_LENGTH = 3  # Shortest "contains" value looked up through the full-text index.
 OAUTH_CREDENTIALS_FILE = "credentials.json"  # Where our OAuth credentials are stored.
+ACCOUNT = "default"  # Gmail account key the app works on (see accounts.py).
+TOKEN_DIR = "tokens"  # Where OAuth tokens of accounts other than "default" are saved.
+SYNC_WORKERS = 2  # Accounts synced at the same time by scheduler.sync_accounts.
 RULES_FILE = "rules.json"  # File containing the rules for processing emails.
+RULES_STATE_FILE = "rules_state.json"  # Where each ruleset's last-run watermark is kept.
+INCREMENTAL_RULES = True  # Only re-check new or changed emails when the rules haven't changed.
+ACTION_QUEUE = False  # Queue matched actions in the pending_actions table so several workers can share them.
+ACTION_LEASE_SECONDS = 300  # How long a worker's claim on queued actions lasts before others may retry them.
+ACTION_MAX_ATTEMPTS = 5  # Queued actions that fail this many times are marked 'failed' and left alone.
+ACTION_DONE_KEEP_DAYS = 30  # Applied actions stay queued as 'done' this long, so later runs don't resend them.
+RULE_WORKERS = 1  # Worker processes used to check stored emails against the rules (1 = no extra processes).
+RULE_STATS_FILE = "rule_stats.json"  # Per-condition pass rates and timings, used to order conditions.
+RULE_STATS_SAMPLE = 10  # Check and time every condition on one email in this many (0 = don't collect stats).
+RULE_STATS_WINDOW = 100000  # Halve a condition's counts past this many checks, so stats follow the mailbox.
+
+# Profiling (see profiling.py). "off" disables it, "full" uses cProfile, "sample" is the low-overhead mode.
+PROFILE_MODE = "off"
+PROFILE_DIR = "profiles"  # Where .pstats files and allocation reports get written.
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples in "sample" mode.
+PROFILE_TRACEMALLOC_FRAMES = 10  # Stack depth tracemalloc records per allocation in "full" mode.
+PROFILE_TOP_ALLOCATIONS = 25  # Number of allocation sites listed in each memory report.
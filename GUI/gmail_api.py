@@ -1,11 +1,85 @@
 #!/usr/bin/env python3
 import os
+import re
+import time
 import pickle
-from datetime import datetime
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import config  # Import our project settings
+from accounts import current_account, token_path
+
+# The Google client libraries take a few hundred milliseconds to import, so they're
+# imported where they're used instead of here; the window can show up first.
+# warm_imports() loads them ahead of time in the background.
+
+def warm_imports():
+    """Import the Google client libraries now (e.g. in a background thread) so the first login is quick."""
+    import httplib2, requests.adapters, google_auth_oauthlib.flow, google.auth.transport.requests  # noqa: F401
+    import googleapiclient.discovery  # noqa: F401
+
+# Every Gmail call goes through one process-wide requests adapter: a pool of
+# keep-alive HTTPS connections, so TLS handshakes happen once per connection
+# instead of once per service or thread. See PooledHttp.
+_adapter = None
+_adapter_lock = threading.Lock()
+
+def pooled_adapter():
+    """The shared requests adapter (created on first use with config.HTTP_POOL_SIZE connections per host)."""
+    global _adapter
+    from requests.adapters import HTTPAdapter
+    with _adapter_lock:
+        if _adapter is None:
+            # pool_block makes extra threads wait for a free connection instead of opening throwaway ones.
+            _adapter = HTTPAdapter(pool_maxsize=config.HTTP_POOL_SIZE, pool_block=True)
+        return _adapter
+
+class PooledHttp:
+    """
+    Stands in for httplib2.Http under googleapiclient, sending requests through
+    an AuthorizedSession on the shared pooled adapter.
+
+    Unlike httplib2.Http it's safe to share between threads, so the fetch,
+    prefetch and action workers can all use the same service's connection pool.
+    Responses are gzip'd on the wire (googleapiclient asks for it and requests
+    decompresses them), and every request has the config.HTTP_CONNECT_TIMEOUT/
+    config.HTTP_READ_TIMEOUT timeouts.
+    """
+    def __init__(self, credentials):
+        import requests
+        from google.auth.transport.requests import AuthorizedSession, Request
+        self.credentials = credentials
+        token_session = requests.Session()
+        token_session.mount("https://", pooled_adapter())
+        self.auth_request = Request(token_session)
+        self.session = AuthorizedSession(credentials, auth_request=self.auth_request)
+        self.session.mount("https://", pooled_adapter())
+        self.refresh_lock = threading.Lock()
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        """Send one request; returns (httplib2.Response, content bytes) like httplib2.Http.request."""
+        import httplib2
+        # Refresh an expired token once, not once per thread that notices it.
+        if not self.credentials.valid:
+            with self.refresh_lock:
+                if not self.credentials.valid:
+                    self.credentials.refresh(self.auth_request)
+        response = self.session.request(
+            method, uri, data=body.encode("utf-8") if isinstance(body, str) else body, headers=headers,
+            timeout=(config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT), allow_redirects=redirections > 0
+        )
+        # The content is already decompressed, so its encoding and length headers no longer apply.
+        info = {key: value for key, value in response.headers.items()
+                if key.lower() not in ("content-encoding", "content-length")}
+        info["status"] = str(response.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = response.reason
+        resp.version = 11
+        return resp, response.content
+
+    def close(self):
+        """Nothing to close per service; the connections belong to the shared pool."""
 
 def authenticate_gmail():
     """
@@ -13,9 +87,16 @@ def authenticate_gmail():
     
     This function tries to load saved credentials from a file.
     If they don't exist or are expired, it refreshes or asks you to log in again.
+    Each account (see accounts.py) has its own saved token, so signing in to
+    one mailbox never touches another's.
     """
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    from googleapiclient.discovery import build
+
     creds = None
-    token_file = "token.pickle"
+    account = current_account()
+    token_file = token_path(account)
     
     # If we've got saved credentials, load them
     if os.path.exists(token_file):
@@ -34,50 +115,117 @@ def authenticate_gmail():
                 )
             # Kick off the login process
             flow = InstalledAppFlow.from_client_secrets_file(config.OAUTH_CREDENTIALS_FILE, config.SCOPES)
-            creds = flow.run_local_server(port=0)
+            # Suggest the right Google account on the sign-in page when the key is an address.
+            creds = flow.run_local_server(port=0, **({"login_hint": account} if "@" in account else {}))
         # Save these credentials for next time so you don't have to log in again
+        if os.path.dirname(token_file):
+            os.makedirs(os.path.dirname(token_file), mode=0o700, exist_ok=True)
         with open(token_file, "wb") as token:
             pickle.dump(creds, token)
     
     # Return our Gmail service object that lets us make API calls
-    return build("gmail", "v1", credentials=creds)
+    return build("gmail", "v1", http=PooledHttp(creds))
 
-def list_emails(service, message_count="50"):
+def iter_email_pages(service, message_count="50"):
     """
-    Fetch a bunch of emails from your Gmail.
-    
-    If you pass a number (as a string) like "50", it'll get that many emails.
-    Otherwise, it'll treat the input as a search query (e.g., "newer_than:7d").
+    Yield the IDs of matching emails one page (up to 100 messages) at a time.
+
+    Takes the same message_count as list_emails: a number like "50", or a search
+    query like "newer_than:7d". While the caller works on one page, the next page
+    is already being fetched in a background thread, so listing and downloading
+    overlap instead of running one after the other.
     """
-    messages = []
-    
     if message_count.isdigit():
-        desired_count = int(message_count)
+        remaining = int(message_count)
         query = ""
         # The API limits us to a max of 100 per request, so we use the smaller number
-        max_results = min(desired_count, 100)
+        max_results = min(remaining, 100)
+        if remaining == 0:
+            return
     else:
+        remaining = None  # No limit; keep going until Gmail runs out of pages
         query = message_count  # This could be something like "newer_than:7d"
         max_results = 100
 
-    response = service.users().messages().list(
-        userId="me", maxResults=max_results, q=query
-    ).execute()
-    messages.extend(response.get("messages", []))
-    
-    # Keep fetching more pages of results if available
-    while "nextPageToken" in response and (not message_count.isdigit() or len(messages) < desired_count):
-        page_token = response["nextPageToken"]
-        response = service.users().messages().list(
+    # The service's PooledHttp is thread-safe, so the prefetch thread can share it.
+    def fetch_page(page_token):
+        return service.users().messages().list(
             userId="me", maxResults=max_results, q=query, pageToken=page_token
         ).execute()
-        messages.extend(response.get("messages", []))
-    
-    # If we fetched too many, trim the list
-    if message_count.isdigit():
-        messages = messages[:desired_count]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_page, None)
+        while future is not None:
+            response = future.result()
+            messages = response.get("messages", [])
+            if remaining is not None:
+                messages = messages[:remaining]
+                remaining -= len(messages)
+            # Start on the next page before handing this one over.
+            next_token = response.get("nextPageToken")
+            if next_token and (remaining is None or remaining > 0):
+                future = executor.submit(fetch_page, next_token)
+            else:
+                future = None
+            if messages:
+                yield messages
+
+def list_emails(service, message_count="50"):
+    """
+    Fetch a bunch of emails from your Gmail.
     
-    return messages
+    If you pass a number (as a string) like "50", it'll get that many emails.
+    Otherwise, it'll treat the input as a search query (e.g., "newer_than:7d").
+    This collects every page from iter_email_pages; use that directly to start
+    working on the first page right away.
+    """
+    return [msg for page in iter_email_pages(service, message_count) for msg in page]
+
+# Per account: label name (and ID), case-folded -> label ID, from labels.list. See label_id().
+_label_caches = {}
+_label_lock = threading.Lock()
+
+def load_labels(service):
+    """Refresh the current account's label cache with one labels.list call."""
+    labels = service.users().labels().list(userId="me").execute().get("labels", [])
+    ids = {}
+    for label in labels:
+        ids[label["name"].casefold()] = label["id"]
+        ids[label["id"].casefold()] = label["id"]
+    _label_caches[current_account()] = {"ids": ids, "loaded_at": time.monotonic()}
+
+def label_id(service, name):
+    """
+    Look up the ID of a Gmail label by its name (or ID), e.g. "Receipts" -> "Label_123".
+
+    The mailbox's labels are loaded once with labels.list and kept for
+    config.LABEL_CACHE_TTL seconds, so lookups normally cost no API calls.
+    A label that doesn't exist yet is created with a single labels.create call.
+    """
+    key = name.strip().casefold()
+    with _label_lock:
+        cache = _label_caches.get(current_account())
+        if cache is None or time.monotonic() - cache["loaded_at"] > config.LABEL_CACHE_TTL:
+            load_labels(service)
+        ids = _label_caches[current_account()]["ids"]
+        if key in ids:
+            return ids[key]
+        try:
+            label = service.users().labels().create(userId="me", body={"name": name.strip()}).execute()
+        except Exception:
+            # Someone may have made it since we last looked (Gmail refuses duplicates).
+            load_labels(service)
+            ids = _label_caches[current_account()]["ids"]
+            if key in ids:
+                return ids[key]
+            raise
+        ids[key] = label["id"]
+        return label["id"]
+
+def clear_label_cache():
+    """Forget the cached labels of every account."""
+    with _label_lock:
+        _label_caches.clear()
 
 def get_email(service, msg_id):
     """
@@ -87,24 +235,120 @@ def get_email(service, msg_id):
     when it was received, and a little snippet of the email's content.
     """
     message = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
+    return message_to_email(message, msg_id)
+
+def get_thread(service, thread_id):
+    """
+    Grab every email in a conversation with a single threads.get call.
+
+    Returns a list of email dicts, like get_email's, oldest first.
+    """
+    thread = service.users().threads().get(
+        userId="me", id=thread_id, format="metadata", metadataHeaders=["From", "To", "Subject", "Date"]
+    ).execute()
+    return [message_to_email(message) for message in thread.get("messages", [])]
+
+def changed_messages(service, start_history_id):
+    """
+    IDs of the messages that were added, deleted or relabeled since a historyId,
+    from history.list.
+
+    Returns None if that can't be told, e.g. Gmail no longer has history that
+    far back (it keeps about a week).
+    """
+    changed = set()
+    page_token = None
+    try:
+        while True:
+            response = service.users().history().list(
+                userId="me", startHistoryId=start_history_id, pageToken=page_token
+            ).execute()
+            for record in response.get("history", []):
+                changed.update(item["id"] for item in record.get("messages", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return changed
+    except Exception:
+        return None
+
+def message_to_email(message, msg_id=None):
+    """Pull the fields we store out of a Gmail message resource."""
     headers = {h["name"].lower(): h["value"] for h in message.get("payload", {}).get("headers", [])}
     email_data = {
-        "email_id": msg_id,
+        "email_id": msg_id or message["id"],
         "from": headers.get("from", ""),
         "to": headers.get("to", ""),
         "subject": headers.get("subject", ""),
-        "received_date": parse_date(headers.get("date", "")),
-        "message": message.get("snippet", "")
+        "received_date": received_date(message, headers),
+        "message": message.get("snippet", ""),
+        "history_id": message.get("historyId"),
+        "thread_id": message.get("threadId")
     }
     return email_data
 
+def received_date(message, headers):
+    """
+    When an email was received, as a timezone-aware datetime (or None).
+
+    Gmail's internalDate (epoch milliseconds) is used when it's there, so there's
+    nothing to parse; otherwise we fall back to the Date header.
+    """
+    internal_date = message.get("internalDate")
+    if internal_date:
+        try:
+            return datetime.fromtimestamp(int(internal_date) / 1000, timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            pass
+    return parse_date(headers.get("date", ""))
+
+# Pieces of an RFC 2822 date like "Tue, 15 Nov 2022 12:45:26 +0000 (UTC)". The weekday,
+# seconds and zone are optional, and anything after the zone (like "(UTC)") is ignored.
+DATE_PATTERN = re.compile(
+    r"\s*(?:[A-Za-z]{3},?\s*)?(\d{1,2})\s+([A-Za-z]{3})[a-z]*\s+(\d{2,4})\s+"
+    r"(\d{1,2}):(\d{2})(?::(\d{2}))?\s*([+-]\d{4}|[A-Za-z]{1,5})?"
+)
+MONTHS = {name: number for number, name in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], 1)}
+# Zone names from RFC 2822 (unknown ones count as UTC, like "-0000").
+ZONE_NAMES = {"ut": 0, "utc": 0, "gmt": 0, "z": 0, "est": -500, "edt": -400, "cst": -600,
+              "cdt": -500, "mst": -700, "mdt": -600, "pst": -800, "pdt": -700}
+_timezones = {}
+
+def zone_for(offset):
+    """A cached timezone for an offset written as +HHMM (e.g. -0500 -> UTC-05:00)."""
+    tz = _timezones.get(offset)
+    if tz is None:
+        minutes = abs(offset) // 100 * 60 + abs(offset) % 100
+        tz = _timezones[offset] = timezone(timedelta(minutes=-minutes if offset < 0 else minutes))
+    return tz
+
 def parse_date(date_str):
     """
     Try to convert an email's date string into a datetime object.
-    
+
+    Handles the usual RFC 2822 forms, including a missing weekday, no seconds,
+    zone names like "GMT" and comments like "(UTC)" after the offset.
     If parsing fails for any reason, it just returns None.
     """
+    match = DATE_PATTERN.match(date_str or "")
+    if match:
+        day, month, year, hour, minute, second, zone = match.groups()
+        month = MONTHS.get(month.lower())
+        year = int(year)
+        if len(match.group(3)) == 2:
+            year += 2000 if year < 50 else 1900
+        if zone and zone[0] in "+-":
+            offset = int(zone)
+        else:
+            offset = ZONE_NAMES.get((zone or "utc").lower(), 0)
+        try:
+            return datetime(year, month, int(day), int(hour), int(minute), int(second or 0),
+                            tzinfo=zone_for(offset))
+        except (TypeError, ValueError):
+            pass
+    # Anything odder goes through the standard library's (slower) parser.
     try:
-        return datetime.strptime(date_str[:31], '%a, %d %b %Y %H:%M:%S %z')
-    except Exception:
+        parsed = parsedate_to_datetime(date_str)
+    except (TypeError, ValueError, IndexError):
         return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
@@ -5,8 +5,12 @@ import tkinter as tk
 from tkinter import messagebox, filedialog, scrolledtext, ttk
 import json
 import config  # Using our config settings for everything
-from mysql_db import create_database_if_not_exists, create_mysql_table
+import storage
+from accounts import check_account
 from rules_engine import process_email_rules, fetch_and_store_emails
+from remote_rules import apply_rules_remotely
+from patterns import check_patterns
+import browser
 
 # ----------------- Action Row for Rule Editor -----------------
 class ActionRow(tk.Frame):
@@ -53,7 +57,10 @@ class ActionRow(tk.Frame):
             destination = self.destination_var.get().strip()
             if not destination:
                 return None
-            action_dict["destination"] = destination.lower()
+            # Built-in folders are saved lowercase; custom labels keep their name as typed.
+            if destination.lower() in [name.lower() for name in self.MOVE_DESTINATIONS]:
+                destination = destination.lower()
+            action_dict["destination"] = destination
         return action_dict
 
 # ----------------- Updated Rule Editor Window -----------------
@@ -71,13 +78,15 @@ class RuleEditorWindow(tk.Toplevel):
     def create_widgets(self):
         instructions = (
             "Enter your rules here. Each rule has a Condition with these columns:\n"
-            "- Field: Pick from [From, To, Subject, Received Date/Time, Message]\n"
+            "- Field: Pick from [From, To, Subject, Received Date/Time, Message, Message Body]\n"
+            "  (Message is Gmail's short preview; Message Body downloads the full text when needed)\n"
             "- Predicate: For text use [contains, does not contain, equals, does not equal];\n"
             "  for 'Received Date/Time' use [less than, greater than]\n"
             "- Value: The text to look for, or a number for days/months (if needed)\n"
             "- Unit: Only for 'Received Date/Time' (default is 'days', or you can pick 'months')\n"
             "\nThen add one or more Actions. You can add or remove actions as you like.\n"
-            "For actions, choose the type. For 'Move Message', pick the destination folder."
+            "For actions, choose the type. For 'Move Message', pick the destination folder or type\n"
+            "the name of any Gmail label (it's created if it doesn't exist yet)."
         )
         tk.Label(self, text=instructions, justify="left").pack(padx=10, pady=5, anchor="w")
         
@@ -167,6 +176,10 @@ class RuleEditorWindow(tk.Toplevel):
             "rules": rules,
             "actions": actions
         }
+        pattern_error = check_patterns(ruleset)
+        if pattern_error:
+            messagebox.showerror("Error", pattern_error)
+            return
         with open(config.RULES_FILE, "w") as f:
             json.dump(ruleset, f, indent=4)
         messagebox.showinfo("Success", "Rules saved successfully.")
@@ -175,8 +188,8 @@ class RuleEditorWindow(tk.Toplevel):
 
 # ----------------- ConditionRow -----------------
 class ConditionRow(tk.Frame):
-    FIELDS = ["From", "To", "Subject", "Received Date/Time", "Message"]
-    PREDICATES_TEXT = ["contains", "does not contain", "equals", "does not equal"]
+    FIELDS = ["From", "To", "Subject", "Received Date/Time", "Message", "Message Body"]
+    PREDICATES_TEXT = ["contains", "does not contain", "equals", "does not equal", "matches regex", "matches glob"]
     PREDICATES_DATE = ["less than", "greater than"]
 
     def __init__(self, master):
@@ -233,6 +246,105 @@ class ConditionRow(tk.Frame):
             cond["unit"] = self.unit_var.get().strip() or "days"
         return cond
 
+# ----------------- Browse Emails Window -----------------
+class BrowseEmailsWindow(tk.Toplevel):
+    """A scrolling list of the stored emails, loaded a page at a time as you scroll (see browser.py)."""
+    COLUMNS = [("received", "Received", 140), ("from", "From", 200), ("subject", "Subject", 340),
+               ("rules", "Rules Match", 80)]
+
+    def __init__(self, master):
+        super().__init__(master)
+        self.title("Browse Emails")
+        self.geometry("850x500")
+        self.search_field = tk.StringVar(value="Subject")
+        self.search_text = tk.StringVar()
+        self.status = tk.StringVar()
+        self.pager = None
+        self.loading = None  # The pager a page is being loaded for, if any
+        self.ruleset = None
+        self.create_widgets()
+        self.search()
+
+    def create_widgets(self):
+        # Search bar: filters in the database, so only matching emails get loaded
+        search_frame = tk.Frame(self)
+        search_frame.pack(fill="x", padx=10, pady=5)
+        ttk.Combobox(search_frame, textvariable=self.search_field, values=browser.SEARCH_FIELDS, width=10)\
+            .grid(row=0, column=0, padx=2)
+        tk.Label(search_frame, text="contains").grid(row=0, column=1, padx=2)
+        search_entry = tk.Entry(search_frame, textvariable=self.search_text, width=30)
+        search_entry.grid(row=0, column=2, padx=2)
+        search_entry.bind("<Return>", lambda event: self.search())
+        tk.Button(search_frame, text="Search", command=self.search).grid(row=0, column=3, padx=2)
+        tk.Label(search_frame, textvariable=self.status).grid(row=0, column=4, padx=10, sticky="w")
+        
+        # The email list; the scrollbar also tells us when to load more
+        list_frame = tk.Frame(self)
+        list_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        self.tree = ttk.Treeview(list_frame, columns=[name for name, _, _ in self.COLUMNS], show="headings")
+        for name, heading, width in self.COLUMNS:
+            self.tree.heading(name, text=heading)
+            self.tree.column(name, width=width, stretch=name == "subject")
+        self.scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.on_scroll)
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+        tk.Button(self, text="Close", command=self.destroy).pack(pady=5)
+
+    def search(self):
+        """Start over with the current search (and the rules as they're saved now)."""
+        self.pager = browser.EmailPager(browser.search_filters(self.search_field.get(), self.search_text.get()))
+        self.ruleset = browser.load_ruleset()
+        self.tree.delete(*self.tree.get_children())
+        self.load("older")
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        # Load the next page once the view gets near either end of what's loaded.
+        if float(last) > 0.9 and self.pager.more_older:
+            self.load("older")
+        elif float(first) < 0.1 and self.pager.more_newer:
+            self.load("newer")
+
+    def load(self, direction):
+        """Load the next page ("older" or "newer") in the background."""
+        if self.loading is self.pager:
+            return
+        pager, ruleset = self.pager, self.ruleset
+        self.loading = pager
+        self.status.set("Loading...")
+        def task():
+            try:
+                added, dropped = getattr(pager, direction)()
+                matches = [browser.matches_rules(email, ruleset) for email in added]
+                error = None
+            except Exception as e:
+                added, dropped, matches, error = [], [], [], e
+            self.after(0, lambda: self.show_page(pager, direction, added, matches, dropped, error))
+        threading.Thread(target=task, daemon=True).start()
+
+    def show_page(self, pager, direction, added, matches, dropped, error):
+        if self.loading is pager:
+            self.loading = None
+        if pager is not self.pager:
+            return  # A new search started while this page was loading
+        if error is not None:
+            self.status.set(f"Error loading emails: {error}")
+            return
+        # Keep the email at the top of the view where it is while rows come and go.
+        anchor = self.tree.identify_row(1)
+        for email in dropped:
+            self.tree.delete(str(email["id"]))
+        for position, (email, matched) in enumerate(zip(added, matches)):
+            received = str(email.get("received_date") or "")[:16]
+            rules = "n/a" if matched is None else ("yes" if matched else "")
+            self.tree.insert("", position if direction == "newer" else "end", iid=str(email["id"]),
+                             values=(received, email.get("from", ""), email.get("subject", ""), rules))
+        if anchor and self.tree.exists(anchor):
+            self.tree.yview_moveto(self.tree.index(anchor) / max(len(pager.rows), 1))
+        more = " (scroll for more)" if pager.more_older else ""
+        self.status.set(f"{len(pager.rows)} emails loaded{more}.")
+
 # ----------------- Main Application -----------------
 class GmailCRUDApp(tk.Tk):
     def __init__(self):
@@ -249,6 +361,10 @@ class GmailCRUDApp(tk.Tk):
         self.message_number = tk.StringVar(value="10")
         self.timeframe_number = tk.StringVar(value="7")
         self.timeframe_unit = tk.StringVar(value="Days")
+        self.storage_backend = tk.StringVar(value="SQLite" if config.DB_BACKEND == "sqlite" else "MySQL")
+        self.sqlite_path = tk.StringVar(value=config.SQLITE_PATH)
+        self.account = tk.StringVar(value=config.ACCOUNT)
+        self.force_refresh = tk.BooleanVar(value=False)
         self.create_widgets()
 
     def create_widgets(self):
@@ -295,8 +411,18 @@ class GmailCRUDApp(tk.Tk):
             .grid(row=0, column=2, padx=5)
         self.timeframe_frame.grid_forget()  # Hide this by default
         
+        # Storage backend: a MySQL server or a local SQLite file
+        tk.Label(config_frame, text="Storage Backend:").grid(row=7, column=0, sticky="e")
+        ttk.Combobox(config_frame, textvariable=self.storage_backend, values=["MySQL", "SQLite"], width=22)\
+            .grid(row=7, column=1, padx=5, pady=2)
+        tk.Label(config_frame, text="SQLite File:").grid(row=8, column=0, sticky="e")
+        tk.Entry(config_frame, textvariable=self.sqlite_path, width=25).grid(row=8, column=1, padx=5, pady=2)
+        # Gmail account key: each account has its own sign-in and its own stored emails
+        tk.Label(config_frame, text="Gmail Account:").grid(row=9, column=0, sticky="e")
+        tk.Entry(config_frame, textvariable=self.account, width=25).grid(row=9, column=1, padx=5, pady=2)
+        
         tk.Button(config_frame, text="Save Configuration", command=self.update_config)\
-            .grid(row=7, column=0, columnspan=3, pady=5)
+            .grid(row=10, column=0, columnspan=3, pady=5)
 
     def build_ops_frame(self):
         ops_frame = tk.LabelFrame(self, text="Operations", padx=10, pady=10)
@@ -305,7 +431,13 @@ class GmailCRUDApp(tk.Tk):
         self.fetch_button.grid(row=0, column=0, padx=5, pady=5)
         self.apply_button = tk.Button(ops_frame, text="Apply Rules", command=self.open_rule_editor_threaded)
         self.apply_button.grid(row=0, column=1, padx=5, pady=5)
-        tk.Button(ops_frame, text="Exit", command=self.quit).grid(row=0, column=2, padx=5, pady=5)
+        self.remote_button = tk.Button(ops_frame, text="Apply Rules on Gmail", command=self.apply_remote_threaded)
+        self.remote_button.grid(row=0, column=2, padx=5, pady=5)
+        tk.Button(ops_frame, text="Browse Emails", command=self.open_browser).grid(row=0, column=3, padx=5, pady=5)
+        tk.Button(ops_frame, text="Exit", command=self.quit).grid(row=0, column=4, padx=5, pady=5)
+        # Re-download emails even if they're already stored
+        tk.Checkbutton(ops_frame, text="Force refresh", variable=self.force_refresh)\
+            .grid(row=1, column=0, padx=5, sticky="w")
 
     def build_output_area(self):
         self.output_text = scrolledtext.ScrolledText(self, height=30)
@@ -330,18 +462,31 @@ class GmailCRUDApp(tk.Tk):
 
     def update_config(self):
         import config  # Re-import config to update its variables
-        # Check that all the needed fields are filled in.
-        if not self.server.get() or not self.db_user.get() or not self.db_password.get() or not self.db_name.get():
-            messagebox.showerror("Error", "Please fill in Server, MySQL username, password, and database name.")
+        try:
+            config.ACCOUNT = check_account(self.account.get().strip())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
             return
-        # Update the global DB_CONFIG in our config module.
-        config.DB_CONFIG.clear()
-        config.DB_CONFIG.update({
-            "host": self.server.get().strip(),
-            "user": self.db_user.get(),
-            "password": self.db_password.get(),
-            "database": self.db_name.get()
-        })
+        use_sqlite = self.storage_backend.get() == "SQLite"
+        config.DB_BACKEND = "sqlite" if use_sqlite else "mysql"
+        if use_sqlite:
+            if not self.sqlite_path.get().strip():
+                messagebox.showerror("Error", "Please enter a SQLite database file.")
+                return
+            config.SQLITE_PATH = self.sqlite_path.get().strip()
+        else:
+            # Check that all the needed fields are filled in.
+            if not self.server.get() or not self.db_user.get() or not self.db_password.get() or not self.db_name.get():
+                messagebox.showerror("Error", "Please fill in Server, MySQL username, password, and database name.")
+                return
+            # Update the global DB_CONFIG in our config module.
+            config.DB_CONFIG.clear()
+            config.DB_CONFIG.update({
+                "host": self.server.get().strip(),
+                "user": self.db_user.get(),
+                "password": self.db_password.get(),
+                "database": self.db_name.get()
+            })
         # Make sure the OAuth file path is absolute.
         cred_path = self.oauth_file.get().strip()
         if not os.path.isabs(cred_path):
@@ -354,12 +499,14 @@ class GmailCRUDApp(tk.Tk):
         # Update the OAuth credentials file in our config.
         config.OAUTH_CREDENTIALS_FILE = cred_path
         self.append_output("Configuration updated.")
-        db_result = create_database_if_not_exists(config.DB_CONFIG)
-        if db_result.startswith("Error"):
-            messagebox.showerror("Connection Error", f"Please check your connection.\n{db_result}")
-            return
-        self.append_output(db_result)
-        table_result = create_mysql_table()
+        if not use_sqlite:
+            from mysql_db import create_database_if_not_exists  # Only MySQL setups need the client library
+            db_result = create_database_if_not_exists(config.DB_CONFIG)
+            if db_result.startswith("Error"):
+                messagebox.showerror("Connection Error", f"Please check your connection.\n{db_result}")
+                return
+            self.append_output(db_result)
+        table_result = storage.create_schema()
         if table_result.startswith("Error"):
             messagebox.showerror("Connection Error", f"Please check your connection.\n{table_result}")
             return
@@ -378,10 +525,12 @@ class GmailCRUDApp(tk.Tk):
     def disable_ops_buttons(self):
         self.fetch_button.config(state="disabled")
         self.apply_button.config(state="disabled")
+        self.remote_button.config(state="disabled")
 
     def enable_ops_buttons(self):
         self.fetch_button.config(state="normal")
         self.apply_button.config(state="normal")
+        self.remote_button.config(state="normal")
 
     def fetch_emails(self):
         self.update_config()
@@ -392,7 +541,7 @@ class GmailCRUDApp(tk.Tk):
             unit = self.timeframe_unit.get().strip().lower()
             unit_letter = "d" if unit == "days" else "m"
             msg_param = f"newer_than:{num}{unit_letter}"
-        result = fetch_and_store_emails(msg_param)
+        result = fetch_and_store_emails(msg_param, force_refresh=self.force_refresh.get())
         self.append_output(result)
 
     def fetch_emails_threaded(self):
@@ -408,11 +557,23 @@ class GmailCRUDApp(tk.Tk):
     def open_rule_editor_threaded(self):
         self.run_task(self.open_rule_editor)
 
+    def open_browser(self):
+        self.update_config()
+        BrowseEmailsWindow(self)
+
     def process_emails(self):
         self.update_config()
         result = process_email_rules()
         self.append_output(result)
 
+    def apply_remote(self):
+        # Runs the saved rules file against Gmail directly; no database needed.
+        result = apply_rules_remotely()
+        self.append_output(result)
+
+    def apply_remote_threaded(self):
+        self.run_task(self.apply_remote)
+
     def append_output(self, text):
         self.output_text.insert(tk.END, text + "\n")
         self.output_text.see(tk.END)
\ No newline at end of file
@@ -3,8 +3,72 @@
 # This is our main entry point for the Gmail CRUD app.
 # It imports the main GUI class from gui_components, creates the app,
 # and starts the Tkinter event loop so the window stays open.
+import argparse
+import threading
+import config
+from profiling import PROFILE_MODES
 from gui_components import GmailCRUDApp
 
 if __name__ == "__main__":
+    # Optional profiling of fetch/rule runs, e.g. `python main.py --profile sample`
+    parser = argparse.ArgumentParser(description="G-helper: Gmail rules GUI")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=config.PROFILE_MODE,
+                        help="Profile fetch and rule runs (full = cProfile, sample = low overhead)")
+    parser.add_argument("--profile-dir", default=config.PROFILE_DIR,
+                        help="Directory for .pstats files and allocation reports")
+    parser.add_argument("--workers", type=int, default=config.RULE_WORKERS,
+                        help="Processes used to check stored emails against the rules (default 1)")
+    parser.add_argument("--db", choices=["mysql", "sqlite"], default=config.DB_BACKEND,
+                        help="Storage backend (MySQL uses the settings in config.DB_CONFIG)")
+    parser.add_argument("--sqlite-path", default=config.SQLITE_PATH, help="SQLite database file (with --db sqlite)")
+    parser.add_argument("--account", default=config.ACCOUNT,
+                        help="Gmail account key to work on (each has its own token and stored emails)")
+    parser.add_argument("--sync-accounts", metavar="ACCOUNT[,ACCOUNT...]",
+                        help="Don't open the window; fetch and apply rules for these accounts and exit")
+    parser.add_argument("--sync-count", default="10",
+                        help="With --sync-accounts: how many emails (or a query like newer_than:7d) to fetch")
+    parser.add_argument("--action-worker", action="store_true",
+                        help="Don't open the window; just send queued rule actions to Gmail and exit")
+    parser.add_argument("--retention", action="store_true",
+                        help="Don't open the window; archive old emails and ones deleted in Gmail, then exit")
+    parser.add_argument("--export-snapshot", metavar="PATH",
+                        help="Don't open the window; write the account's stored emails to an Arrow snapshot and exit")
+    parser.add_argument("--simulate", metavar="PATH",
+                        help="Don't open the window; check rules.json against a snapshot offline and exit")
+    args = parser.parse_args()
+    config.PROFILE_MODE = args.profile
+    config.PROFILE_DIR = args.profile_dir
+    config.RULE_WORKERS = max(1, args.workers)
+    config.DB_BACKEND = args.db
+    config.SQLITE_PATH = args.sqlite_path
+    config.ACCOUNT = args.account
+
+    if args.sync_accounts:
+        from scheduler import sync_accounts
+        print(sync_accounts(args.sync_accounts.split(","), args.sync_count))
+        raise SystemExit
+
+    if args.action_worker:
+        # Extra workers can run alongside the GUI; each claims its own rows (see config.ACTION_QUEUE).
+        from rules_engine import process_action_queue
+        print(process_action_queue())
+        raise SystemExit
+
+    if args.retention:
+        from retention import run_retention
+        print(run_retention())
+        raise SystemExit
+
+    if args.export_snapshot or args.simulate:
+        import snapshot
+        if args.export_snapshot:
+            print(snapshot.export_snapshot(args.export_snapshot, [("account", "=", config.ACCOUNT)]))
+        if args.simulate:
+            print(snapshot.simulate(args.simulate))
+        raise SystemExit
+
     app = GmailCRUDApp()
+    # Load the Google libraries in the background while the window is idle, so the first login doesn't wait on them.
+    import gmail_api
+    threading.Thread(target=gmail_api.warm_imports, daemon=True).start()
     app.mainloop()
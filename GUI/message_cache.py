@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+message_cache.py
+
+A local on-disk cache of downloaded message metadata (what get_email returns),
+kept between Gmail and the database. If the database is down or a fetch gets
+cut off halfway, the next run reads the messages it already downloaded from
+disk instead of spending Gmail API quota on them again.
+
+How it's laid out:
+- One append-only file of records: a 4-byte length, then the message as JSON
+  (including Gmail's historyId and when we cached it).
+- An in-memory index of message key -> (offset, length), rebuilt by scanning
+  the file on open. A record that can't be read is skipped by its length; only
+  a half-written one at the very end is cut off. Reads go through a memory map
+  of the file.
+- Gmail messages can be deleted or change after they're cached, so the fetch
+  only uses a cached copy if Gmail's history shows nothing happened to that
+  message since the copy's historyId (see gmail_api.changed_messages).
+- The index is kept in least-recently-used order. When the file grows past
+  config.MESSAGE_CACHE_MAX_BYTES it's rewritten with just the most recently
+  used messages (down to about 3/4 of the limit), oldest first, so the order
+  survives a restart.
+
+It's meant for one process at a time; set config.MESSAGE_CACHE_FILE to None
+to turn it off.
+"""
+
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import config
+from accounts import current_account
+
+HEADER = struct.Struct("<I")  # Length of the JSON record that follows
+
+class MessageCache:
+    """Append-only, memory-mapped key-value file with an LRU index (see the module docstring)."""
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()  # key -> (offset, length), least recently used first
+        self.lock = threading.Lock()
+        self.file = open(path, "a+b")
+        self.map = None
+        self.load_index()
+
+    def load_index(self):
+        """
+        Scan the file and rebuild the index.
+
+        A record that isn't valid JSON is skipped (its length still says where
+        the next one starts); a half-written record at the end is cut off.
+        """
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        self.remap()
+        offset = 0
+        while offset + HEADER.size <= size:
+            (length,) = HEADER.unpack_from(self.map, offset)
+            start = offset + HEADER.size
+            if start + length > size:
+                break
+            offset = start + length
+            try:
+                key = json.loads(self.map[start:offset])["key"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            self.index.pop(key, None)
+            self.index[key] = (start, length)
+        if offset < size:
+            self.close_map()
+            self.file.truncate(offset)
+            self.remap()
+
+    def remap(self):
+        """Map the whole file into memory again (needed after it grows)."""
+        self.close_map()
+        self.file.flush()
+        if os.fstat(self.file.fileno()).st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def get(self, key):
+        """Return the cached record for a key (marking it recently used), or None."""
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return None
+            start, length = location
+            if self.map is None or start + length > len(self.map):
+                self.remap()
+            self.index.move_to_end(key)
+            return json.loads(self.map[start:start + length])
+
+    def put(self, key, record):
+        """Append a record for a key; the older copy (if any) is dropped at the next compaction."""
+        data = json.dumps({**record, "key": key}).encode("utf-8")
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(HEADER.pack(len(data)) + data)
+            self.index.pop(key, None)
+            self.index[key] = (offset + HEADER.size, len(data))
+            if offset + HEADER.size + len(data) > self.max_bytes:
+                self.compact()
+
+    def compact(self):
+        """Rewrite the file with the most recently used records that fit in 3/4 of max_bytes."""
+        self.file.flush()
+        self.remap()
+        keep = []
+        total = 0
+        for key, (start, length) in reversed(self.index.items()):
+            total += HEADER.size + length
+            if total > self.max_bytes * 3 // 4:
+                break
+            keep.append((key, start, length))
+        temp_path = f"{self.path}.tmp"
+        index = OrderedDict()
+        with open(temp_path, "wb") as temp:
+            for key, start, length in reversed(keep):
+                temp.write(HEADER.pack(length))
+                index[key] = (temp.tell(), length)
+                temp.write(self.map[start:start + length])
+        self.close_map()
+        self.file.close()
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, "a+b")
+        self.index = index
+        self.remap()
+
+    def close(self):
+        with self.lock:
+            self.close_map()
+            self.file.close()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """The cache for config.MESSAGE_CACHE_FILE (opened on first use), or None if it's turned off."""
+    global _cache
+    with _cache_lock:
+        if not config.MESSAGE_CACHE_FILE:
+            return None
+        if _cache is None or _cache.path != config.MESSAGE_CACHE_FILE:
+            if _cache is not None:
+                _cache.close()
+            _cache = MessageCache(config.MESSAGE_CACHE_FILE, config.MESSAGE_CACHE_MAX_BYTES)
+        return _cache
+
+def close_cache():
+    """Close the cache file (handy in tests and before deleting it)."""
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+
+def cache_key(email_id):
+    return f"{current_account()}/{email_id}"
+
+def load_email(email_id, max_age=None):
+    """
+    Return a cached email dict (as from gmail_api.get_email), or None on a miss.
+
+    Entries cached more than `max_age` seconds ago count as misses. The email's
+    "history_id" is what to check with gmail_api.changed_messages before using it.
+    """
+    try:
+        cache = get_cache()
+        record = cache.get(cache_key(email_id)) if cache else None
+    except (OSError, ValueError):
+        return None  # A broken cache just means downloading again
+    if record is None or (max_age is not None and time.time() - record["cached_at"] > max_age):
+        return None
+    email = record["email"]
+    if email.get("received_date"):
+        email["received_date"] = datetime.fromisoformat(email["received_date"])
+    return email
+
+def save_email(email):
+    """Cache an email dict right after it's downloaded."""
+    received_date = email.get("received_date")
+    try:
+        cache = get_cache()
+        if cache is not None:
+            cache.put(cache_key(email["email_id"]), {
+                "history_id": email.get("history_id"),
+                "cached_at": time.time(),
+                "email": {**email, "received_date": received_date.isoformat() if received_date else None}
+            })
+    except OSError:
+        pass  # Caching is only an optimization
@@ -1,7 +1,139 @@
 #!/usr/bin/env python3
+import time
 import mysql.connector
 from mysql.connector import Error
 import config  # Using our project settings for consistent config
+from normalize import NORMALIZED_COLUMNS, normalized_values
+from accounts import current_account
+
+# Columns and indexes added after the first release of the 'emails' table.
+# Each entry is (kind, name, statements, required). upgrade_mysql_schema() runs the
+# statements only when the column/index is missing, so existing databases catch up
+# the next time create_mysql_table() runs. Optional upgrades (required=False) may
+# fail on servers that lack the feature; the app then just works without them.
+SCHEMA_UPGRADES = [
+    # UTC epoch seconds of received_date, so date rules are integer range lookups.
+    ("column", "received_ts", [
+        "ALTER TABLE emails ADD COLUMN received_ts BIGINT, ADD INDEX idx_received_ts (received_ts)",
+        "UPDATE emails SET received_ts = UNIX_TIMESTAMP(received_date) WHERE received_date IS NOT NULL"
+    ], True),
+    # UTC epoch seconds of the last time the row was written from Gmail (for refreshing stale rows).
+    ("column", "fetched_at", "ALTER TABLE emails ADD COLUMN fetched_at BIGINT", True),
+    # Case-folded copies of the matched fields plus the bare sender address/domain (see normalize.py).
+    # Existing rows are filled in by backfill_normalized_columns().
+    ("column", "subject_norm", """
+        ALTER TABLE emails
+            ADD COLUMN subject_norm TEXT, ADD COLUMN snippet_norm TEXT,
+            ADD COLUMN from_norm TEXT, ADD COLUMN to_norm TEXT,
+            ADD COLUMN from_email VARCHAR(320), ADD COLUMN from_domain VARCHAR(255),
+            ADD INDEX idx_subject_norm (subject_norm(191)),
+            ADD INDEX idx_from_email (from_email), ADD INDEX idx_from_domain (from_domain)
+    """, True),
+    # ngram FULLTEXT indexes behave like substring search, so they can safely pre-filter
+    # "contains" rules before the exact check in Python (see rules_engine). They're over the
+    # case-folded columns, the same text rules are matched against; the second statement
+    # drops the index older versions built over the raw column (and fails harmlessly if
+    # there isn't one).
+    ("index", "ft_subject_norm", [
+        "ALTER TABLE emails ADD FULLTEXT INDEX ft_subject_norm (subject_norm) WITH PARSER ngram",
+        "ALTER TABLE emails DROP INDEX ft_subject"
+    ], False),
+    ("index", "ft_snippet_norm", [
+        "ALTER TABLE emails ADD FULLTEXT INDEX ft_snippet_norm (snippet_norm) WITH PARSER ngram",
+        "ALTER TABLE emails DROP INDEX ft_snippet"
+    ], False),
+    # Which Gmail account the email belongs to (see accounts.py); older rows belong to "default".
+    ("column", "account", "ALTER TABLE emails ADD COLUMN account VARCHAR(255) NOT NULL DEFAULT 'default', "
+                          "ADD INDEX idx_account (account, id)", True),
+    # Gmail conversation the email is part of (for config.THREAD_MODE).
+    ("column", "thread_id", "ALTER TABLE emails ADD COLUMN thread_id VARCHAR(255), "
+                            "ADD INDEX idx_thread_id (thread_id)", True),
+    # Lets the Browse Emails window page through one account's emails newest first (see page_emails).
+    ("index", "idx_account_received", "ALTER TABLE emails ADD INDEX idx_account_received (account, received_ts, id)",
+     True),
+]
+FULLTEXT_INDEXES = {"subject_norm": "ft_subject_norm", "snippet_norm": "ft_snippet_norm"}
+
+# Outbox of rule actions waiting to be sent to Gmail (see rules_engine.process_action_queue).
+# One row per email per ruleset, so the same actions are never queued twice.
+ACTION_QUEUE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pending_actions (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        email_id VARCHAR(255) NOT NULL,
+        rule_key VARCHAR(64) NOT NULL,
+        actions TEXT NOT NULL,
+        account VARCHAR(255) NOT NULL DEFAULT 'default',
+        status VARCHAR(16) NOT NULL DEFAULT 'pending',
+        attempts INT NOT NULL DEFAULT 0,
+        claimed_until BIGINT,
+        last_error TEXT,
+        finished_at BIGINT,
+        UNIQUE KEY uq_account_email_rule (account, email_id, rule_key),
+        INDEX idx_pending_status (status, id)
+    );
+"""
+# Compressed full message bodies, kept apart from 'emails' so scans over it stay small (see body_store.py).
+BODY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS email_bodies (
+        email_id VARCHAR(255) NOT NULL,
+        codec VARCHAR(16) NOT NULL,
+        body LONGBLOB NOT NULL,
+        stored_at BIGINT,
+        account VARCHAR(255) NOT NULL DEFAULT 'default',
+        PRIMARY KEY (account, email_id)
+    );
+"""
+# Bodies stored before they had an account belong to the account of their email.
+BODY_UPGRADE = [
+    "ALTER TABLE email_bodies ADD COLUMN account VARCHAR(255) NOT NULL DEFAULT 'default'",
+    "UPDATE email_bodies JOIN emails ON emails.email_id = email_bodies.email_id "
+    "SET email_bodies.account = emails.account"
+]
+# Emails moved out of 'emails' by retention.py: ones past the hot window (archived_at)
+# and ones deleted in Gmail (deleted_at, a tombstone). Same columns as INSERT_COLUMNS;
+# rows are rarely read, so they're stored compressed.
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS emails_archive (
+        email_id VARCHAR(255) NOT NULL,
+        from_address VARCHAR(255),
+        to_address VARCHAR(255),
+        subject VARCHAR(255),
+        received_date DATETIME,
+        snippet TEXT,
+        received_ts BIGINT,
+        fetched_at BIGINT,
+        account VARCHAR(255) NOT NULL DEFAULT 'default',
+        subject_norm TEXT,
+        snippet_norm TEXT,
+        from_norm TEXT,
+        to_norm TEXT,
+        from_email VARCHAR(320),
+        from_domain VARCHAR(255),
+        thread_id VARCHAR(255),
+        archived_at BIGINT,
+        deleted_at BIGINT,
+        PRIMARY KEY (account, email_id),
+        INDEX idx_archive_account (account, received_ts)
+    ) ROW_FORMAT=COMPRESSED;
+"""
+# Columns pending_actions got after it was first released -> how to add them.
+ACTION_QUEUE_UPGRADES = {
+    "account": "ALTER TABLE pending_actions ADD COLUMN account VARCHAR(255) NOT NULL DEFAULT 'default'",
+    "finished_at": "ALTER TABLE pending_actions ADD COLUMN finished_at BIGINT"
+}
+# Gmail message ids are only unique within an account, so rows are keyed by (account, email_id).
+# Tables made before that had keys on email_id alone; (table, new key, statement) swaps them over.
+ACCOUNT_KEY_UPGRADES = [
+    ("emails", "uq_account_email",
+     "ALTER TABLE emails DROP INDEX email_id, ADD UNIQUE KEY uq_account_email (account, email_id)"),
+    ("emails_archive", "PRIMARY",
+     "ALTER TABLE emails_archive DROP PRIMARY KEY, ADD PRIMARY KEY (account, email_id)"),
+    ("email_bodies", "PRIMARY",
+     "ALTER TABLE email_bodies DROP PRIMARY KEY, ADD PRIMARY KEY (account, email_id)"),
+    ("pending_actions", "uq_account_email_rule",
+     "ALTER TABLE pending_actions DROP INDEX uq_email_rule, "
+     "ADD UNIQUE KEY uq_account_email_rule (account, email_id, rule_key)"),
+]
 
 def create_database_if_not_exists(config_dict: dict) -> str:
     """
@@ -57,6 +189,26 @@ def create_mysql_table() -> str:
             );
         """
         cursor.execute(create_table_query)
+        upgrade_mysql_schema(cursor)
+        cursor.execute(ACTION_QUEUE_SCHEMA)
+        cursor.execute(BODY_SCHEMA)
+        cursor.execute(ARCHIVE_SCHEMA)
+        cursor.execute(
+            "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'pending_actions';"
+        )
+        queue_columns = {row[0] for row in cursor.fetchall()}
+        for column, statement in ACTION_QUEUE_UPGRADES.items():
+            if column not in queue_columns:
+                cursor.execute(statement)
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'email_bodies' AND COLUMN_NAME = 'account';"
+        )
+        if not cursor.fetchone()[0]:
+            for statement in BODY_UPGRADE:
+                cursor.execute(statement)
+        rekey_by_account(cursor)
         connection.commit()
         return "MySQL table 'emails' is ready."
     except Error as e:
@@ -66,6 +218,69 @@ def create_mysql_table() -> str:
             cursor.close()
             connection.close()
 
+def upgrade_mysql_schema(cursor):
+    """
+    Add any columns or indexes from SCHEMA_UPGRADES that the 'emails' table is missing.
+
+    Args:
+        cursor: An open cursor on the configured database.
+    """
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'emails';"
+    )
+    existing = {"column": {row[0] for row in cursor.fetchall()}}
+    cursor.execute(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'emails';"
+    )
+    existing["index"] = {row[0] for row in cursor.fetchall()}
+    # Index stopwords with the FULLTEXT indexes; otherwise ngrams containing them are dropped.
+    cursor.execute("SET SESSION innodb_ft_enable_stopword = OFF;")
+    for kind, name, statements, required in SCHEMA_UPGRADES:
+        if name in existing[kind]:
+            continue
+        try:
+            for statement in [statements] if isinstance(statements, str) else statements:
+                cursor.execute(statement)
+        except Error:
+            if required:
+                raise
+    backfill_normalized_columns(cursor)
+    _fulltext_cache.clear()
+
+def rekey_by_account(cursor):
+    """
+    Move keys made on email_id alone over to (account, email_id), see ACCOUNT_KEY_UPGRADES.
+
+    Args:
+        cursor: An open cursor on the configured database.
+    """
+    for table, key, statement in ACCOUNT_KEY_UPGRADES:
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s AND COLUMN_NAME = 'account';",
+            (table, key)
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(statement)
+
+def backfill_normalized_columns(cursor):
+    """
+    Fill in the normalized columns for rows stored before they existed.
+
+    Args:
+        cursor: An open cursor on the configured database.
+    """
+    cursor.execute("SELECT id, from_address, to_address, subject, snippet FROM emails WHERE subject_norm IS NULL;")
+    rows = cursor.fetchall()
+    if rows:
+        assignments = ", ".join(f"{column} = %s" for column in NORMALIZED_COLUMNS.values())
+        cursor.executemany(f"UPDATE emails SET {assignments} WHERE id = %s;", [
+            (*normalized_values({"from": row[1], "to": row[2], "subject": row[3], "message": row[4]}), row[0])
+            for row in rows
+        ])
+
 def insert_email_mysql(email_data: dict) -> str:
     """
     Insert a new email into MySQL (or update it if it's already there).
@@ -80,24 +295,7 @@ def insert_email_mysql(email_data: dict) -> str:
     try:
         connection = mysql.connector.connect(**config.DB_CONFIG)
         cursor = connection.cursor()
-        insert_query = """
-            INSERT INTO emails (email_id, from_address, to_address, subject, received_date, snippet)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                from_address = VALUES(from_address),
-                to_address = VALUES(to_address),
-                subject = VALUES(subject),
-                received_date = VALUES(received_date),
-                snippet = VALUES(snippet);
-        """
-        cursor.execute(insert_query, (
-            email_data["email_id"],
-            email_data.get("from", ""),
-            email_data.get("to", ""),
-            email_data.get("subject", ""),
-            email_data.get("received_date", None),
-            email_data.get("message", "")
-        ))
+        cursor.execute(UPSERT_QUERY, email_row(email_data, int(time.time())))
         connection.commit()
         return f"Stored email {email_data['email_id']}"
     except Error as e:
@@ -136,3 +334,469 @@ def fetch_emails_mysql():
         if connection and connection.is_connected():
             cursor.close()
             connection.close()
+
+# ----------------- Storage interface (see storage.py) -----------------
+PLACEHOLDER = "%s"
+LIKE_ESCAPE = "ESCAPE '\\\\'"  # Backslash escapes % and _ in LIKE patterns (MySQL strings escape it too)
+SELECT_COLUMNS = ("id, email_id, from_address, to_address, subject, received_date, snippet, received_ts, "
+                  + ", ".join(NORMALIZED_COLUMNS.values()) + ", account, thread_id")
+
+# Written columns, in the order email_row() returns them.
+INSERT_COLUMNS = ["email_id", "from_address", "to_address", "subject", "received_date", "snippet",
+                  "received_ts", "fetched_at", "account", *NORMALIZED_COLUMNS.values(), "thread_id"]
+UPSERT_QUERY = f"""
+    INSERT INTO emails ({', '.join(INSERT_COLUMNS)})
+    VALUES ({', '.join(['%s'] * len(INSERT_COLUMNS))})
+    ON DUPLICATE KEY UPDATE {', '.join(f'{column} = VALUES({column})' for column in INSERT_COLUMNS[1:])};
+"""
+
+def epoch_seconds(received_date):
+    """UTC epoch seconds for a datetime (naive ones are taken as local time), or None."""
+    return int(received_date.timestamp()) if received_date else None
+
+def email_row(email_data: dict, fetched_at: int) -> tuple:
+    """The values for UPSERT_QUERY from an email dict, including its normalized columns."""
+    return (
+        email_data["email_id"],
+        email_data.get("from", ""),
+        email_data.get("to", ""),
+        email_data.get("subject", ""),
+        email_data.get("received_date", None),
+        email_data.get("message", ""),
+        epoch_seconds(email_data.get("received_date")),
+        fetched_at,
+        email_data.get("account") or current_account(),
+        *normalized_values(email_data),
+        email_data.get("thread_id")
+    )
+
+def row_to_email(row) -> dict:
+    """Turn a row selected with SELECT_COLUMNS into the email dict the rules engine uses."""
+    return {
+        "id": row[0],
+        "email_id": row[1],
+        "from": row[2],
+        "to": row[3],
+        "subject": row[4],
+        "received_date": row[5],
+        "message": row[6],
+        "received_ts": row[7],
+        **dict(zip(NORMALIZED_COLUMNS, row[8:14])),
+        "account": row[14],
+        "thread_id": row[15]
+    }
+
+_fulltext_cache = {}
+
+def fulltext_columns() -> set:
+    """
+    Find which columns have a FULLTEXT index we can search (cached per database).
+
+    Returns:
+        set: Column names like {"subject", "snippet"}; empty if the server has none.
+    """
+    key = (config.DB_CONFIG.get("host"), config.DB_CONFIG.get("database"))
+    if key not in _fulltext_cache:
+        connection = None
+        try:
+            connection = mysql.connector.connect(**config.DB_CONFIG)
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'emails' AND INDEX_TYPE = 'FULLTEXT';"
+            )
+            indexes = {row[0] for row in cursor.fetchall()}
+            _fulltext_cache[key] = {column for column, index in FULLTEXT_INDEXES.items() if index in indexes}
+        except Error:
+            return set()
+        finally:
+            if connection and connection.is_connected():
+                cursor.close()
+                connection.close()
+    return _fulltext_cache[key]
+
+def fulltext_condition(column: str) -> str:
+    """SQL condition that looks up `column` through its FULLTEXT index."""
+    return f"MATCH({column}) AGAINST (%s IN BOOLEAN MODE)"
+
+def fulltext_query(text: str) -> str:
+    """Search string for fulltext_condition(): the text as one quoted phrase."""
+    return f'"{text}"'
+
+def create_schema() -> str:
+    """Create the tables this backend needs (same as create_mysql_table)."""
+    return create_mysql_table()
+
+def upsert_emails(emails: list) -> str:
+    """
+    Insert or update a batch of emails with a single executemany round trip.
+
+    Args:
+        emails (list): Email dicts as returned by gmail_api.get_email.
+
+    Returns:
+        str: How many emails were stored, or an error message.
+    """
+    if not emails:
+        return "Stored 0 emails."
+    connection = None
+    try:
+        connection = mysql.connector.connect(**config.DB_CONFIG)
+        cursor = connection.cursor()
+        fetched_at = int(time.time())
+        cursor.executemany(UPSERT_QUERY, [email_row(email_data, fetched_at) for email_data in emails])
+        connection.commit()
+        return f"Stored {len(emails)} emails."
+    except Error as e:
+        return f"Error inserting emails: {e}"
+    finally:
+        if connection and connection.is_connected():
+            cursor.close()
+            connection.close()
+
+def stream_emails(where: str = "", params: tuple = (), batch_size: int = 1000):
+    """
+    Yield stored emails one at a time, reading them in id order a batch at a time.
+
+    Each batch is its own small query (keyset pagination on id), so we never hold a
+    huge result set open while the caller is busy talking to Gmail.
+
+    Args:
+        where (str): Optional SQL condition (using %s placeholders) to filter rows.
+        params (tuple): Values for the placeholders in `where`.
+        batch_size (int): Rows fetched per query.
+
+    Raises:
+        mysql.connector.Error: If the database can't be read.
+    """
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        filter_sql = f" AND ({where})" if where else ""
+        last_id = 0
+        while True:
+            cursor.execute(
+                f"SELECT {SELECT_COLUMNS} FROM emails WHERE id > %s{filter_sql} ORDER BY id LIMIT %s;",
+                (last_id, *params, batch_size)
+            )
+            rows = cursor.fetchall()
+            for row in rows:
+                yield row_to_email(row)
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+    finally:
+        cursor.close()
+        connection.close()
+
+def page_emails(where: str = "", params: tuple = (), limit: int = 200, newest_first: bool = True) -> list:
+    """
+    Return up to `limit` stored emails matching a SQL condition, ordered by
+    (received_ts, id), newest first unless newest_first is False.
+
+    Raises:
+        mysql.connector.Error: If the database can't be read.
+    """
+    order = "DESC" if newest_first else "ASC"
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            f"SELECT {SELECT_COLUMNS} FROM emails{' WHERE ' + where if where else ''} "
+            f"ORDER BY received_ts {order}, id {order} LIMIT %s;", (*params, limit)
+        )
+        return [row_to_email(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        connection.close()
+
+def id_bounds(where: str = "", params: tuple = ()) -> tuple:
+    """
+    Return the smallest and largest id of the stored emails matching a SQL condition.
+
+    Returns:
+        tuple: (min_id, max_id), or (None, None) if nothing matches.
+
+    Raises:
+        mysql.connector.Error: If the database can't be read.
+    """
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"SELECT MIN(id), MAX(id) FROM emails{' WHERE ' + where if where else ''};", params)
+        return tuple(cursor.fetchone())
+    finally:
+        cursor.close()
+        connection.close()
+
+def select_email_ids(where: str = "", params: tuple = (), archived: bool = False) -> set:
+    """
+    Return just the email_id of every stored email matching an optional SQL condition.
+    With `archived`, look in emails_archive instead.
+
+    Raises:
+        mysql.connector.Error: If the database can't be read.
+    """
+    table = "emails_archive" if archived else "emails"
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"SELECT email_id FROM {table}{' WHERE ' + where if where else ''};", params)
+        return {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+        connection.close()
+
+def select_emails(where: str = "", params: tuple = ()):
+    """
+    Return every stored email matching an optional SQL condition.
+
+    Returns:
+        list: Email dicts, or a string error message if something goes wrong.
+    """
+    try:
+        return list(stream_emails(where, params))
+    except Error as e:
+        return f"Error fetching emails: {e}"
+
+def enqueue_actions(email_ids: list, rule_key: str, actions: str, account: str = "default",
+                    requeue: bool = False) -> int:
+    """
+    Queue a ruleset's actions for some emails, skipping emails already queued for it.
+
+    Args:
+        email_ids (list): Gmail message IDs that matched.
+        rule_key (str): Identifies the ruleset (see rules_engine.ruleset_hash).
+        actions (str): The ruleset's actions as JSON.
+        account (str): The Gmail account the emails belong to.
+        requeue (bool): Also put rows that are already 'done' or 'failed' back in the queue.
+
+    Returns:
+        int: How many rows were queued (new or put back).
+
+    Raises:
+        mysql.connector.Error: If the queue can't be written.
+    """
+    if not email_ids:
+        return 0
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        queued = 0
+        if requeue:
+            cursor.executemany(REQUEUE_QUERY, [(actions, account, email_id, rule_key) for email_id in email_ids])
+            queued = cursor.rowcount
+        cursor.executemany(
+            "INSERT IGNORE INTO pending_actions (email_id, rule_key, actions, account) VALUES (%s, %s, %s, %s);",
+            [(email_id, rule_key, actions, account) for email_id in email_ids]
+        )
+        queued += cursor.rowcount
+        connection.commit()
+        return queued
+    except Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+# Puts a finished row back in the queue as if it were new (for full runs).
+REQUEUE_QUERY = """
+    UPDATE pending_actions SET status = 'pending', attempts = 0, claimed_until = NULL, last_error = NULL,
+        finished_at = NULL, actions = %s
+    WHERE account = %s AND email_id = %s AND rule_key = %s AND status IN ('done', 'failed');
+"""
+
+# Claims that ran out on their last allowed attempt: the worker died, and there are no retries left.
+EXPIRE_CLAIMS_QUERY = """
+    UPDATE pending_actions SET status = 'failed', claimed_until = NULL,
+        last_error = COALESCE(last_error, 'The worker stopped before finishing (lease expired).')
+    WHERE status = 'claimed' AND claimed_until < %s AND attempts >= %s AND account = %s;
+"""
+
+def claim_actions(limit: int, lease_seconds: int, max_attempts: int, account: str = "default") -> list:
+    """
+    Claim up to `limit` of an account's queued actions for this worker.
+
+    Rows are pending ones, or claimed ones whose lease ran out (their worker died).
+    Rows whose lease ran out after their last allowed attempt are marked 'failed'.
+    FOR UPDATE SKIP LOCKED (MySQL 8.0+) makes concurrent workers take different
+    rows instead of waiting on each other or grabbing the same ones.
+
+    Returns:
+        list: (row id, email_id, rule_key, actions JSON) tuples.
+
+    Raises:
+        mysql.connector.Error: If the queue can't be read.
+    """
+    now = int(time.time())
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        connection.start_transaction()
+        cursor.execute(EXPIRE_CLAIMS_QUERY, (now, max_attempts, account))
+        cursor.execute("""
+            SELECT id, email_id, rule_key, actions FROM pending_actions
+            WHERE (status = 'pending' OR (status = 'claimed' AND claimed_until < %s)) AND attempts < %s
+                AND account = %s
+            ORDER BY id LIMIT %s
+            FOR UPDATE SKIP LOCKED;
+        """, (now, max_attempts, account, limit))
+        rows = cursor.fetchall()
+        if rows:
+            ids = [row[0] for row in rows]
+            cursor.execute(
+                f"UPDATE pending_actions SET status = 'claimed', claimed_until = %s, attempts = attempts + 1 "
+                f"WHERE id IN ({', '.join(['%s'] * len(ids))});",
+                (now + lease_seconds, *ids)
+            )
+        connection.commit()
+        return rows
+    except Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+def finish_actions(ids: list, error: str = None, max_attempts: int = 5, keep_done_seconds: int = 0):
+    """
+    Record how claimed actions went: done, or back in the queue with the error
+    (or 'failed' for good once they've used up max_attempts).
+
+    'done' rows are kept for `keep_done_seconds` (so later runs don't queue the
+    same actions again), then deleted.
+
+    Raises:
+        mysql.connector.Error: If the queue can't be written.
+    """
+    if not ids:
+        return
+    marks = ", ".join(["%s"] * len(ids))
+    now = int(time.time())
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        if error is None:
+            cursor.execute(
+                f"UPDATE pending_actions SET status = 'done', claimed_until = NULL, last_error = NULL, "
+                f"finished_at = %s WHERE id IN ({marks});", (now, *ids)
+            )
+            cursor.execute(PRUNE_DONE_QUERY, (now - keep_done_seconds,))
+        else:
+            cursor.execute(
+                f"UPDATE pending_actions SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END, "
+                f"claimed_until = NULL, last_error = %s WHERE id IN ({marks});",
+                (max_attempts, error, *ids)
+            )
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+# Done rows past their keep time (rows from before finished_at count as old).
+PRUNE_DONE_QUERY = "DELETE FROM pending_actions WHERE status = 'done' AND (finished_at IS NULL OR finished_at < %s);"
+
+def load_body(email_id: str, account: str):
+    """
+    Return the stored (codec, compressed body) of an account's email, or None if there isn't one.
+
+    Raises:
+        mysql.connector.Error: If the database can't be read.
+    """
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT codec, body FROM email_bodies WHERE account = %s AND email_id = %s;",
+                       (account, email_id))
+        row = cursor.fetchone()
+        return (row[0], bytes(row[1])) if row else None
+    finally:
+        cursor.close()
+        connection.close()
+
+def save_body(email_id: str, codec: str, body: bytes, account: str):
+    """
+    Store (or replace) the compressed body of an account's email.
+
+    Raises:
+        mysql.connector.Error: If the database can't be written.
+    """
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "REPLACE INTO email_bodies (email_id, codec, body, stored_at, account) VALUES (%s, %s, %s, %s, %s);",
+            (email_id, codec, body, int(time.time()), account)
+        )
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+def archive_emails(where: str, params: tuple = (), deleted_at: int = None) -> int:
+    """
+    Move the stored emails matching an SQL condition into emails_archive, in one transaction.
+
+    Their bodies are dropped too (they can be downloaded again). Pass `deleted_at`
+    to tombstone emails that were deleted in Gmail; matching emails that were
+    already archived get it too.
+
+    Returns:
+        int: How many emails were moved (plus, with `deleted_at`, archived ones tombstoned).
+
+    Raises:
+        mysql.connector.Error: If the database can't be written.
+    """
+    columns = ", ".join(INSERT_COLUMNS)
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        tombstoned = 0
+        if deleted_at is not None:
+            cursor.execute(f"UPDATE emails_archive SET deleted_at = %s WHERE deleted_at IS NULL AND ({where});",
+                           (deleted_at, *params))
+            tombstoned = cursor.rowcount
+        cursor.execute(
+            f"REPLACE INTO emails_archive ({columns}, archived_at, deleted_at) "
+            f"SELECT {columns}, %s, %s FROM emails WHERE {where};",
+            (int(time.time()), deleted_at, *params)
+        )
+        moved = delete_rows(cursor, where, params)
+        connection.commit()
+        return tombstoned + moved
+    except Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+def delete_emails(where: str, params: tuple = ()) -> int:
+    """
+    Delete the stored emails (and bodies) matching an SQL condition, e.g. after exporting them.
+
+    Returns:
+        int: How many emails were deleted.
+
+    Raises:
+        mysql.connector.Error: If the database can't be written.
+    """
+    connection = mysql.connector.connect(**config.DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        deleted = delete_rows(cursor, where, params)
+        connection.commit()
+        return deleted
+    except Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+def delete_rows(cursor, where, params):
+    cursor.execute(f"DELETE FROM email_bodies WHERE (account, email_id) IN "
+                   f"(SELECT account, email_id FROM emails WHERE {where});", params)
+    cursor.execute(f"DELETE FROM emails WHERE {where};", params)
+    return cursor.rowcount
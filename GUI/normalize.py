@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""
+normalize.py
+
+Case-folded copies of the fields rules match against, worked out once when an
+email is stored instead of on every rule check:
+- subject, snippet, from and to run through str.casefold().
+- The sender's bare address and domain, parsed out of headers like
+  '"Name" <a@b.com>', so "From equals a@b.com" works on display-name forms.
+
+Both storage backends keep these in their own columns (see NORMALIZED_COLUMNS),
+and rules_engine compares rule values against them directly.
+"""
+
+from email.utils import parseaddr
+
+# Email dict key -> column it's stored in.
+NORMALIZED_COLUMNS = {
+    "subject_norm": "subject_norm",
+    "message_norm": "snippet_norm",
+    "from_norm": "from_norm",
+    "to_norm": "to_norm",
+    "from_email": "from_email",
+    "from_domain": "from_domain"
+}
+
+def casefold(text):
+    """Case-folded text for matching (None becomes "")."""
+    return (text or "").casefold()
+
+def parse_sender(header):
+    """Return the (address, domain) of a From header, case-folded; "" for parts that are missing."""
+    address = parseaddr(header or "")[1].casefold()
+    return address, address.rpartition("@")[2] if "@" in address else ""
+
+def normalized_fields(email_data):
+    """The normalized values for an email dict (as returned by gmail_api.get_email)."""
+    from_email, from_domain = parse_sender(email_data.get("from"))
+    return {
+        "subject_norm": casefold(email_data.get("subject")),
+        "message_norm": casefold(email_data.get("message")),
+        "from_norm": casefold(email_data.get("from")),
+        "to_norm": casefold(email_data.get("to")),
+        "from_email": from_email,
+        "from_domain": from_domain
+    }
+
+def normalized_values(email_data):
+    """normalized_fields() as a tuple in NORMALIZED_COLUMNS order, ready for an INSERT."""
+    fields = normalized_fields(email_data)
+    return tuple(fields[key] for key in NORMALIZED_COLUMNS)
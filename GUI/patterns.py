@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+patterns.py
+
+"matches regex" and "matches glob" rule predicates, so one condition like
+`Subject matches regex (invoice|receipt) #\\d+` can stand in for a long "Any"
+list of near-duplicates.
+
+- Both ignore letter case. Regexes match anywhere in the text (like grep);
+  globs (*, ?, [abc]) have to match the whole value, e.g. "*@github.com".
+  For From, the bare sender address is tried too (see rules_engine.match_text),
+  so "*@github.com" matches "GitHub <noreply@github.com>".
+- Patterns are compiled once and kept in a bounded LRU cache of
+  config.PATTERN_CACHE_SIZE, so checking an email is just a lookup.
+- Runaway patterns are guarded against: anything over config.PATTERN_MAX_LENGTH
+  is refused, and so are repeated groups with a quantifier or an alternation
+  inside, like (a+)+ or (a|aa)+, that can backtrack for ages. Regexes only look
+  at the first config.PATTERN_MAX_TEXT characters of a value, which bounds what
+  is left (e.g. a*a*a*b). If the optional `regex` package is installed, every
+  match also gets a config.PATTERN_TIMEOUT time limit, and one that runs out
+  counts as no match.
+"""
+
+import re
+import fnmatch
+import threading
+from collections import OrderedDict
+import config
+
+try:
+    import regex
+except ImportError:  # Optional; adds match timeouts
+    regex = None
+
+PATTERN_PREDICATES = ["matches regex", "matches glob"]
+REPEAT = re.compile(r"[+*]|\{\d*,\d*\}")  # Quantifiers that can repeat something more than once
+
+_cache = OrderedDict()  # (predicate, pattern) -> compiled pattern
+_cache_lock = threading.Lock()
+
+def compile_pattern(predicate, pattern):
+    """
+    Return the compiled regex for a "matches regex"/"matches glob" condition value.
+
+    Raises ValueError if the pattern is invalid, too long, or could backtrack badly.
+    """
+    key = (predicate, pattern)
+    with _cache_lock:
+        compiled = _cache.get(key)
+        if compiled is not None:
+            _cache.move_to_end(key)
+            return compiled
+    if len(pattern) > config.PATTERN_MAX_LENGTH:
+        raise ValueError(f"Pattern is longer than {config.PATTERN_MAX_LENGTH} characters: {pattern[:40]}...")
+    if predicate == "matches glob":
+        source = fnmatch.translate(pattern)
+    else:
+        if repeats_risky_group(pattern):
+            raise ValueError(f"Pattern '{pattern}' repeats a group with a quantifier or | inside, "
+                             "which can take forever to match.")
+        source = pattern
+    try:
+        compiled = (regex or re).compile(source, re.IGNORECASE)
+    except (re.error, getattr(regex, "error", re.error)) as e:
+        raise ValueError(f"Invalid pattern '{pattern}': {e}")
+    with _cache_lock:
+        _cache[key] = compiled
+        while len(_cache) > config.PATTERN_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
+
+def repeats_risky_group(pattern):
+    """
+    Check if a regex repeats (+, *, {n,m}) a group that has a quantifier or an
+    alternation anywhere inside, e.g. (a+)+, (\\w*x)*, (a|aa)+ or ((a|b)c)*.
+    There are then many ways to split the text between the repeats, and a failing
+    match tries them all.
+    """
+    risky_groups = []  # One flag per open group: has it got a quantifier or | inside?
+    closed_risky = False  # The last thing seen was a risky group closing
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        repeat = REPEAT.match(pattern, i)
+        if char == "\\":
+            i += 2
+            closed_risky = False
+            continue
+        if char == "[":
+            # Skip the character class; a ] straight after [ or [^ is part of it.
+            i += 2 if pattern.startswith("[^", i) else 1
+            i += pattern.startswith("]", i)
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            closed_risky = False
+        elif char == "(":
+            risky_groups.append(False)
+            closed_risky = False
+        elif char == ")":
+            closed_risky = risky_groups.pop() if risky_groups else False
+            if closed_risky and risky_groups:
+                risky_groups[-1] = True
+        elif repeat or char == "|":
+            if repeat and closed_risky:
+                return True
+            if risky_groups:
+                risky_groups[-1] = True
+            closed_risky = False
+            if repeat:
+                i = repeat.end()
+                continue
+        else:
+            closed_risky = False
+        i += 1
+    return False
+
+def pattern_matches(predicate, pattern, text):
+    """Check a "matches regex"/"matches glob" condition against some text."""
+    compiled = compile_pattern(predicate, pattern)
+    if predicate == "matches glob":
+        # fnmatch's translations don't backtrack badly, and have to see the whole value.
+        search = compiled.match
+    else:
+        search = compiled.search
+        text = text[:config.PATTERN_MAX_TEXT]
+    if regex is None:
+        return search(text) is not None
+    try:
+        return search(text, timeout=config.PATTERN_TIMEOUT) is not None
+    except TimeoutError:
+        return False
+
+def check_patterns(ruleset):
+    """Compile every pattern in a ruleset. Returns an error message for the first bad one, or None."""
+    for condition in ruleset.get("rules", []):
+        predicate = condition.get("predicate", "").lower()
+        if predicate in PATTERN_PREDICATES:
+            try:
+                compile_pattern(predicate, str(condition.get("value", "")))
+            except ValueError as e:
+                return f"Error in {condition.get('field')} condition: {e}"
+    return None
+
+def clear_cache():
+    """Forget the compiled patterns."""
+    with _cache_lock:
+        _cache.clear()
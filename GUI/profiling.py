@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+profiling.py
+
+Opt-in profiling for sync runs. Wrap a phase (like fetching emails or applying
+rules) with profile_phase() or the @profiled decorator and, when profiling is
+switched on in config, it will:
+- "full" mode: record the phase with cProfile and dump a .pstats file, plus a
+  tracemalloc report of the top allocation sites. Only one profiler can run at
+  a time, so a phase that starts while another is being profiled (nested in
+  it, or in another thread) just writes how long it took to a .time.txt file.
+- "sample" mode: peek at the running thread's stack every few milliseconds and
+  write the counts in collapsed-stack format (ready for flame graph tools).
+  Nothing is traced (not even allocations; tracemalloc slows down every one),
+  so this mode is cheap enough to leave on for long daemon runs.
+
+With PROFILE_MODE set to "off" (the default) everything here is a no-op.
+"""
+
+import os
+import sys
+import time
+import itertools
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import config  # Profiling settings live with the rest of our config
+
+PROFILE_MODES = ["off", "full", "sample"]
+_report_numbers = itertools.count(1)  # Tells apart reports of phases started in the same second
+_active_profiler = None  # The cProfile.Profile of the phase being profiled in "full" mode, if any
+_profiler_lock = threading.Lock()
+
+class _StackSampler(threading.Thread):
+    """Background thread that periodically records the call stack of another thread."""
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def _write_allocation_report(path, name, start_snapshot, end_snapshot, limit):
+    # Compare the snapshots so the report only shows what this phase allocated.
+    stats = end_snapshot.compare_to(start_snapshot, "lineno")
+    current, peak = tracemalloc.get_traced_memory()
+    with open(path, "w") as f:
+        f.write(f"Top {limit} allocation sites for phase '{name}'\n")
+        f.write(f"Traced memory: current={current / 1024:.1f} KiB, peak={peak / 1024:.1f} KiB\n\n")
+        for stat in stats[:limit]:
+            f.write(f"{stat}\n")
+
+def _write_timing(path, name, seconds):
+    with open(path, "w") as f:
+        f.write(f"Phase '{name}' took {seconds:.3f} s (another phase was already being profiled)\n")
+
+def _write_samples(path, counts):
+    with open(path, "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+@contextmanager
+def profile_phase(name):
+    """
+    Profile everything that runs inside the with-block as one phase.
+
+    Reports are written to config.PROFILE_DIR, named after the phase, the time
+    it started, the process ID and a counter, so phases that start in the same
+    second (in this process or another) never overwrite each other.
+    """
+    mode = config.PROFILE_MODE.lower()
+    if mode not in ("full", "sample"):
+        yield
+        return
+
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    stamp = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_report_numbers)}"
+    base_path = os.path.join(config.PROFILE_DIR, f"{name}-{stamp}")
+
+    global _active_profiler
+    profiler = sampler = start_snapshot = None
+    owns_tracemalloc = False
+    started = time.perf_counter()
+    if mode == "full":
+        # Python only allows one cProfile at a time (3.12+ raises, older versions
+        # cut off the outer profile), so only the outermost phase gets one.
+        with _profiler_lock:
+            if _active_profiler is None:
+                profiler = _active_profiler = cProfile.Profile()
+        if profiler:
+            # Only start tracemalloc if nobody else has.
+            owns_tracemalloc = not tracemalloc.is_tracing()
+            if owns_tracemalloc:
+                tracemalloc.start(config.PROFILE_TRACEMALLOC_FRAMES)
+            start_snapshot = tracemalloc.take_snapshot()
+            try:
+                profiler.enable()
+            except ValueError:  # Some other profiling tool (not ours) is already running
+                profiler = None
+                with _profiler_lock:
+                    _active_profiler = None
+    else:
+        sampler = _StackSampler(threading.get_ident(), config.PROFILE_SAMPLE_INTERVAL)
+        sampler.start()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            with _profiler_lock:
+                _active_profiler = None
+            profiler.dump_stats(f"{base_path}.pstats")
+        if start_snapshot:
+            _write_allocation_report(f"{base_path}.alloc.txt", name, start_snapshot,
+                                     tracemalloc.take_snapshot(), config.PROFILE_TOP_ALLOCATIONS)
+            if owns_tracemalloc:
+                tracemalloc.stop()
+        if mode == "full" and not profiler:
+            _write_timing(f"{base_path}.time.txt", name, time.perf_counter() - started)
+        if sampler:
+            sampler.stop()
+            _write_samples(f"{base_path}.samples.txt", sampler.counts)
+
+def profiled(name):
+    """Decorator version of profile_phase() for whole functions."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+remote_rules.py
+
+"Remote apply" mode: run a ruleset against Gmail itself instead of the copy
+in our database. It:
+- Translates the ruleset into a Gmail search query (the q= parameter), e.g.
+  From contains "github" + Received less than 7 days -> from:("github") newer_than:8d
+  (a day wider, since the date itself is checked again locally).
+- Lists the matching message IDs on Gmail's side, page by page.
+- Checks any conditions Gmail can't express exactly by downloading just those
+  candidates, then batch-applies the actions.
+
+Gmail matches whole words ("test" won't find "latest"), its plain terms
+search the whole message, and its newer_than/older_than don't line up with our
+whole-day and calendar-month cutoffs, so only conditions where Gmail's answer
+can't include extra emails are trusted as-is. The rest are checked locally, so the
+actions never reach an email the local rules wouldn't match (though Gmail's
+word matching can miss a few that they would).
+"""
+
+from gmail_api import authenticate_gmail, iter_email_pages, get_email
+from body_store import fetch_body
+from profiling import profiled
+from patterns import check_patterns
+from rules_engine import load_rules, compile_ruleset, evaluate_email, apply_actions
+
+# Gmail search operators for the text fields we store.
+# Plain terms search the whole message (headers, body, attachment names), which is
+# more than the snippet or body text matched locally, so those are always checked.
+FIELD_OPERATORS = {
+    "from": "from:",
+    "to": "to:",
+    "subject": "subject:",
+    "message": "",
+    "message body": ""
+}
+
+def quote_term(value):
+    """Quote a value for Gmail search (Gmail has no escape for quotes, so they're dropped)."""
+    return '"' + value.replace('"', " ").strip() + '"'
+
+def condition_to_query(condition):
+    """
+    Translate one condition into a Gmail search term.
+
+    Returns (term, exact):
+      - term: the Gmail search text, or None if Gmail can't narrow this condition down.
+      - exact: True if Gmail's answer can be trusted as-is, False if each candidate
+        still has to be checked locally (e.g. "equals", which Gmail can only
+        approximate with a word search, or "does not contain", where Gmail only
+        leaves out emails with the whole word).
+
+    Date conditions become a slightly wider newer_than/older_than in days (never
+    narrower than date_cutoff in rules_engine) and are always checked locally.
+    """
+    field = condition.get("field", "").lower()
+    predicate = condition.get("predicate", "").lower()
+    value = str(condition.get("value", "")).strip()
+    if "received" in field:
+        try:
+            num = int(value)
+        except ValueError:
+            return None, False
+        months = condition.get("unit", "days").lower() == "months"
+        if predicate == "less than":
+            # Locally: received within N days (or N calendar months, at most 31 days each).
+            return f"newer_than:{(31 * num if months else num) + 1}d", False
+        if predicate == "greater than":
+            # Locally: at least N+1 whole days ago (or N calendar months, at least 28 days each).
+            days = 28 * num - 1 if months else num
+            return (f"older_than:{days}d", False) if days > 0 else (None, False)
+        return None, False
+    operator = FIELD_OPERATORS.get(field)
+    if operator is None or not value.replace('"', "").strip():
+        return None, False
+    term = f"{operator}({quote_term(value)})" if operator else quote_term(value)
+    if predicate == "contains":
+        return term, bool(operator)
+    if predicate == "does not contain":
+        return f"-{term}", False
+    if predicate == "equals":
+        return term, False
+    return None, False
+
+def build_gmail_query(ruleset):
+    """
+    Compile a ruleset into a Gmail search query.
+
+    Returns (query, residual_rules): the q= string and the conditions that must still
+    be checked locally on each candidate. Returns (None, None) if the ruleset can't
+    be run remotely: for "Any" rulesets every condition has to translate exactly,
+    since one unknown condition could match any message, and a ruleset without a
+    positive search term (only exclusions like -subject:(...), or nothing) would
+    mean going through nearly the whole mailbox.
+    """
+    terms = []
+    residual = []
+    policy = ruleset.get("match_policy", "All").lower()
+    for condition in ruleset.get("rules", []):
+        term, exact = condition_to_query(condition)
+        if policy != "all" and not exact:
+            return None, None
+        if term:
+            terms.append(term)
+        if not exact:
+            residual.append(condition)
+    if not any(not term.startswith("-") for term in terms):
+        return None, None
+    if policy != "all" and len(terms) > 1:
+        return "{" + " ".join(terms) + "}", []
+    return " ".join(terms), residual
+
+@profiled("apply_rules_remotely")
+def apply_rules_remotely():
+    """
+    Apply the rules file straight to Gmail, without syncing emails first.
+
+    Returns a string with a summary of what happened.
+    """
+    ruleset = load_rules()
+    if not ruleset:
+        return "Missing or invalid rules.json file."
+    pattern_error = check_patterns(ruleset)
+    if pattern_error:
+        return pattern_error
+    query, residual = build_gmail_query(ruleset)
+    if query is None:
+        return "These rules can't be applied remotely. Fetch emails and use Apply Rules instead."
+    residual_ruleset = compile_ruleset({"match_policy": "All", "rules": residual})
+
+    try:
+        service = authenticate_gmail()
+    except Exception as e:
+        return f"Error authenticating with Gmail: {e}"
+
+    output = [f"Gmail query: {query}"]
+    matched = 0
+    for page in iter_email_pages(service, query):
+        email_ids = [msg["id"] for msg in page]
+        if residual:
+            # Download only the candidates, to check what Gmail couldn't.
+            email_ids = [email_id for email_id in email_ids
+                         if check_locally(service, email_id, residual_ruleset, output)]
+        if email_ids:
+            matched += len(email_ids)
+            output.append(apply_actions(service, email_ids, ruleset["actions"]))
+    output.append(f"{matched} emails matched on Gmail.")
+    return "\n".join(output)
+
+def check_locally(service, email_id, residual_ruleset, output):
+    """Download one candidate and check the conditions Gmail couldn't; errors go to output."""
+    try:
+        return evaluate_email(get_email(service, email_id), residual_ruleset,
+                              lambda email: fetch_body(service, email_id))
+    except Exception as e:
+        output.append(f"Error processing message {email_id}: {e}")
+        return False
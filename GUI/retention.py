@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+retention.py
+
+Keeps the emails table down to a "hot" window, so fetches and rule runs don't
+get slower every month as the mailbox history piles up:
+- apply_retention() moves the current account's emails received more than
+  config.RETENTION_DAYS ago out of `emails`, either into the emails_archive
+  table (config.RETENTION_ARCHIVE = "table") or into a gzip'd JSON-lines file
+  in config.ARCHIVE_DIR ("export"). It works through id ranges, one short
+  transaction each.
+- sync_deletions() tombstones emails that were deleted in Gmail: they're moved
+  to emails_archive with deleted_at set (ones archived earlier just get
+  deleted_at). Gmail's history.list tells us which ones, starting from the
+  historyId saved in config.HISTORY_STATE_FILE.
+Fetches treat archived emails as already stored, and don't store emails that
+are already past the hot window, so nothing churns back into the live table.
+
+Why not MySQL RANGE partitioning on received_date? MySQL needs the partition
+column in every unique key, so email_id would stop being unique (and the
+upsert relies on that), and InnoDB doesn't allow FULLTEXT indexes on
+partitioned tables, which the "contains" pushdown uses. Moving cold rows to
+their own table gets the same effect: the live table only holds the hot
+window, and SQLite gets it too.
+"""
+
+import os
+import gzip
+import json
+import time
+import config
+import storage
+import gmail_api
+from accounts import current_account
+
+SECONDS_PER_DAY = 86400
+
+def apply_retention(now=None):
+    """
+    Move the current account's emails older than config.RETENTION_DAYS out of the emails table.
+
+    Returns a string saying how many emails were archived (and where), or an error message.
+    """
+    if config.RETENTION_DAYS is None:
+        return "Retention is off (config.RETENTION_DAYS is None)."
+    cutoff = int(now or time.time()) - config.RETENTION_DAYS * SECONDS_PER_DAY
+    filters = [("account", "=", current_account()), ("received_ts", "<", cutoff)]
+    try:
+        if config.RETENTION_ARCHIVE == "export":
+            moved, path = export_emails(filters)
+            where = path
+        else:
+            moved = archive_in_ranges(filters)
+            where = "the emails_archive table"
+    except Exception as e:
+        return f"Error applying retention: {e}"
+    if not moved:
+        return f"No emails older than {config.RETENTION_DAYS} days to archive."
+    return f"Archived {moved} emails older than {config.RETENTION_DAYS} days to {where}."
+
+def archive_in_ranges(filters, deleted_at=None):
+    """Archive the emails matching `filters` a config.DB_BATCH_SIZE-wide id range at a time."""
+    low, high = storage.id_bounds(filters)
+    if low is None:
+        return 0
+    moved = 0
+    for start in range(low, high + 1, config.DB_BATCH_SIZE):
+        moved += storage.archive_emails(filters + [("id", ">=", start), ("id", "<", start + config.DB_BATCH_SIZE)],
+                                        deleted_at)
+    return moved
+
+def export_emails(filters):
+    """
+    Write the emails matching `filters` to a new gzip'd JSON-lines file, then delete them.
+
+    Rows are only deleted once the file is complete, and only up to the last one
+    written, so emails stored during the export stay put.
+    Returns (number of emails exported, file path or None).
+    """
+    os.makedirs(config.ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(config.ARCHIVE_DIR, f"emails-{current_account()}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz")
+    count = 0
+    last_id = None
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for email in storage.stream_emails(filters):
+            f.write(json.dumps(email, default=str) + "\n")
+            last_id = email["id"]
+            count += 1
+    if last_id is None:
+        os.remove(path)
+        return 0, None
+    storage.delete_emails(filters + [("id", "<=", last_id)])
+    return count, path
+
+def load_history_state():
+    """Load the last historyId checked for deletions, per account (an empty dict if there isn't one)."""
+    try:
+        with open(config.HISTORY_STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_history_state(state):
+    temp_file = f"{config.HISTORY_STATE_FILE}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(temp_file, config.HISTORY_STATE_FILE)
+
+def sync_deletions(service):
+    """
+    Tombstone the stored emails that were deleted in Gmail since the last check.
+
+    The first call only records where Gmail's history is now. If Gmail no longer
+    has history that far back (it keeps about a week), tracking starts over from now.
+    Returns a string saying what happened, or an error message.
+    """
+    from googleapiclient.errors import HttpError
+    account = current_account()
+    state = load_history_state()
+    start = state.get(account)
+    try:
+        if start is None:
+            state[account] = service.users().getProfile(userId="me").execute()["historyId"]
+            save_history_state(state)
+            return "Started tracking emails deleted in Gmail."
+        deleted = []
+        page_token = None
+        latest = start
+        while True:
+            response = service.users().history().list(
+                userId="me", startHistoryId=start, historyTypes=["messageDeleted"], pageToken=page_token
+            ).execute()
+            for record in response.get("history", []):
+                deleted.extend(item["message"]["id"] for item in record.get("messagesDeleted", []))
+            latest = response.get("historyId", latest)
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+    except HttpError as e:
+        if e.resp.status == 404:
+            state.pop(account, None)
+            save_history_state(state)
+            return "Gmail's history has expired; deletions will be tracked again from the next check."
+        return f"Error checking Gmail for deleted emails: {e}"
+    except Exception as e:
+        return f"Error checking Gmail for deleted emails: {e}"
+    tombstoned = 0
+    now = int(time.time())
+    try:
+        for start_index in range(0, len(deleted), config.DB_BATCH_SIZE):
+            chunk = deleted[start_index:start_index + config.DB_BATCH_SIZE]
+            tombstoned += storage.archive_emails([("account", "=", account), ("email_id", "in", chunk)], now)
+    except Exception as e:
+        return f"Error tombstoning deleted emails: {e}"
+    state[account] = latest
+    save_history_state(state)
+    return f"Marked {tombstoned} stored emails as deleted in Gmail."
+
+def run_retention(service=None):
+    """
+    Tombstone emails deleted in Gmail, then archive the ones past the hot window.
+
+    Logs in to Gmail only if no service is given. Returns the combined output.
+    """
+    output = []
+    try:
+        output.append(sync_deletions(service or gmail_api.authenticate_gmail()))
+    except Exception as e:
+        output.append(f"Error authenticating with Gmail: {e}")
+    output.append(apply_retention())
+    return "\n".join(output)
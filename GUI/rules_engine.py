@@ -13,10 +13,24 @@ This module handles rule-based email processing. It:
 
 import os
 import json
-from datetime import datetime
-from gmail_api import authenticate_gmail
-from mysql_db import fetch_emails_mysql
+import time
+import hashlib
+import threading
+import calendar
+import multiprocessing
+from collections import Counter
+from datetime import datetime, timezone
+import config
+import storage
+import gmail_api
+from gmail_api import label_id
+from accounts import current_account
+import body_store
+import message_cache
+from normalize import casefold, normalized_fields
+from patterns import PATTERN_PREDICATES, pattern_matches, check_patterns
 from config import RULES_FILE
+from profiling import profiled
 
 # Mapping from simple names to Gmail API label IDs.
 LABEL_MAPPING = {
@@ -26,6 +40,49 @@ LABEL_MAPPING = {
     "promotions": "CATEGORY_PROMOTIONS"
 }
 
+DATE_PREDICATES = ["less than", "greater than"]
+TEXT_PREDICATES = ["contains", "does not contain", "equals", "does not equal"] + PATTERN_PREDICATES
+# Keys compile_ruleset() adds to conditions; they're worked out from the rest, so they're not hashed.
+COMPILED_KEYS = ["cutoff", "value_norm", "stats_key"]
+SECONDS_PER_DAY = 86400
+# Settings copied into worker processes so they read the same database (see find_matches).
+WORKER_SETTINGS = ["DB_BACKEND", "DB_CONFIG", "SQLITE_PATH", "DB_BATCH_SIZE", "FULLTEXT_MIN_LENGTH",
+                   "RULE_STATS_SAMPLE", "PATTERN_CACHE_SIZE", "PATTERN_MAX_LENGTH", "PATTERN_MAX_TEXT",
+                   "PATTERN_TIMEOUT"]
+# Each worker gets several id ranges, so one slow range doesn't leave the others idle.
+SHARDS_PER_WORKER = 4
+
+# Incremental runs also re-check rows written shortly before the previous run started,
+# in case a fetch was still committing them while that run was reading.
+WATERMARK_OVERLAP_SECONDS = 60
+
+# Rule fields whose case-folded column the full-text index covers (see build_pushdown_filters).
+FIELD_COLUMNS = {
+    "subject": "subject_norm",
+    "message": "snippet_norm"
+}
+
+# Rule fields that need the full message body (see body_store.py). They're checked last,
+# so the body is only loaded when the other conditions haven't already decided.
+BODY_FIELDS = ["message body"]
+
+# Assumed time for a condition that has no stats yet (seconds); about what a text match takes.
+DEFAULT_CONDITION_COST = 1e-6
+
+_stats_lock = threading.Lock()
+
+# Rule fields and the case-folded email value (and column) they're matched against (see normalize.py).
+NORMALIZED_FIELDS = {
+    "from": ("from_norm", "from_norm"),
+    "to": ("to_norm", "to_norm"),
+    "subject": ("subject_norm", "subject_norm"),
+    "message": ("message_norm", "snippet_norm")
+}
+
+def authenticate_gmail():
+    """Log in to Gmail (see gmail_api.authenticate_gmail), looked up when called so it can be swapped out."""
+    return gmail_api.authenticate_gmail()
+
 def load_rules():
     """
     Load the rules from our JSON file.
@@ -43,6 +100,209 @@ def load_rules():
             print("Error decoding the rules file. Check its contents.")
             return None
 
+def ruleset_hash(ruleset):
+    """
+    A fingerprint of what a ruleset does (its policy, conditions and actions).
+
+    Keys and letter case that don't change the meaning are normalized, so just
+    re-saving the same rules keeps the same hash.
+    """
+    canonical = {
+        "match_policy": str(ruleset.get("match_policy", "All")).lower(),
+        "rules": [canonical_item(condition) for condition in ruleset.get("rules", [])],
+        "actions": [canonical_item(action) for action in ruleset.get("actions", [])]
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+def canonical_item(item):
+    """A condition or action with lower-case keys (and values, except "value") and no compiled keys."""
+    return {key.lower(): str(value).lower() if key.lower() != "value" else str(value)
+            for key, value in item.items() if key not in COMPILED_KEYS}
+
+def condition_key(condition):
+    """Key a condition's stats are saved under; the same condition in another ruleset shares them."""
+    return json.dumps(canonical_item(condition), sort_keys=True)
+
+def rule_state_key(ruleset):
+    """
+    Key for a ruleset's saved state: the ruleset hash plus which account and database it ran on.
+    Pass the ruleset as loaded, before compile_ruleset.
+    """
+    if config.DB_BACKEND.lower() == "sqlite":
+        database = os.path.abspath(config.SQLITE_PATH)
+    else:
+        database = f"{config.DB_CONFIG.get('host')}/{config.DB_CONFIG.get('database')}"
+    return f"{ruleset_hash(ruleset)}@{current_account()}/{config.DB_BACKEND.lower()}:{database}"
+
+def load_rule_state():
+    """Load the saved per-ruleset state (watermarks), or an empty dict if there isn't any."""
+    try:
+        with open(config.RULES_STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_rule_state(state):
+    """Write the per-ruleset state, replacing the file in one step so it's never half-written."""
+    temp_file = f"{config.RULES_STATE_FILE}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(temp_file, config.RULES_STATE_FILE)
+
+def load_rule_stats():
+    """
+    Load the saved per-condition stats: condition_key -> [times checked, times passed, seconds spent].
+    Returns an empty dict if there aren't any.
+    """
+    try:
+        with open(config.RULE_STATS_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_rule_stats(new_stats):
+    """
+    Add the stats collected during a run to the saved ones.
+
+    Once a condition has been checked more than config.RULE_STATS_WINDOW times its
+    counts are halved, so older runs gradually count for less.
+    """
+    with _stats_lock:
+        stats = load_rule_stats()
+        for key, (checked, passed, seconds) in new_stats.items():
+            entry = stats.get(key, [0, 0, 0.0])
+            entry = [entry[0] + checked, entry[1] + passed, entry[2] + seconds]
+            while entry[0] > config.RULE_STATS_WINDOW:
+                entry = [entry[0] // 2, entry[1] // 2, entry[2] / 2]
+            stats[key] = entry
+        temp_file = f"{config.RULE_STATS_FILE}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump(stats, f, indent=4)
+        os.replace(temp_file, config.RULE_STATS_FILE)
+
+def record_condition(stats, condition, passed, seconds):
+    """Count one check of a condition into a stats dict (see load_rule_stats)."""
+    key = condition.get("stats_key") or condition_key(condition)
+    entry = stats.get(key)
+    if entry is None:
+        entry = stats[key] = [0, 0, 0.0]
+    entry[0] += 1
+    entry[1] += passed
+    entry[2] += seconds
+
+def merge_stats(stats, more):
+    """Add one stats dict into another (e.g. a worker's into the run's)."""
+    for key, (checked, passed, seconds) in more.items():
+        entry = stats.setdefault(key, [0, 0, 0.0])
+        entry[0] += checked
+        entry[1] += passed
+        entry[2] += seconds
+
+def condition_rank(condition, stats, match_all):
+    """
+    Expected cost of a condition per email it settles; lower runs first.
+
+    Under "All" a condition settles the result when it fails, under "Any" when it
+    passes, so the cheap conditions that most often do that go first. Conditions
+    without stats count as taking DEFAULT_CONDITION_COST and passing half the time.
+    """
+    checked, passed, seconds = stats.get(condition["stats_key"], (0, 0, 0.0))
+    cost = seconds / checked if checked else DEFAULT_CONDITION_COST
+    pass_rate = (passed + 1) / (checked + 2)  # Smoothed, so a few checks can't make it 0 or 1
+    return cost / ((1 - pass_rate) if match_all else pass_rate)
+
+def evaluation_order(ruleset):
+    """
+    The order evaluate_email checks conditions in: the compiled "plan" if there is
+    one, otherwise file order. Either way Message Body conditions come last.
+    """
+    if "plan" in ruleset:
+        return ruleset["plan"]
+    rules = ruleset.get("rules", [])
+    return ([c for c in rules if c.get("field", "").lower() not in BODY_FIELDS] +
+            [c for c in rules if c.get("field", "").lower() in BODY_FIELDS])
+
+def changed_since_filter(ruleset, previous):
+    """
+    Storage filter for the emails whose result could have changed since the last run.
+
+    That's every row written since the previous run started, plus rows that have
+    aged past a "greater than" date cutoff in the meantime (those are the only
+    conditions that start passing just because time went by).
+    """
+    groups = [[("fetched_at", ">=", previous["watermark"])]]
+    for condition, old_cutoff in zip(ruleset.get("rules", []), previous.get("cutoffs", [])):
+        cutoff = condition.get("cutoff")
+        if cutoff and old_cutoff and cutoff[0] in ("<", "<="):
+            groups.append([("received_ts", ">=", old_cutoff[1]), ("received_ts", "<=", cutoff[1])])
+    return groups
+
+def subtract_months(moment, months):
+    """
+    Go back a number of calendar months from a datetime.
+
+    The day is clamped to the end of the target month, so March 31 minus one
+    month is February 28 (or 29 in a leap year).
+    """
+    month_index = moment.year * 12 + moment.month - 1 - months
+    year, month = divmod(month_index, 12)
+    month += 1
+    day = min(moment.day, calendar.monthrange(year, month)[1])
+    return moment.replace(year=year, month=month, day=day)
+
+def date_cutoff(condition, now):
+    """
+    Work out the received-time boundary for a "Received Date/Time" condition.
+
+    Returns (operator, epoch_seconds) such that an email passes when
+    `received_ts <operator> epoch_seconds`, or None if the value isn't a number.
+    For days this matches "(now - received).days < N" (or "> N") exactly; months
+    are real calendar months counted back from `now`.
+    """
+    try:
+        num = int(condition["value"])
+    except ValueError:
+        return None
+    predicate = condition["predicate"].lower()
+    if condition.get("unit", "days").lower() == "months":
+        boundary = subtract_months(now, num).timestamp()
+        return (">", boundary) if predicate == "less than" else ("<", boundary)
+    now_ts = now.timestamp()
+    if predicate == "less than":
+        return (">", now_ts - num * SECONDS_PER_DAY)
+    # More than N whole days ago means at least N+1 days have passed.
+    return ("<=", now_ts - (num + 1) * SECONDS_PER_DAY)
+
+def compile_ruleset(ruleset, now=None, stats=None):
+    """
+    Prepare a ruleset for a run over many emails.
+
+    Each date condition gets its cutoff (see date_cutoff) worked out once, so
+    checking an email is a single integer comparison instead of date math per row,
+    and each text condition gets its case-folded value ("value_norm").
+
+    With `stats` (see load_rule_stats), the ruleset also gets a "plan": its
+    conditions in the order evaluate_email should check them, cheapest per
+    decided email first (see condition_rank). "rules" keeps the file order.
+    Returns a new ruleset dict; the original is left untouched.
+    """
+    now = now or datetime.now(timezone.utc)
+    rules = []
+    for condition in ruleset.get("rules", []):
+        if "received" in condition.get("field", "").lower() and condition.get("predicate", "").lower() in DATE_PREDICATES:
+            condition = {**condition, "cutoff": date_cutoff(condition, now)}
+        else:
+            condition = {**condition, "value_norm": condition_value(condition)}
+        rules.append({**condition, "stats_key": condition_key(condition)})
+    compiled = {**ruleset, "rules": rules}
+    plan = evaluation_order(compiled)
+    if stats:
+        match_all = ruleset.get("match_policy", "All").lower() == "all"
+        # Body conditions stay last whatever their stats say; loading a body may mean a Gmail call.
+        plan = sorted(plan, key=lambda c: (c.get("field", "").lower() in BODY_FIELDS,
+                                           condition_rank(c, stats, match_all)))
+    return {**compiled, "plan": plan}
+
 def match_condition(email_value, condition):
     """
     Check if a single condition passes for an email field.
@@ -51,59 +311,241 @@ def match_condition(email_value, condition):
       - contains, does not contain, equals, and does not equal.
     For dates (like the received date), it handles:
       - less than or greater than, treating the value as a number (days or months).
+      The email value can be a datetime or UTC epoch seconds.
 
     Returns True if the condition is met, else False.
     """
     predicate = condition["predicate"].lower()
     value = condition["value"]
     
-    if isinstance(email_value, datetime) and predicate in ["less than", "greater than"]:
-        try:
-            num = int(value)
-        except ValueError:
+    if isinstance(email_value, (datetime, int, float)) and predicate in DATE_PREDICATES:
+        if "cutoff" in condition:
+            cutoff = condition["cutoff"]
+        else:
+            tz = email_value.tzinfo if isinstance(email_value, datetime) else timezone.utc
+            cutoff = date_cutoff(condition, datetime.now(tz))
+        if cutoff is None:
             return False
-        unit = condition.get("unit", "days").lower()
-        if unit == "months":
-            num *= 30  # rough conversion to days
-        diff = (datetime.now(email_value.tzinfo) - email_value).days
-        if predicate == "less than":
-            return diff < num
-        elif predicate == "greater than":
-            return diff > num
+        received = email_value.timestamp() if isinstance(email_value, datetime) else email_value
+        operator, boundary = cutoff
+        if operator == ">":
+            return received > boundary
+        elif operator == "<":
+            return received < boundary
+        return received <= boundary
     elif isinstance(email_value, str):
-        if predicate == "contains":
-            return value.lower() in email_value.lower()
-        elif predicate == "does not contain":
-            return value.lower() not in email_value.lower()
-        elif predicate == "equals":
-            return email_value.lower() == value.lower()
-        elif predicate == "does not equal":
-            return email_value.lower() != value.lower()
+        value_norm = condition["value_norm"] if "value_norm" in condition else condition_value(condition)
+        return match_text(casefold(email_value), predicate, value_norm)
     return False
 
-def evaluate_email(email, ruleset):
+def condition_value(condition):
+    """
+    The value a text condition is matched with: case-folded, except for regex
+    and glob patterns, which ignore case themselves (folding would turn \\S into \\s).
+    """
+    value = str(condition.get("value", ""))
+    return value if condition.get("predicate", "").lower() in PATTERN_PREDICATES else casefold(value)
+
+def match_text(email_norm, predicate, value_norm, sender=None):
+    """
+    Check a text predicate on values that are already case-folded.
+
+    `sender` is the bare From address; "equals" and the patterns then also pass
+    if the rule value matches just the address, e.g. "a@b.com" or "*@b.com" for
+    '"Name" <a@b.com>'.
+    For "matches regex"/"matches glob", `value_norm` is the pattern (see patterns.py).
+    """
+    if predicate == "contains":
+        return value_norm in email_norm
+    elif predicate == "does not contain":
+        return value_norm not in email_norm
+    elif predicate in ("equals", "does not equal"):
+        equal = email_norm == value_norm or (sender is not None and sender == value_norm)
+        return equal if predicate == "equals" else not equal
+    elif predicate in PATTERN_PREDICATES:
+        return (pattern_matches(predicate, value_norm, email_norm) or
+                (sender is not None and pattern_matches(predicate, value_norm, sender)))
+    return False
+
+def uses_body(ruleset):
+    """Check if any condition needs the full message body."""
+    return any(condition.get("field", "").lower() in BODY_FIELDS for condition in ruleset.get("rules", []))
+
+def evaluate_email(email, ruleset, load_body=None, stats=None):
     """
     Check an email against a set of rules.
 
     It maps fields like "Received Date/Time" to the email's received_date
     and "Message" to the email's message. Depending on the overall match policy
     ("All" or "Any"), it returns True if the email passes the rules.
+
+    Conditions are checked in evaluation_order() and it stops as soon as the
+    result is settled: at the first failing condition for "All", the first
+    passing one for "Any". "Message Body" conditions use email["body"], or call
+    load_body(email) to get it, so the body is only loaded if it's still needed.
+
+    If `stats` is given (a sampled email, see stats_sample), every condition is
+    checked and counted into it (see record_condition), not just the ones before
+    the result is settled; otherwise conditions later in the plan would only be
+    timed on the emails the earlier ones let through, and the plan would never change.
     """
-    results = []
-    for condition in ruleset.get("rules", []):
+    match_all = ruleset.get("match_policy", "All").lower() == "all"
+    result = None
+    normalized = None
+    body_norm = None
+    for condition in evaluation_order(ruleset):
+        started = time.perf_counter() if stats is not None else 0
         field = condition.get("field", "").lower()
-        if field in ["from", "to", "subject"]:
-            email_value = email.get(field, "")
-        elif "received" in field:
-            email_value = email.get("received_date", None)
-        elif field == "message":
-            email_value = email.get("message", "")
+        predicate = condition.get("predicate", "").lower()
+        if field in BODY_FIELDS:
+            if body_norm is None:
+                body = email.get("body")
+                if body is None and load_body is not None:
+                    body = load_body(email)
+                body_norm = casefold(body)
+            value_norm = condition["value_norm"] if "value_norm" in condition else condition_value(condition)
+            passed = match_text(body_norm, predicate, value_norm)
+        elif field in NORMALIZED_FIELDS and predicate in TEXT_PREDICATES:
+            # Stored emails come with case-folded fields; anything else gets them worked out once here.
+            if normalized is None:
+                normalized = email if email.get("subject_norm") is not None else normalized_fields(email)
+            value_norm = condition["value_norm"] if "value_norm" in condition else condition_value(condition)
+            sender = normalized["from_email"] if field == "from" else None
+            passed = match_text(normalized[NORMALIZED_FIELDS[field][0]], predicate, value_norm, sender)
         else:
-            email_value = email.get(field, "")
-        results.append(match_condition(email_value, condition))
-    
-    policy = ruleset.get("match_policy", "All").lower()
-    return all(results) if policy == "all" else any(results)
+            if field in ["from", "to", "subject"]:
+                email_value = email.get(field, "")
+            elif "received" in field:
+                # Prefer the stored epoch seconds; fall back to the datetime.
+                email_value = email.get("received_ts")
+                if email_value is None:
+                    email_value = email.get("received_date", None)
+            elif field == "message":
+                email_value = email.get("message", "")
+            else:
+                email_value = email.get(field, "")
+            passed = match_condition(email_value, condition)
+        if stats is not None:
+            record_condition(stats, condition, passed, time.perf_counter() - started)
+        if passed != match_all:
+            if stats is None:
+                return passed
+            result = passed if result is None else result
+    return match_all if result is None else result
+
+def is_searchable_text(value):
+    """
+    Check if a "contains" value can be looked up in the full-text index.
+
+    It has to be a single word (no spaces or quotes) of at least
+    config.FULLTEXT_MIN_LENGTH characters; shorter or multi-word values
+    could be missed by the index, so those are only checked in Python.
+    """
+    return len(value) >= config.FULLTEXT_MIN_LENGTH and not any(c.isspace() or c == '"' for c in value)
+
+def build_pushdown_filters(ruleset):
+    """
+    Turn the parts of a ruleset the database can check into storage filters.
+
+    That's "contains" conditions on Subject and Message, which are looked up through
+    the full-text index, "equals" conditions, which compare the case-folded columns
+    (From also checks the indexed bare address), and date conditions from a compiled
+    ruleset (see compile_ruleset), which become range lookups on the indexed
+    received_ts column.
+    Filters only narrow down the candidates; evaluate_email still checks each
+    candidate exactly. They're only used when every condition has to hold ("All",
+    or a single condition).
+    """
+    conditions = ruleset.get("rules", [])
+    if ruleset.get("match_policy", "All").lower() != "all" and len(conditions) != 1:
+        return []
+    filters = []
+    searchable = None
+    for condition in conditions:
+        if condition.get("cutoff"):
+            operator, boundary = condition["cutoff"]
+            filters.append(("received_ts", operator, boundary))
+            continue
+        field = condition.get("field", "").lower()
+        if field in NORMALIZED_FIELDS and condition.get("predicate", "").lower() == "equals":
+            value_norm = casefold(str(condition.get("value", "")))
+            column = NORMALIZED_FIELDS[field][1]
+            if field == "from":
+                filters.append([[(column, "=", value_norm)], [("from_email", "=", value_norm)]])
+            else:
+                filters.append((column, "=", value_norm))
+            continue
+        column = FIELD_COLUMNS.get(field)
+        # The index is over the case-folded columns, so it's searched with the case-folded
+        # value, e.g. "STRAẞE" -> "strasse", or it would miss rows the exact check matches.
+        value_norm = condition["value_norm"] if "value_norm" in condition else condition_value(condition)
+        if column and condition.get("predicate", "").lower() == "contains" and is_searchable_text(value_norm):
+            if searchable is None:
+                searchable = storage.fulltext_columns()
+            if column in searchable:
+                filters.append((column, "match", value_norm))
+    return filters
+
+def plan_actions(actions, resolve_label=None):
+    """
+    Fold a list of actions into one net label change for the Gmail API.
+
+    Actions are applied in order, so later ones win: "mark as read" followed by
+    "mark as unread" just adds UNREAD, and read + move becomes a single change that
+    removes UNREAD and INBOX and adds the destination label.
+
+    Move destinations in LABEL_MAPPING map straight to Gmail's label IDs. Any other
+    destination is a label name, turned into its ID by `resolve_label` (e.g. a
+    gmail_api.label_id lookup); without one, the upper-cased name is used as the ID.
+
+    Returns a dict with:
+      - "addLabelIds" / "removeLabelIds": the net labels to add and remove.
+      - "descriptions": what each action does, for the output log.
+    """
+    add_labels = {}
+    remove_labels = {}
+    descriptions = []
+    for action_dict in actions:
+        action_type = action_dict.get("action", "").lower()
+        if action_type == "mark as read":
+            adds, removes = [], ["UNREAD"]
+            descriptions.append("marked as read")
+        elif action_type == "mark as unread":
+            adds, removes = ["UNREAD"], []
+            descriptions.append("marked as unread")
+        elif action_type == "move message":
+            # Map the user-given destination to a Gmail label.
+            user_destination = action_dict.get("destination", "inbox")
+            destination_label = LABEL_MAPPING.get(user_destination.lower())
+            if destination_label is None:
+                destination_label = resolve_label(user_destination) if resolve_label else user_destination.upper()
+                descriptions.append(f"moved to {user_destination}")
+            else:
+                descriptions.append(f"moved to {destination_label}")
+            adds, removes = [destination_label], ["INBOX"]
+        else:
+            continue
+        # Dicts keep the labels in the order they were first mentioned.
+        for label in removes:
+            add_labels.pop(label, None)
+            remove_labels[label] = True
+        for label in adds:
+            remove_labels.pop(label, None)
+            add_labels[label] = True
+    return {
+        "addLabelIds": list(add_labels),
+        "removeLabelIds": list(remove_labels),
+        "descriptions": descriptions
+    }
+
+def modify_body(plan):
+    """The request body for messages.modify/batchModify from a plan_actions() result."""
+    body = {}
+    if plan["addLabelIds"]:
+        body["addLabelIds"] = plan["addLabelIds"]
+    if plan["removeLabelIds"]:
+        body["removeLabelIds"] = plan["removeLabelIds"]
+    return body
 
 def process_actions(service, email_id, actions):
     """
@@ -112,90 +554,451 @@ def process_actions(service, email_id, actions):
     Supported actions include:
       - Marking as read/unread.
       - Moving the email (with a specified destination).
+    The actions are folded into one net label change first (see plan_actions),
+    so the whole list costs a single modify call.
       
     Returns a string that summarizes what actions were taken.
     """
+    try:
+        plan = plan_actions(actions, lambda name: label_id(service, name))
+    except Exception as e:
+        return f"Error looking up labels for email {email_id}: {e}"
+    body = modify_body(plan)
+    if not body:
+        return ""
+    try:
+        service.users().messages().modify(userId="me", id=email_id, body=body).execute()
+    except Exception as e:
+        return f"Error processing actions on email {email_id}: {e}"
+    return "\n".join(f"Email {email_id} {description}." for description in plan["descriptions"])
+
+def apply_actions(service, email_ids, actions):
+    """
+    Run the same list of actions on many emails with as few API calls as possible.
+
+    The actions are folded into one net label change, then sent with
+    messages.batchModify for up to config.BATCH_MODIFY_SIZE emails per call.
+
+    Returns a string that summarizes what was done, including how many API calls
+    were saved compared to one call per action per email.
+    """
+    if not email_ids:
+        return ""
+    try:
+        plan = plan_actions(actions, lambda name: label_id(service, name))
+    except Exception as e:
+        return f"Error looking up labels for {len(email_ids)} emails: {e}"
+    body = modify_body(plan)
+    if not body:
+        return ""
     output = []
-    for action_dict in actions:
-        action_type = action_dict.get("action", "").lower()
+    calls = 0
+    for start in range(0, len(email_ids), config.BATCH_MODIFY_SIZE):
+        chunk = email_ids[start:start + config.BATCH_MODIFY_SIZE]
+        calls += 1
+        try:
+            service.users().messages().batchModify(userId="me", body={"ids": chunk, **body}).execute()
+        except Exception as e:
+            output.append(f"Error processing actions on {len(chunk)} emails: {e}")
+            continue
+        for email_id in chunk:
+            output.extend(f"Email {email_id} {description}." for description in plan["descriptions"])
+    unplanned_calls = len(email_ids) * len(plan["descriptions"])
+    output.append(
+        f"Applied actions to {len(email_ids)} emails with {calls} Gmail API call(s) "
+        f"({unplanned_calls - calls} saved)."
+    )
+    return "\n".join(output)
+
+def modify_threads(service, thread_ids, actions):
+    """
+    Run the same list of actions on whole conversations, one threads.modify call each.
+
+    A call covers every message in the thread, including ones we never fetched,
+    so a busy 20-message mailing-list thread costs one call instead of twenty.
+
+    Returns a string that summarizes what was done.
+    """
+    if not thread_ids:
+        return ""
+    try:
+        plan = plan_actions(actions, lambda name: label_id(service, name))
+    except Exception as e:
+        return f"Error looking up labels for {len(thread_ids)} threads: {e}"
+    body = modify_body(plan)
+    if not body:
+        return ""
+    output = []
+    messages = 0
+    for thread_id in thread_ids:
         try:
-            if action_type == "mark as read":
-                service.users().messages().modify(
-                    userId="me", id=email_id,
-                    body={"removeLabelIds": ["UNREAD"]}
-                ).execute()
-                output.append(f"Email {email_id} marked as read.")
-            elif action_type == "mark as unread":
-                service.users().messages().modify(
-                    userId="me", id=email_id,
-                    body={"addLabelIds": ["UNREAD"]}
-                ).execute()
-                output.append(f"Email {email_id} marked as unread.")
-            elif action_type == "move message":
-                # Map the user-given destination to a Gmail label.
-                user_destination = action_dict.get("destination", "inbox").lower()
-                destination_label = LABEL_MAPPING.get(user_destination, user_destination.upper())
-                service.users().messages().modify(
-                    userId="me", id=email_id,
-                    body={
-                        "removeLabelIds": ["INBOX"],
-                        "addLabelIds": [destination_label]
-                    }
-                ).execute()
-                output.append(f"Email {email_id} moved to {destination_label}.")
+            thread = service.users().threads().modify(userId="me", id=thread_id, body=body).execute()
         except Exception as e:
-            output.append(f"Error processing action '{action_type}' on email {email_id}: {e}")
+            output.append(f"Error processing actions on thread {thread_id}: {e}")
+            continue
+        messages += len(thread.get("messages", []))
+        output.extend(f"Thread {thread_id} {description}." for description in plan["descriptions"])
+    output.append(f"Applied actions to {len(thread_ids)} threads ({messages} emails) "
+                  f"with {len(thread_ids)} Gmail API call(s).")
     return "\n".join(output)
 
-def process_email_rules():
+def matching_threads(email_ids, ruleset, load_body=None):
+    """
+    Work out which conversations a batch of matching emails selects (config.THREAD_MODE).
+
+    With config.THREAD_MATCH "any", a thread matches as soon as one of its emails
+    does; with "all", every stored email of the thread has to match the rules too.
+
+    Returns (thread IDs, IDs of matching emails stored without a thread ID).
+    """
+    account = ("account", "=", current_account())
+    thread_ids = []
+    loose_ids = []
+    for email in storage.stream_emails([account, ("email_id", "in", email_ids)]):
+        if not email["thread_id"]:
+            loose_ids.append(email["email_id"])
+        elif email["thread_id"] not in thread_ids:
+            thread_ids.append(email["thread_id"])
+    if thread_ids and config.THREAD_MATCH.lower() == "all":
+        failing = {email["thread_id"] for email in storage.stream_emails([account, ("thread_id", "in", thread_ids)])
+                   if not evaluate_email(email, ruleset, load_body)}
+        thread_ids = [thread_id for thread_id in thread_ids if thread_id not in failing]
+    return thread_ids, loose_ids
+
+def shard_filters(filters, shard_count):
+    """
+    Split the stored emails matching `filters` into primary-key ranges.
+
+    Returns a list of filter lists, one per non-empty id range.
+    """
+    low, high = storage.id_bounds(filters)
+    if low is None:
+        return []
+    step = max(1, -(-(high - low + 1) // shard_count))  # Ceiling division
+    return [filters + [("id", ">=", start), ("id", "<", start + step)] for start in range(low, high + 1, step)]
+
+def evaluate_shard(task):
+    """
+    Worker-process entry point: check one id range of stored emails against the rules.
+
+    Each worker opens its own database connection and sends back only the IDs
+    of the emails that matched, not the emails themselves.
+
+    Returns a tuple of (number of emails checked, list of matching email IDs,
+    condition stats from the sampled emails).
+    """
+    settings, ruleset, filters = task
+    for name, value in settings.items():
+        setattr(config, name, value)
+    evaluated = 0
+    matched_ids = []
+    stats = {}
+    for email in storage.stream_emails(filters):
+        evaluated += 1
+        if evaluate_email(email, ruleset, stats=stats_sample(stats, evaluated)):
+            matched_ids.append(email["email_id"])
+    return evaluated, matched_ids, stats
+
+def stats_sample(stats, count):
+    """`stats` for one email in config.RULE_STATS_SAMPLE (the ones that get timed), None for the rest."""
+    sample = config.RULE_STATS_SAMPLE
+    return stats if sample and count % sample == 0 else None
+
+def find_matches(ruleset, filters, workers=1, load_body=None, stats=None):
+    """
+    Check the stored emails against a compiled ruleset.
+
+    Yields (number of emails checked, list of matching email IDs) as work finishes.
+    With more than one worker, the emails are split into id ranges that are
+    checked in separate processes, so matching can use every CPU core.
+    Rulesets that need message bodies (see evaluate_email) are checked in this
+    process, since loading a body may mean a Gmail call.
+
+    If a `stats` dict is given, condition stats from a sample of the emails
+    (see config.RULE_STATS_SAMPLE) are added to it.
+    """
+    if workers <= 1 or uses_body(ruleset):
+        evaluated = 0
+        for email in storage.stream_emails(filters):
+            evaluated += 1
+            sample = stats_sample(stats, evaluated) if stats is not None else None
+            yield 1, [email["email_id"]] if evaluate_email(email, ruleset, load_body, sample) else []
+        return
+    settings = {name: getattr(config, name) for name in WORKER_SETTINGS}
+    tasks = [(settings, ruleset, shard) for shard in shard_filters(filters, workers * SHARDS_PER_WORKER)]
+    # "spawn" starts clean processes, so no open database connections are shared with the parent.
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        for evaluated, matched_ids, shard_stats in pool.imap_unordered(evaluate_shard, tasks):
+            if stats is not None:
+                merge_stats(stats, shard_stats)
+            yield evaluated, matched_ids
+
+@profiled("process_email_rules")
+def process_email_rules(full_run=False, workers=None):
     """
     Load the rules, grab emails from the database, and for each email that matches
-    the rules, run the specified actions via the Gmail API.
+    the rules, run the specified actions via the Gmail API. Only the current
+    account's emails are checked (see accounts.py).
+
+    `workers` (default config.RULE_WORKERS) sets how many processes check emails
+    in parallel; see find_matches.
+
+    With config.THREAD_MODE on, matching emails select their whole conversations
+    (see matching_threads), and actions go out through threads.modify.
+
+    With config.INCREMENTAL_RULES on, a run only looks at emails stored or refreshed
+    since the last run of the same rules (see changed_since_filter); editing the
+    rules, or passing full_run=True, checks every email again.
 
     Returns a string with a summary of what happened.
     """
     ruleset = load_rules()
     if not ruleset:
         return "Missing or invalid rules.json file."
+    pattern_error = check_patterns(ruleset)
+    if pattern_error:
+        return pattern_error
+    run_started = int(time.time())
+    # Keyed by the rules as saved: compiling adds per-run date cutoffs, which would give
+    # every run of a date rule a new key (and a full scan).
+    state_key = rule_state_key(ruleset)
+    rule_key = ruleset_hash(ruleset)  # Same reason: queued actions are deduplicated on it
+    ruleset = compile_ruleset(ruleset, stats=load_rule_stats() if config.RULE_STATS_SAMPLE else None)
     
-    emails = fetch_emails_mysql()
-    if not emails or not isinstance(emails, list):
-        return "No emails to process."
+    state = load_rule_state() if config.INCREMENTAL_RULES else {}
+    previous = None if full_run else state.get(state_key)
+    filters = [("account", "=", current_account())] + build_pushdown_filters(ruleset)
+    if previous:
+        filters.append(changed_since_filter(ruleset, previous))
     
-    service = authenticate_gmail()
+    service = None
+    def gmail():
+        # Only log in to Gmail once we actually have something to do.
+        nonlocal service
+        service = service or authenticate_gmail()
+        return service
+    load_body = lambda email: body_store.get_body(email["email_id"], gmail)
+
     output = []
-    for email in emails:
-        if evaluate_email(email, ruleset):
-            output.append(f"Email {email['email_id']} matches rules. Running actions...")
-            actions_output = process_actions(service, email["email_id"], ruleset["actions"])
-            output.append(actions_output)
+    done_threads = set()
+    def send(email_ids):
+        # In thread mode the matches pick whole threads, each sent once per run.
+        if config.THREAD_MODE:
+            thread_ids, email_ids = matching_threads(email_ids, ruleset, load_body)
+            thread_ids = [thread_id for thread_id in thread_ids if thread_id not in done_threads]
+            done_threads.update(thread_ids)
+            if config.ACTION_QUEUE and thread_ids:
+                # The queue works per email, so queue every stored email of the matching threads.
+                email_ids += [email["email_id"] for email in storage.stream_emails(
+                    [("account", "=", current_account()), ("thread_id", "in", thread_ids)])]
+            elif thread_ids:
+                output.append(modify_threads(gmail(), thread_ids, ruleset["actions"]))
+        if not email_ids:
+            return
+        if config.ACTION_QUEUE:
+            # A full run means "apply everything again", so finished rows are queued again too.
+            storage.enqueue_actions(email_ids, rule_key, ruleset["actions"], requeue=full_run)
+        else:
+            output.append(apply_actions(gmail(), email_ids, ruleset["actions"]))
+
+    email_count = 0
+    matched = 0
+    matched_ids = []
+    stats = {}
+    try:
+        for evaluated, batch_ids in find_matches(ruleset, filters, workers or config.RULE_WORKERS, load_body, stats):
+            email_count += evaluated
+            for email_id in batch_ids:
+                output.append(f"Email {email_id} matches rules. Running actions...")
+                matched_ids.append(email_id)
+                matched += 1
+            # Send matches off in full batches so memory stays flat on big mailboxes.
+            if len(matched_ids) >= config.BATCH_MODIFY_SIZE:
+                send(matched_ids)
+                matched_ids = []
+        if matched_ids:
+            send(matched_ids)
+    except Exception as e:
+        return f"Error processing stored emails: {e}"
+    if stats:
+        try:
+            save_rule_stats(stats)
+        except OSError:
+            pass  # Stats only decide the order conditions are checked in
+    
+    # Move the watermark forward only if every action went through, so failures get retried.
+    # (Queued actions are retried by the queue itself, so only the matching has to succeed.)
+    if config.INCREMENTAL_RULES and not any(line.startswith("Error") for line in "\n".join(output).splitlines()):
+        state[state_key] = {
+            "watermark": run_started - WATERMARK_OVERLAP_SECONDS,
+            "cutoffs": [condition.get("cutoff") for condition in ruleset.get("rules", [])],
+            "evaluated": email_count,
+            "matched": matched
+        }
+        save_rule_state(state)
+    if config.ACTION_QUEUE and matched:
+        output.append(process_action_queue())
+    if email_count == 0:
+        return "No new or changed emails since the last run." if previous else "No emails to process."
     return "\n".join(output)
 
-def fetch_and_store_emails(message_count="10"):
+@profiled("process_action_queue")
+def process_action_queue(service=None):
+    """
+    Work through the pending_actions outbox until it's empty.
+
+    Any number of these can run at once (the GUI, the CLI, or extra
+    `main.py --action-worker` processes): each claims its own batch of rows, so
+    no email gets the same actions sent twice. Each batch is grouped by ruleset
+    and sent with apply_actions; failed groups go back in the queue with their
+    error until they run out of config.ACTION_MAX_ATTEMPTS.
+
+    Returns a string with a summary of what happened.
+    """
+    output = []
+    done = 0
+    try:
+        while True:
+            claimed = storage.claim_actions(config.BATCH_MODIFY_SIZE)
+            if not claimed:
+                break
+            service = service or authenticate_gmail()
+            groups = {}
+            for row in claimed:
+                groups.setdefault(row["rule_key"], []).append(row)
+            for rows in groups.values():
+                ids = [row["id"] for row in rows]
+                result = apply_actions(service, [row["email_id"] for row in rows], rows[0]["actions"])
+                output.append(result)
+                # A group fits in one batchModify call, so it either all worked or all failed.
+                errors = [line for line in result.splitlines() if line.startswith("Error")]
+                storage.finish_actions(ids, errors[0] if errors else None)
+                if not errors:
+                    done += len(ids)
+    except Exception as e:
+        output.append(f"Error processing queued actions: {e}")
+    output.append(f"Queued actions done: {done}.")
+    return "\n".join(line for line in output if line)
+
+@profiled("fetch_and_store_emails")
+def fetch_and_store_emails(message_count="10", force_refresh=False):
     """
     Log in to Gmail, grab emails (either a set number or using a query like 'newer_than:7d'),
-    get details for each email, and save them into our MySQL database.
+    get details for each email, and save them into our database.
+
+    Emails that are already stored (and were fetched within config.REFRESH_AFTER_DAYS)
+    are skipped without calling get_email, and emails downloaded by an earlier run
+    that never made it into the database come from the local message cache (see
+    message_cache.py), as long as Gmail's history shows they haven't changed since.
+    Pass force_refresh=True to fetch everything from Gmail again.
+    With config.THREAD_MODE on, conversations with several new messages are
+    downloaded whole with one threads.get call instead of one call per message.
 
     Returns a summary string of what happened during the process.
     """
-    from gmail_api import list_emails, get_email
-    from mysql_db import insert_email_mysql
+    from gmail_api import iter_email_pages, get_email, get_thread, changed_messages
     
     try:
         service = authenticate_gmail()
     except Exception as e:
         return f"Error authenticating with Gmail: {e}"
     
-    messages = list_emails(service, message_count)
-    if not messages:
+    output = []
+    listed = 0
+    skipped = 0
+    cached = 0
+    max_age = None if config.REFRESH_AFTER_DAYS is None else config.REFRESH_AFTER_DAYS * SECONDS_PER_DAY
+    # Pages stream in while we work (the next one is fetched in the background),
+    # and each page is stored before moving on, so rows land right away.
+    for page in iter_email_pages(service, message_count):
+        listed += len(page)
+        known_ids = set() if force_refresh else find_stored_ids([msg["id"] for msg in page])
+        pending = []
+        downloads = []
+        hits = []
+        for msg in page:
+            if msg["id"] in known_ids:
+                skipped += 1
+                continue
+            email = None if force_refresh else message_cache.load_email(msg["id"], max_age)
+            if email is not None and email.get("history_id"):
+                hits.append((msg, email))
+                continue
+            downloads.append(msg)
+        # Cached copies are only used if nothing happened to them in Gmail since they were cached.
+        if hits:
+            oldest = min(int(email["history_id"]) for msg, email in hits)
+            changed = changed_messages(service, oldest)
+            for msg, email in hits:
+                if changed is None or msg["id"] in changed:
+                    downloads.append(msg)
+                else:
+                    cached += 1
+                    pending.append(email)
+        # In thread mode, a conversation with several new messages comes down in one threads.get call.
+        thread_sizes = Counter(msg.get("threadId") for msg in downloads) if config.THREAD_MODE else Counter()
+        fetched_threads = set()
+        for msg in downloads:
+            thread_id = msg.get("threadId")
+            try:
+                if thread_id and thread_sizes[thread_id] > 1:
+                    if thread_id in fetched_threads:
+                        continue
+                    fetched_threads.add(thread_id)
+                    emails = get_thread(service, thread_id)
+                else:
+                    emails = [get_email(service, msg["id"])]
+            except Exception as e:
+                output.append(f"Error processing message {msg['id']}: {e}")
+                continue
+            for email in emails:
+                message_cache.save_email(email)
+                pending.append(email)
+        if pending:
+            output.extend(store_emails(pending))
+    if not listed:
         return "No messages found."
-    
+    if skipped:
+        output.append(f"Skipped {skipped} emails that are already stored.")
+    if cached:
+        output.append(f"Read {cached} emails from the local message cache instead of Gmail.")
+    return "\n".join(output)
+
+def find_stored_ids(email_ids):
+    """
+    Find which of these Gmail IDs are already stored and still fresh, in one query.
+
+    If the database can't be checked, nothing counts as stored, so every email
+    just gets fetched again.
+    """
+    fetched_since = None
+    if config.REFRESH_AFTER_DAYS is not None:
+        fetched_since = int(time.time()) - config.REFRESH_AFTER_DAYS * SECONDS_PER_DAY
+    try:
+        return storage.known_email_ids(email_ids, fetched_since)
+    except Exception:
+        return set()
+
+def store_emails(emails):
+    """
+    Save a batch of fetched emails with one bulk upsert.
+
+    Emails received before the config.RETENTION_DAYS window are left out; the next
+    retention run would only move them out again.
+
+    Returns a list of output lines: one per stored email, or the error message.
+    """
     output = []
-    for msg in messages:
-        try:
-            email_data = get_email(service, msg["id"])
-            result = insert_email_mysql(email_data)
-            output.append(result)
-        except Exception as e:
-            output.append(f"Error processing message {msg['id']}: {e}")
-    return "\n".join(output)
\ No newline at end of file
+    if config.RETENTION_DAYS is not None:
+        cutoff = time.time() - config.RETENTION_DAYS * SECONDS_PER_DAY
+        recent = [email for email in emails
+                  if email.get("received_date") is None or email["received_date"].timestamp() >= cutoff]
+        if len(recent) < len(emails):
+            output.append(f"Skipped {len(emails) - len(recent)} emails older than {config.RETENTION_DAYS} days.")
+        emails = recent
+    if not emails:
+        return output
+    result = storage.upsert_emails(emails)
+    if result.startswith("Error"):
+        return [result]
+    return [f"Stored email {email['email_id']}" for email in emails] + output
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+scheduler.py
+
+Syncs several Gmail accounts at once: for each account it fetches new emails
+and then applies the rules, each account with its own token and its own rows
+in the database (see accounts.py).
+
+Limits are global, not per account:
+- At most config.SYNC_WORKERS accounts run at the same time; the rest wait
+  their turn in the order given, so every account gets the same share.
+- The config.RULE_WORKERS processes for rule matching are split between the
+  accounts that run at the same time, so adding accounts never adds CPU load.
+- Each running account holds at most one database connection and two Gmail
+  connections (one for listing pages ahead, one for everything else).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import config
+from accounts import check_account, using_account
+from profiling import profiled
+from rules_engine import fetch_and_store_emails, process_email_rules
+from retention import run_retention
+
+def sync_account(account, message_count="10", apply_rules=True, rule_workers=1):
+    """
+    Fetch and (optionally) apply the rules for one account. With config.RETENTION_DAYS
+    set, old and deleted emails are archived in between (see retention.py).
+
+    Returns a string with what happened, each line tagged with the account.
+    """
+    output = []
+    try:
+        with using_account(account):
+            output.append(fetch_and_store_emails(message_count))
+            if config.RETENTION_DAYS is not None:
+                output.append(run_retention())
+            if apply_rules:
+                output.append(process_email_rules(workers=rule_workers))
+    except Exception as e:
+        output.append(f"Error syncing account {account}: {e}")
+    return "\n".join(f"[{account}] {line}" for line in "\n".join(output).splitlines())
+
+@profiled("sync_accounts")
+def sync_accounts(accounts, message_count="10", apply_rules=True, workers=None):
+    """
+    Sync a list of accounts, running up to `workers` (default config.SYNC_WORKERS)
+    of them at the same time.
+
+    Returns the accounts' results in the order the accounts were given.
+    """
+    accounts = [check_account(account.strip()) for account in accounts if account.strip()]
+    if not accounts:
+        return "No accounts to sync."
+    running = max(1, min(workers or config.SYNC_WORKERS, len(accounts)))
+    rule_workers = max(1, config.RULE_WORKERS // running)
+    with ThreadPoolExecutor(max_workers=running) as executor:
+        futures = [executor.submit(sync_account, account, message_count, apply_rules, rule_workers)
+                   for account in accounts]
+        return "\n".join(future.result() for future in futures)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+snapshot.py
+
+Try out a ruleset offline, without touching the database or Gmail:
+- export_snapshot() writes the stored emails to an Arrow IPC file, a columnar
+  format that can be memory-mapped straight back in.
+- simulate() checks a rules file against that snapshot and reports how many
+  emails would match and how many pass each condition, so you can see which
+  conditions do the filtering before running the rules for real.
+
+Conditions are checked a whole column at a time with Arrow's compute functions
+(no Python loop per email), so millions of rows take seconds. The results
+match evaluate_email for the fields the Rule Editor offers; Message Body isn't
+in snapshots, so it's treated as empty, like an email whose body can't be loaded.
+
+Needs the optional `pyarrow` package (pip install pyarrow).
+"""
+
+import time
+import config
+import storage
+from rules_engine import (load_rules, compile_ruleset, condition_value, match_text, BODY_FIELDS, DATE_PREDICATES,
+                          NORMALIZED_FIELDS, TEXT_PREDICATES)
+from patterns import PATTERN_PREDICATES, pattern_matches
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # Optional; only needed for snapshots
+    pa = pc = None
+
+# Email dict keys written to snapshots.
+SNAPSHOT_COLUMNS = ["id", "email_id", "account", "from", "to", "subject", "message", "received_ts",
+                    "subject_norm", "message_norm", "from_norm", "to_norm", "from_email", "from_domain"]
+INTEGER_COLUMNS = ["id", "received_ts"]
+MISSING_PYARROW = "Error: snapshots need the pyarrow package (pip install pyarrow)."
+
+def snapshot_schema():
+    return pa.schema([(name, pa.int64() if name in INTEGER_COLUMNS else pa.string())
+                      for name in SNAPSHOT_COLUMNS])
+
+def export_snapshot(path, filters=None):
+    """
+    Write the stored emails (optionally filtered, see storage.build_where) to an
+    Arrow IPC file at `path`, a batch of config.DB_BATCH_SIZE rows at a time.
+
+    Returns a string saying how many emails were written, or an error message.
+    """
+    if pa is None:
+        return MISSING_PYARROW
+    schema = snapshot_schema()
+    count = 0
+    try:
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+            batch = []
+            for email in storage.stream_emails(filters):
+                batch.append(email)
+                if len(batch) >= config.DB_BATCH_SIZE:
+                    writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                count += len(batch)
+    except Exception as e:
+        return f"Error exporting snapshot: {e}"
+    return f"Exported {count} emails to {path}."
+
+def load_snapshot(path):
+    """Memory-map a snapshot file and return it as an Arrow table (no copy is made)."""
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+def text_mask(column, predicate, value_norm, sender=None):
+    """Vectorized match_text: which rows of a case-folded string column pass."""
+    column = column.fill_null("")
+    if predicate in PATTERN_PREDICATES:
+        # Arrow's regexes are RE2, which doesn't quite match Python's, so patterns are checked row by row.
+        return pa.array([pattern_matches(predicate, value_norm, text) for text in column.to_pylist()])
+    if predicate in ("contains", "does not contain"):
+        mask = pc.match_substring(column, value_norm)
+        return mask if predicate == "contains" else pc.invert(mask)
+    mask = pc.equal(column, value_norm)
+    if sender is not None:
+        mask = pc.or_(mask, pc.equal(sender.fill_null(""), value_norm))
+    return mask if predicate == "equals" else pc.invert(mask)
+
+def condition_mask(table, condition):
+    """
+    Which rows of a snapshot pass one condition of a compiled ruleset, as a boolean array.
+    Matches evaluate_email/match_condition, including their handling of missing values.
+    """
+    field = condition.get("field", "").lower()
+    predicate = condition.get("predicate", "").lower()
+    value_norm = condition["value_norm"] if "value_norm" in condition else condition_value(condition)
+    if field in NORMALIZED_FIELDS and predicate in TEXT_PREDICATES:
+        sender = table["from_email"] if field == "from" else None
+        return text_mask(table[NORMALIZED_FIELDS[field][0]], predicate, value_norm, sender)
+    if "received" in field and field not in BODY_FIELDS:
+        cutoff = condition.get("cutoff")
+        if predicate not in DATE_PREDICATES or not cutoff:
+            return pa.repeat(False, table.num_rows)
+        compare = {">": pc.greater, "<": pc.less, "<=": pc.less_equal}[cutoff[0]]
+        return compare(table["received_ts"], cutoff[1]).fill_null(False)
+    # Fields that aren't in the snapshot (like Message Body) are empty text.
+    passes = match_text("", predicate, value_norm) if predicate in TEXT_PREDICATES else False
+    return pa.repeat(passes, table.num_rows)
+
+def simulate_rules(ruleset, table, now=None):
+    """
+    Check a ruleset against a snapshot table.
+
+    Returns a dict with:
+      - "total": number of emails in the snapshot.
+      - "matched_ids": email_id of every email the rules match.
+      - "conditions": (condition, number of emails passing it) for each condition.
+    """
+    ruleset = compile_ruleset(ruleset, now)
+    masks = [condition_mask(table, condition) for condition in ruleset.get("rules", [])]
+    if ruleset.get("match_policy", "All").lower() == "all":
+        combined = pa.repeat(True, table.num_rows)
+        for mask in masks:
+            combined = pc.and_(combined, mask)
+    else:
+        combined = pa.repeat(False, table.num_rows)
+        for mask in masks:
+            combined = pc.or_(combined, mask)
+    return {
+        "total": table.num_rows,
+        "matched_ids": table["email_id"].filter(combined).to_pylist(),
+        "conditions": [(condition, pc.sum(mask).as_py() or 0)
+                       for condition, mask in zip(ruleset.get("rules", []), masks)]
+    }
+
+def simulate(path, ruleset=None):
+    """
+    Simulate the rules file (or the given ruleset) against a snapshot file.
+
+    Returns a report string: match count and each condition's selectivity (the
+    share of emails that pass it), or an error message.
+    """
+    if pa is None:
+        return MISSING_PYARROW
+    ruleset = ruleset or load_rules()
+    if not ruleset:
+        return "Missing or invalid rules.json file."
+    started = time.perf_counter()
+    try:
+        result = simulate_rules(ruleset, load_snapshot(path))
+    except Exception as e:
+        return f"Error simulating rules: {e}"
+    total = result["total"]
+    share = lambda count: f"{100 * count / total:.2f}%" if total else "n/a"
+    matched = len(result["matched_ids"])
+    output = [
+        f"Simulated rules on {total} emails from {path} in {time.perf_counter() - started:.2f}s.",
+        f"Would match {matched} emails ({share(matched)}), policy {ruleset.get('match_policy', 'All')}.",
+        "Conditions (emails passing each one):"
+    ]
+    for condition, count in result["conditions"]:
+        unit = f" {condition.get('unit', 'days')}" if condition.get("cutoff") else ""
+        output.append(f"  {condition.get('field')} {condition.get('predicate')} "
+                      f"\"{condition.get('value')}\"{unit}: {count} ({share(count)})")
+    return "\n".join(output)
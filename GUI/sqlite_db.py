@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+
+"""
+sqlite_db.py
+
+Embedded SQLite storage for single-user installs. It offers the same functions
+as the storage part of mysql_db.py, but keeps everything in one local file:
+- No database server to install or log in to.
+- No network round trip per query.
+- WAL journaling, so the GUI can read while a fetch thread is writing.
+
+Each thread gets its own long-lived connection, and all statements use "?"
+parameters so sqlite3's statement cache can reuse the prepared versions.
+"""
+
+import time
+import sqlite3
+import threading
+from datetime import datetime
+import config  # SQLITE_PATH lives here
+from normalize import NORMALIZED_COLUMNS, normalized_values
+from accounts import current_account
+
+PLACEHOLDER = "?"
+LIKE_ESCAPE = "ESCAPE '\\'"  # Backslash escapes % and _ in LIKE patterns (see storage.like_pattern)
+SELECT_COLUMNS = ("id, email_id, from_address, to_address, subject, received_date, snippet, received_ts, "
+                  + ", ".join(NORMALIZED_COLUMNS.values()) + ", account, thread_id")
+
+# Written columns, in the order email_row() returns them.
+INSERT_COLUMNS = ["email_id", "from_address", "to_address", "subject", "received_date", "snippet",
+                  "received_ts", "fetched_at", "account", *NORMALIZED_COLUMNS.values(), "thread_id"]
+UPSERT_QUERY = f"""
+    INSERT INTO emails ({', '.join(INSERT_COLUMNS)})
+    VALUES ({', '.join('?' * len(INSERT_COLUMNS))})
+    ON CONFLICT(account, email_id) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in INSERT_COLUMNS[1:])};
+"""
+_local = threading.local()
+
+# Columns added after the first release of the 'emails' table, as (name, statements).
+# upgrade_sqlite_schema() runs the statements only when the column is missing.
+SCHEMA_UPGRADES = [
+    # UTC epoch seconds of received_date, so date rules are integer range lookups.
+    ("received_ts", [
+        "ALTER TABLE emails ADD COLUMN received_ts INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_received_ts ON emails (received_ts)",
+        "UPDATE emails SET received_ts = CAST(strftime('%s', received_date) AS INTEGER) "
+        "WHERE received_date IS NOT NULL"
+    ]),
+    # UTC epoch seconds of the last time the row was written from Gmail (for refreshing stale rows).
+    ("fetched_at", ["ALTER TABLE emails ADD COLUMN fetched_at INTEGER"]),
+    # Case-folded copies of the matched fields plus the bare sender address/domain (see normalize.py).
+    # Existing rows are filled in by backfill_normalized_columns().
+    ("subject_norm", [
+        *[f"ALTER TABLE emails ADD COLUMN {column} TEXT" for column in NORMALIZED_COLUMNS.values()],
+        "CREATE INDEX IF NOT EXISTS idx_subject_norm ON emails (subject_norm)",
+        "CREATE INDEX IF NOT EXISTS idx_from_email ON emails (from_email)",
+        "CREATE INDEX IF NOT EXISTS idx_from_domain ON emails (from_domain)"
+    ]),
+    # Which Gmail account the email belongs to (see accounts.py); older rows belong to "default".
+    ("account", [
+        "ALTER TABLE emails ADD COLUMN account TEXT NOT NULL DEFAULT 'default'",
+        "CREATE INDEX IF NOT EXISTS idx_account ON emails (account, id)"
+    ]),
+    # Gmail conversation the email is part of (for config.THREAD_MODE).
+    ("thread_id", [
+        "ALTER TABLE emails ADD COLUMN thread_id TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_thread_id ON emails (thread_id)"
+    ]),
+]
+
+# Full-text index over the case-folded subject and snippet, the same text rules are
+# matched against. The trigram tokenizer matches any substring of 3+ characters, so
+# it can pre-filter "contains" rules safely. Triggers keep it in sync as emails are
+# inserted, updated or deleted.
+FULLTEXT_COLUMNS = {"subject_norm", "snippet_norm"}
+FULLTEXT_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+        subject_norm, snippet_norm, content='emails', content_rowid='id', tokenize='trigram'
+    );
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, subject_norm, snippet_norm) VALUES (new.id, new.subject_norm, new.snippet_norm);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject_norm, snippet_norm)
+        VALUES ('delete', old.id, old.subject_norm, old.snippet_norm);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject_norm, snippet_norm)
+        VALUES ('delete', old.id, old.subject_norm, old.snippet_norm);
+        INSERT INTO emails_fts (rowid, subject_norm, snippet_norm) VALUES (new.id, new.subject_norm, new.snippet_norm);
+    END;
+    """
+]
+# Drops an index built over the raw subject/snippet by older versions, so it can be rebuilt.
+FULLTEXT_DROP = [
+    "DROP TRIGGER IF EXISTS emails_fts_insert;",
+    "DROP TRIGGER IF EXISTS emails_fts_delete;",
+    "DROP TRIGGER IF EXISTS emails_fts_update;",
+    "DROP TABLE IF EXISTS emails_fts;"
+]
+
+# Outbox of rule actions waiting to be sent to Gmail (see rules_engine.process_action_queue).
+# One row per email per ruleset, so the same actions are never queued twice.
+ACTION_QUEUE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS pending_actions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email_id TEXT NOT NULL,
+        rule_key TEXT NOT NULL,
+        actions TEXT NOT NULL,
+        account TEXT NOT NULL DEFAULT 'default',
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_until INTEGER,
+        last_error TEXT,
+        finished_at INTEGER,
+        UNIQUE (account, email_id, rule_key)
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pending_status ON pending_actions (status, id);"
+]
+
+# Gmail message IDs are only unique within a mailbox, so emails are keyed by account too.
+ACCOUNT_KEY_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS uq_account_email ON emails (account, email_id);"
+
+# Lets the Browse Emails window page through one account's emails newest first (see page_emails).
+BROWSE_INDEX = "CREATE INDEX IF NOT EXISTS idx_account_received ON emails (account, received_ts, id);"
+
+# Compressed full message bodies, kept apart from 'emails' so scans over it stay small (see body_store.py).
+BODY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS email_bodies (
+        email_id TEXT NOT NULL,
+        codec TEXT NOT NULL,
+        body BLOB NOT NULL,
+        stored_at INTEGER,
+        account TEXT NOT NULL DEFAULT 'default',
+        PRIMARY KEY (account, email_id)
+    );
+"""
+# Bodies stored before they had an account belong to the account of their email.
+BODY_UPGRADE = [
+    "ALTER TABLE email_bodies ADD COLUMN account TEXT NOT NULL DEFAULT 'default'",
+    "UPDATE email_bodies SET account = COALESCE("
+    "(SELECT account FROM emails WHERE emails.email_id = email_bodies.email_id), 'default')"
+]
+
+# Emails moved out of 'emails' by retention.py: ones past the hot window (archived_at)
+# and ones deleted in Gmail (deleted_at, a tombstone). Same columns as INSERT_COLUMNS.
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS emails_archive (
+        email_id TEXT NOT NULL,
+        from_address TEXT,
+        to_address TEXT,
+        subject TEXT,
+        received_date TEXT,
+        snippet TEXT,
+        received_ts INTEGER,
+        fetched_at INTEGER,
+        account TEXT NOT NULL DEFAULT 'default',
+        subject_norm TEXT,
+        snippet_norm TEXT,
+        from_norm TEXT,
+        to_norm TEXT,
+        from_email TEXT,
+        from_domain TEXT,
+        thread_id TEXT,
+        archived_at INTEGER,
+        deleted_at INTEGER,
+        PRIMARY KEY (account, email_id)
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_archive_account ON emails_archive (account, received_ts);"
+]
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Get this thread's connection to the SQLite file, opening it on first use.
+
+    If config.SQLITE_PATH changed since the last call, the old connection is closed
+    and a new one is opened on the new file.
+    """
+    connection = getattr(_local, "connection", None)
+    if connection is not None and _local.path != config.SQLITE_PATH:
+        connection.close()
+        connection = None
+    if connection is None:
+        connection = sqlite3.connect(config.SQLITE_PATH, cached_statements=256)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        _local.connection = connection
+        _local.path = config.SQLITE_PATH
+    return connection
+
+def close_connection():
+    """Close this thread's connection (handy in tests and before deleting the file)."""
+    connection = getattr(_local, "connection", None)
+    if connection is not None:
+        connection.close()
+        _local.connection = None
+
+def row_to_email(row) -> dict:
+    """Turn a row selected with SELECT_COLUMNS into the email dict the rules engine uses."""
+    return {
+        "id": row[0],
+        "email_id": row[1],
+        "from": row[2],
+        "to": row[3],
+        "subject": row[4],
+        "received_date": datetime.fromisoformat(row[5]) if row[5] else None,
+        "message": row[6],
+        "received_ts": row[7],
+        **dict(zip(NORMALIZED_COLUMNS, row[8:14])),
+        "account": row[14],
+        "thread_id": row[15]
+    }
+
+def email_row(email_data: dict, fetched_at: int) -> tuple:
+    """The values for UPSERT_QUERY from an email dict, including its normalized columns."""
+    received_date = email_data.get("received_date")
+    return (
+        email_data["email_id"],
+        email_data.get("from", ""),
+        email_data.get("to", ""),
+        email_data.get("subject", ""),
+        received_date.isoformat() if received_date else None,
+        email_data.get("message", ""),
+        int(received_date.timestamp()) if received_date else None,
+        fetched_at,
+        email_data.get("account") or current_account(),
+        *normalized_values(email_data),
+        email_data.get("thread_id")
+    )
+
+def create_schema() -> str:
+    """
+    Set up the 'emails' table in the SQLite file if it's not there yet.
+
+    Returns:
+        str: A message saying the table is set up or an error message if something went wrong.
+    """
+    try:
+        connection = get_connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS emails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email_id TEXT,
+                from_address TEXT,
+                to_address TEXT,
+                subject TEXT,
+                received_date TEXT,
+                snippet TEXT
+            );
+        """)
+        upgrade_sqlite_schema(connection)
+        connection.execute(BROWSE_INDEX)
+        create_fulltext_index(connection)
+        for statement in ACTION_QUEUE_SCHEMA:
+            connection.execute(statement)
+        connection.execute(BODY_SCHEMA)
+        for statement in ARCHIVE_SCHEMA:
+            connection.execute(statement)
+        queue_columns = {row[1] for row in connection.execute("PRAGMA table_info(pending_actions);")}
+        if "account" not in queue_columns:
+            connection.execute("ALTER TABLE pending_actions ADD COLUMN account TEXT NOT NULL DEFAULT 'default'")
+        if "finished_at" not in queue_columns:
+            connection.execute("ALTER TABLE pending_actions ADD COLUMN finished_at INTEGER")
+        if "account" not in {row[1] for row in connection.execute("PRAGMA table_info(email_bodies);")}:
+            for statement in BODY_UPGRADE:
+                connection.execute(statement)
+        connection.commit()
+        rekey_by_account(connection)
+        connection.execute(ACCOUNT_KEY_INDEX)
+        connection.commit()
+        return f"SQLite table 'emails' is ready in {config.SQLITE_PATH}."
+    except sqlite3.Error as e:
+        return f"Error creating SQLite table: {e}"
+
+def upgrade_sqlite_schema(connection):
+    """Add any columns from SCHEMA_UPGRADES that the 'emails' table is missing."""
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(emails);")}
+    for name, statements in SCHEMA_UPGRADES:
+        if name not in columns:
+            for statement in statements:
+                connection.execute(statement)
+    backfill_normalized_columns(connection)
+
+def rekey_by_account(connection):
+    """
+    Rebuild tables from before keys included the account (an email_id, or
+    email_id + rule_key, unique on its own), so two accounts can store the same ID.
+
+    SQLite can't change a table's constraints in place, so each one is copied
+    into a new table with the current definition, keeping its indexes and triggers.
+    """
+    new_definitions = {
+        "emails": None,  # Same columns as before, minus the UNIQUE on email_id
+        "emails_archive": ARCHIVE_SCHEMA[0],
+        "pending_actions": ACTION_QUEUE_SCHEMA[0],
+        "email_bodies": BODY_SCHEMA
+    }
+    for table, definition in new_definitions.items():
+        if not unique_without_account(connection, table):
+            continue
+        if definition is None:
+            definition = connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;", (table,)
+            ).fetchone()[0].replace("email_id TEXT UNIQUE", "email_id TEXT")
+        extras = [row[0] for row in connection.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL;",
+            (table,)
+        )]
+        columns = ", ".join(row[1] for row in connection.execute(f"PRAGMA table_info({table});"))
+        try:
+            connection.execute("BEGIN;")
+            connection.execute(f"ALTER TABLE {table} RENAME TO {table}_old;")
+            connection.execute(definition)
+            connection.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_old;")
+            connection.execute(f"DROP TABLE {table}_old;")
+            for statement in extras:
+                connection.execute(statement)
+            connection.commit()
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+
+def unique_without_account(connection, table):
+    """Check if a table has a UNIQUE/PRIMARY KEY constraint that leaves out the account column."""
+    for index in connection.execute(f"PRAGMA index_list({table});").fetchall():
+        _, name, unique, origin = index[:4]
+        columns = [row[2] for row in connection.execute(f"PRAGMA index_info({name});")]
+        if unique and origin in ("u", "pk") and "account" not in columns:
+            return True
+    return False
+
+def backfill_normalized_columns(connection):
+    """Fill in the normalized columns for rows stored before they existed."""
+    rows = connection.execute(
+        "SELECT id, from_address, to_address, subject, snippet FROM emails WHERE subject_norm IS NULL;"
+    ).fetchall()
+    if rows:
+        assignments = ", ".join(f"{column} = ?" for column in NORMALIZED_COLUMNS.values())
+        connection.executemany(f"UPDATE emails SET {assignments} WHERE id = ?;", [
+            (*normalized_values({"from": row[1], "to": row[2], "subject": row[3], "message": row[4]}), row[0])
+            for row in rows
+        ])
+
+def create_fulltext_index(connection):
+    """
+    Create the emails_fts index (and fill it from existing rows) if it's missing
+    or still over the raw columns.
+
+    Builds of SQLite without FTS5 or the trigram tokenizer just skip it; searches
+    then fall back to scanning rows in Python.
+    """
+    if fulltext_columns():
+        return
+    try:
+        for statement in FULLTEXT_DROP + FULLTEXT_SCHEMA:
+            connection.execute(statement)
+        connection.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild');")
+    except sqlite3.OperationalError:
+        connection.rollback()
+
+def fulltext_columns() -> set:
+    """Columns we can search through the full-text index (empty if there isn't one)."""
+    columns = {row[1] for row in get_connection().execute("PRAGMA table_info(emails_fts);")}
+    return columns & FULLTEXT_COLUMNS
+
+def fulltext_condition(column: str) -> str:
+    """SQL condition that looks up `column` through the full-text index."""
+    return f"id IN (SELECT rowid FROM emails_fts WHERE {column} MATCH ?)"
+
+def fulltext_query(text: str) -> str:
+    """Search string for fulltext_condition(): the text as one quoted phrase."""
+    return '"' + text.replace('"', '""') + '"'
+
+def upsert_emails(emails: list) -> str:
+    """
+    Insert or update a batch of emails in one transaction.
+
+    Args:
+        emails (list): Email dicts as returned by gmail_api.get_email.
+
+    Returns:
+        str: How many emails were stored, or an error message.
+    """
+    fetched_at = int(time.time())
+    try:
+        connection = get_connection()
+        with connection:
+            connection.executemany(UPSERT_QUERY, [email_row(email_data, fetched_at) for email_data in emails])
+        return f"Stored {len(emails)} emails."
+    except sqlite3.Error as e:
+        return f"Error inserting emails: {e}"
+
+def stream_emails(where: str = "", params: tuple = (), batch_size: int = 1000):
+    """
+    Yield stored emails one at a time, reading them in id order a batch at a time.
+
+    Args:
+        where (str): Optional SQL condition (using ? placeholders) to filter rows.
+        params (tuple): Values for the placeholders in `where`.
+        batch_size (int): Rows fetched per query.
+
+    Raises:
+        sqlite3.Error: If the database can't be read.
+    """
+    connection = get_connection()
+    filter_sql = f" AND ({where})" if where else ""
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            f"SELECT {SELECT_COLUMNS} FROM emails WHERE id > ?{filter_sql} ORDER BY id LIMIT ?;",
+            (last_id, *params, batch_size)
+        ).fetchall()
+        for row in rows:
+            yield row_to_email(row)
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1][0]
+
+def page_emails(where: str = "", params: tuple = (), limit: int = 200, newest_first: bool = True) -> list:
+    """
+    Return up to `limit` stored emails matching a SQL condition, ordered by
+    (received_ts, id), newest first unless newest_first is False.
+
+    Raises:
+        sqlite3.Error: If the database can't be read.
+    """
+    order = "DESC" if newest_first else "ASC"
+    rows = get_connection().execute(
+        f"SELECT {SELECT_COLUMNS} FROM emails{' WHERE ' + where if where else ''} "
+        f"ORDER BY received_ts {order}, id {order} LIMIT ?;", (*params, limit)
+    ).fetchall()
+    return [row_to_email(row) for row in rows]
+
+def id_bounds(where: str = "", params: tuple = ()) -> tuple:
+    """
+    Return the smallest and largest id of the stored emails matching a SQL condition.
+
+    Returns:
+        tuple: (min_id, max_id), or (None, None) if nothing matches.
+    """
+    return tuple(get_connection().execute(
+        f"SELECT MIN(id), MAX(id) FROM emails{' WHERE ' + where if where else ''};", params
+    ).fetchone())
+
+def select_email_ids(where: str = "", params: tuple = (), archived: bool = False) -> set:
+    """
+    Return just the email_id of every stored email matching an optional SQL condition.
+    With `archived`, look in emails_archive instead.
+
+    Raises:
+        sqlite3.Error: If the database can't be read.
+    """
+    table = "emails_archive" if archived else "emails"
+    rows = get_connection().execute(
+        f"SELECT email_id FROM {table}{' WHERE ' + where if where else ''};", params
+    ).fetchall()
+    return {row[0] for row in rows}
+
+def select_emails(where: str = "", params: tuple = ()):
+    """
+    Return every stored email matching an optional SQL condition.
+
+    Returns:
+        list: Email dicts, or a string error message if something goes wrong.
+    """
+    try:
+        return list(stream_emails(where, params))
+    except sqlite3.Error as e:
+        return f"Error fetching emails: {e}"
+
+def enqueue_actions(email_ids: list, rule_key: str, actions: str, account: str = "default",
+                    requeue: bool = False) -> int:
+    """
+    Queue a ruleset's actions for some emails, skipping emails already queued for it.
+
+    Args:
+        email_ids (list): Gmail message IDs that matched.
+        rule_key (str): Identifies the ruleset (see rules_engine.ruleset_hash).
+        actions (str): The ruleset's actions as JSON.
+        account (str): The Gmail account the emails belong to.
+        requeue (bool): Also put rows that are already 'done' or 'failed' back in the queue.
+
+    Returns:
+        int: How many rows were queued (new or put back).
+
+    Raises:
+        sqlite3.Error: If the queue can't be written.
+    """
+    connection = get_connection()
+    with connection:
+        before = connection.total_changes
+        if requeue:
+            connection.executemany(REQUEUE_QUERY, [(actions, account, email_id, rule_key) for email_id in email_ids])
+        connection.executemany(
+            "INSERT INTO pending_actions (email_id, rule_key, actions, account) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(account, email_id, rule_key) DO NOTHING;",
+            [(email_id, rule_key, actions, account) for email_id in email_ids]
+        )
+        return connection.total_changes - before
+
+# Puts a finished row back in the queue as if it were new (for full runs).
+REQUEUE_QUERY = """
+    UPDATE pending_actions SET status = 'pending', attempts = 0, claimed_until = NULL, last_error = NULL,
+        finished_at = NULL, actions = ?
+    WHERE account = ? AND email_id = ? AND rule_key = ? AND status IN ('done', 'failed');
+"""
+
+# Claims that ran out on their last allowed attempt: the worker died, and there are no retries left.
+EXPIRE_CLAIMS_QUERY = """
+    UPDATE pending_actions SET status = 'failed', claimed_until = NULL,
+        last_error = COALESCE(last_error, 'The worker stopped before finishing (lease expired).')
+    WHERE status = 'claimed' AND claimed_until < ? AND attempts >= ? AND account = ?;
+"""
+
+def claim_actions(limit: int, lease_seconds: int, max_attempts: int, account: str = "default") -> list:
+    """
+    Claim up to `limit` of an account's queued actions for this worker.
+
+    Rows are pending ones, or claimed ones whose lease ran out (their worker died).
+    Rows whose lease ran out after their last allowed attempt are marked 'failed'.
+    BEGIN IMMEDIATE takes SQLite's write lock before reading, so two workers can
+    never claim the same row. The claim commits on its own, so it refuses to run
+    inside a transaction the caller has open on this thread's connection.
+
+    Returns:
+        list: (row id, email_id, rule_key, actions JSON) tuples.
+
+    Raises:
+        sqlite3.Error: If the queue can't be read, or a transaction is already open.
+    """
+    connection = get_connection()
+    now = int(time.time())
+    if connection.in_transaction:
+        raise sqlite3.ProgrammingError("Can't claim actions inside an open transaction; commit or roll it back first.")
+    connection.execute("BEGIN IMMEDIATE;")
+    try:
+        connection.execute(EXPIRE_CLAIMS_QUERY, (now, max_attempts, account))
+        rows = connection.execute("""
+            SELECT id, email_id, rule_key, actions FROM pending_actions
+            WHERE (status = 'pending' OR (status = 'claimed' AND claimed_until < ?)) AND attempts < ?
+                AND account = ?
+            ORDER BY id LIMIT ?;
+        """, (now, max_attempts, account, limit)).fetchall()
+        if rows:
+            ids = [row[0] for row in rows]
+            connection.execute(
+                f"UPDATE pending_actions SET status = 'claimed', claimed_until = ?, attempts = attempts + 1 "
+                f"WHERE id IN ({', '.join('?' * len(ids))});",
+                (now + lease_seconds, *ids)
+            )
+        connection.commit()
+    except sqlite3.Error:
+        connection.rollback()
+        raise
+    return rows
+
+def finish_actions(ids: list, error: str = None, max_attempts: int = 5, keep_done_seconds: int = 0):
+    """
+    Record how claimed actions went: done, or back in the queue with the error
+    (or 'failed' for good once they've used up max_attempts).
+
+    'done' rows are kept for `keep_done_seconds` (so later runs don't queue the
+    same actions again), then deleted.
+
+    Raises:
+        sqlite3.Error: If the queue can't be written.
+    """
+    if not ids:
+        return
+    connection = get_connection()
+    marks = ", ".join("?" * len(ids))
+    now = int(time.time())
+    with connection:
+        if error is None:
+            connection.execute(
+                f"UPDATE pending_actions SET status = 'done', claimed_until = NULL, last_error = NULL, "
+                f"finished_at = ? WHERE id IN ({marks});", (now, *ids)
+            )
+            connection.execute(PRUNE_DONE_QUERY, (now - keep_done_seconds,))
+        else:
+            connection.execute(
+                f"UPDATE pending_actions SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                f"claimed_until = NULL, last_error = ? WHERE id IN ({marks});",
+                (max_attempts, error, *ids)
+            )
+
+# Done rows past their keep time (rows from before finished_at count as old).
+PRUNE_DONE_QUERY = "DELETE FROM pending_actions WHERE status = 'done' AND (finished_at IS NULL OR finished_at < ?);"
+
+def load_body(email_id: str, account: str):
+    """
+    Return the stored (codec, compressed body) of an account's email, or None if there isn't one.
+
+    Raises:
+        sqlite3.Error: If the database can't be read.
+    """
+    row = get_connection().execute(
+        "SELECT codec, body FROM email_bodies WHERE account = ? AND email_id = ?;", (account, email_id)
+    ).fetchone()
+    return (row[0], bytes(row[1])) if row else None
+
+def save_body(email_id: str, codec: str, body: bytes, account: str):
+    """
+    Store (or replace) the compressed body of an account's email.
+
+    Raises:
+        sqlite3.Error: If the database can't be written.
+    """
+    connection = get_connection()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO email_bodies (email_id, codec, body, stored_at, account) VALUES (?, ?, ?, ?, ?);",
+            (email_id, codec, body, int(time.time()), account)
+        )
+
+def archive_emails(where: str, params: tuple = (), deleted_at: int = None) -> int:
+    """
+    Move the stored emails matching an SQL condition into emails_archive, in one transaction.
+
+    Their bodies are dropped too (they can be downloaded again). Pass `deleted_at`
+    to tombstone emails that were deleted in Gmail; matching emails that were
+    already archived get it too.
+
+    Returns:
+        int: How many emails were moved (plus, with `deleted_at`, archived ones tombstoned).
+
+    Raises:
+        sqlite3.Error: If the database can't be written.
+    """
+    columns = ", ".join(INSERT_COLUMNS)
+    connection = get_connection()
+    with connection:
+        tombstoned = 0
+        if deleted_at is not None:
+            tombstoned = connection.execute(
+                f"UPDATE emails_archive SET deleted_at = ? WHERE deleted_at IS NULL AND ({where});",
+                (deleted_at, *params)
+            ).rowcount
+        connection.execute(
+            f"INSERT OR REPLACE INTO emails_archive ({columns}, archived_at, deleted_at) "
+            f"SELECT {columns}, ?, ? FROM emails WHERE {where};",
+            (int(time.time()), deleted_at, *params)
+        )
+        return tombstoned + delete_rows(connection, where, params)
+
+def delete_emails(where: str, params: tuple = ()) -> int:
+    """
+    Delete the stored emails (and bodies) matching an SQL condition, e.g. after exporting them.
+
+    Returns:
+        int: How many emails were deleted.
+
+    Raises:
+        sqlite3.Error: If the database can't be written.
+    """
+    connection = get_connection()
+    with connection:
+        return delete_rows(connection, where, params)
+
+def delete_rows(connection, where, params):
+    connection.execute(f"DELETE FROM email_bodies WHERE (account, email_id) IN "
+                       f"(SELECT account, email_id FROM emails WHERE {where});", params)
+    return connection.execute(f"DELETE FROM emails WHERE {where};", params).rowcount
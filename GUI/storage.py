@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+storage.py
+
+One small interface over the places we can keep emails:
+- "mysql": the original MySQL server setup (mysql_db.py).
+- "sqlite": an embedded SQLite file (sqlite_db.py) for single-user installs,
+  with no server to run and no network hop per query.
+
+Pick one with config.DB_BACKEND. The rules engine and the GUI talk to this
+module instead of a specific database. Each backend module provides the same
+functions: create_schema, upsert_emails, stream_emails, page_emails and select_emails, plus
+fulltext_columns/fulltext_condition/fulltext_query for its full-text index,
+enqueue_actions/claim_actions/finish_actions for the pending_actions outbox,
+and load_body/save_body for the compressed message bodies.
+
+Backend modules are imported on first use, so the MySQL client library is
+only loaded by installs that actually use MySQL.
+"""
+
+import json
+import importlib
+import config
+from accounts import current_account
+
+# Backend name -> module that implements it.
+BACKENDS = {
+    "mysql": "mysql_db",
+    "sqlite": "sqlite_db"
+}
+
+# Columns and operators allowed in filters, so filter tuples can't inject SQL.
+FILTER_COLUMNS = ["id", "email_id", "from_address", "to_address", "subject", "received_date", "snippet",
+                  "received_ts", "fetched_at", "subject_norm", "snippet_norm", "from_norm", "to_norm",
+                  "from_email", "from_domain", "account", "thread_id"]
+FILTER_OPERATORS = ["=", "!=", "<", "<=", ">", ">=", "like", "not like", "in", "match", "is null", "is not null"]
+SECONDS_PER_DAY = 86400
+
+def get_backend():
+    """Return the backend module picked in config.DB_BACKEND (importing it the first time)."""
+    module_name = BACKENDS.get(config.DB_BACKEND.lower())
+    if module_name is None:
+        raise ValueError(
+            f"Unknown storage backend '{config.DB_BACKEND}'. Choose one of: {', '.join(BACKENDS)}."
+        )
+    return importlib.import_module(module_name)
+
+def build_where(filters, backend):
+    """
+    Turn a list of (column, operator, value) filters into a SQL condition.
+
+    All filters are ANDed together. For the "in" operator, value should be a list.
+    The "match" operator searches the backend's full-text index for rows whose
+    column contains value (check fulltext_columns() before using it).
+    "is null" and "is not null" ignore the value. "like" and "not like" treat a
+    backslash as the escape character (see like_pattern).
+    A list in place of a filter is an OR group: a list of filter lists, where a row
+    passes if it passes every filter of at least one of them.
+
+    Returns:
+        tuple: (where_sql, params) ready to hand to a backend.
+    """
+    placeholder = backend.PLACEHOLDER
+    clauses = []
+    params = []
+    for item in filters or []:
+        if isinstance(item, list):
+            groups = [build_where(group, backend) for group in item]
+            clauses.append("(" + " OR ".join(f"({where or '1 = 1'})" for where, _ in groups) + ")")
+            params.extend(param for _, group_params in groups for param in group_params)
+            continue
+        column, operator, value = item
+        operator = operator.lower()
+        if column not in FILTER_COLUMNS or operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter: {column} {operator}")
+        if operator == "in":
+            values = list(value)
+            if not values:
+                clauses.append("1 = 0")  # Nothing can be in an empty list
+                continue
+            clauses.append(f"{column} IN ({', '.join([placeholder] * len(values))})")
+            params.extend(values)
+        elif operator == "match":
+            clauses.append(backend.fulltext_condition(column))
+            params.append(backend.fulltext_query(value))
+        elif operator in ("is null", "is not null"):
+            clauses.append(f"{column} {operator.upper()}")
+        elif operator in ("like", "not like"):
+            clauses.append(f"{column} {operator.upper()} {placeholder} {backend.LIKE_ESCAPE}")
+            params.append(value)
+        else:
+            clauses.append(f"{column} {operator.upper()} {placeholder}")
+            params.append(value)
+    return " AND ".join(clauses), tuple(params)
+
+def like_pattern(text):
+    """A "like" filter value for rows containing `text`, with any %, _ or backslash in it taken literally."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def create_schema() -> str:
+    """Create the tables for the configured backend. Returns a status message."""
+    return get_backend().create_schema()
+
+def upsert_emails(emails: list) -> str:
+    """Insert or update a batch of emails. Returns a status message."""
+    return get_backend().upsert_emails(emails)
+
+def fulltext_columns() -> set:
+    """Columns the configured backend can search with the "match" filter."""
+    return get_backend().fulltext_columns()
+
+def stream_emails(filters=None, batch_size=None):
+    """
+    Yield stored emails (optionally filtered) without loading them all at once.
+
+    Raises the backend's own error type if the database can't be read.
+    """
+    backend = get_backend()
+    where, params = build_where(filters, backend)
+    return backend.stream_emails(where, params, batch_size or config.DB_BATCH_SIZE)
+
+def page_key(email) -> tuple:
+    """Where an email sits in page_emails() order: (received_ts, id)."""
+    return email.get("received_ts"), email["id"]
+
+def keyset_filters(key, newer, dated):
+    """
+    Filters for the emails after (older than) or before (newer than, `newer`=True)
+    a page_key in page_emails() order, within one segment: the emails with a
+    received_ts (`dated`), or the ones without, which come last.
+
+    The dated ones get a range on received_ts plus a tie-break on id, which the
+    (account, received_ts, id) index can seek to. Returns None if nothing in the
+    segment can qualify.
+    """
+    segment = [("received_ts", "is not null" if dated else "is null", None)]
+    if key is None:
+        return segment
+    received_ts, row_id = key
+    if (received_ts is None) == dated:
+        # An undated key: every dated email is newer. A dated key: every undated email is older.
+        return segment if newer == dated else None
+    operator = ">" if newer else "<"
+    if not dated:
+        return segment + [("id", operator, row_id)]
+    return [("received_ts", operator + "=", received_ts),
+            [[("received_ts", operator, received_ts)], [("id", operator, row_id)]]]
+
+def page_emails(filters=None, after=None, before=None, limit=None) -> list:
+    """
+    One page of stored emails, newest first (by received_ts, then id; emails with
+    no received_ts come last).
+
+    Keyset pagination: pass the page_key of the last email shown as `after` for the
+    next (older) page, or of the first one as `before` for the previous (newer) page.
+    Each page is an indexed seek however deep into the table it is, unlike
+    LIMIT/OFFSET. Pages fetched with `before` still come back newest first.
+
+    Raises the backend's own error type if the database can't be read.
+    """
+    limit = limit or config.BROWSE_PAGE_SIZE
+    newer = before is not None
+    key = before if newer else after
+    backend = get_backend()
+    emails = []
+    for dated in ([False, True] if newer else [True, False]):
+        keyset = keyset_filters(key, newer, dated)
+        if keyset is None or len(emails) >= limit:
+            continue
+        where, params = build_where(list(filters or []) + keyset, backend)
+        emails.extend(backend.page_emails(where, params, limit - len(emails), newest_first=not newer))
+    return emails[::-1] if newer else emails
+
+def id_bounds(filters=None) -> tuple:
+    """
+    Smallest and largest primary key among the stored emails matching the filters.
+
+    Returns (None, None) if nothing matches; raises the backend's own error type
+    if the database can't be read.
+    """
+    backend = get_backend()
+    where, params = build_where(filters, backend)
+    return backend.id_bounds(where, params)
+
+def known_email_ids(email_ids, fetched_since=None) -> set:
+    """
+    Check which of the given Gmail IDs the current account already has stored
+    (one query per table).
+
+    Archived emails (see retention.py) count as stored too, however long ago they
+    were fetched, so a fetch never brings them back into the emails table.
+
+    Args:
+        email_ids (list): Gmail message IDs to look up.
+        fetched_since (int): If given, rows last fetched before this epoch time
+            count as stale and are left out, so they get fetched again.
+
+    Raises the backend's own error type if the database can't be read.
+    """
+    if not email_ids:
+        return set()
+    filters = [("account", "=", current_account()), ("email_id", "in", email_ids)]
+    backend = get_backend()
+    where, params = build_where(filters, backend)
+    archived = backend.select_email_ids(where, params, archived=True)
+    if fetched_since is not None:
+        where, params = build_where(filters + [("fetched_at", ">=", fetched_since)], backend)
+    return backend.select_email_ids(where, params) | archived
+
+def select_emails(filters=None):
+    """Return a list of stored emails matching the filters, or an error message string."""
+    backend = get_backend()
+    where, params = build_where(filters, backend)
+    return backend.select_emails(where, params)
+
+def enqueue_actions(email_ids: list, rule_key: str, actions: list, requeue: bool = False) -> int:
+    """
+    Queue a ruleset's actions for the given emails (of the current account) in the
+    pending_actions outbox.
+
+    Emails already queued for the same rule_key are skipped, including ones whose
+    actions were applied in the last config.ACTION_DONE_KEEP_DAYS, unless `requeue`
+    is set: then 'done' and 'failed' rows go back in the queue too. Returns how many
+    rows were queued; raises the backend's own error type on failure.
+    """
+    return get_backend().enqueue_actions(email_ids, rule_key, json.dumps(actions), current_account(), requeue)
+
+def claim_actions(limit: int) -> list:
+    """
+    Claim up to `limit` of the current account's queued actions so no other worker
+    picks them up.
+
+    Claims last config.ACTION_LEASE_SECONDS; rows left claimed longer than that
+    (e.g. by a worker that crashed) can be claimed again.
+
+    Returns a list of dicts with "id", "email_id", "rule_key" and "actions".
+    """
+    rows = get_backend().claim_actions(limit, config.ACTION_LEASE_SECONDS, config.ACTION_MAX_ATTEMPTS,
+                                       current_account())
+    return [{"id": row[0], "email_id": row[1], "rule_key": row[2], "actions": json.loads(row[3])}
+            for row in rows]
+
+def finish_actions(ids: list, error: str = None):
+    """
+    Mark claimed actions as done, or put them back in the queue with an error message.
+    Done rows older than config.ACTION_DONE_KEEP_DAYS are cleared out at the same time.
+    """
+    get_backend().finish_actions(ids, error, config.ACTION_MAX_ATTEMPTS,
+                                 config.ACTION_DONE_KEEP_DAYS * SECONDS_PER_DAY)
+
+def load_body(email_id: str):
+    """Return the current account's stored (codec, compressed body) of an email, or None; see body_store.py."""
+    return get_backend().load_body(email_id, current_account())
+
+def save_body(email_id: str, codec: str, body: bytes):
+    """Store an email's compressed body for the current account; see body_store.py."""
+    get_backend().save_body(email_id, codec, body, current_account())
+
+def archive_emails(filters, deleted_at=None) -> int:
+    """
+    Move the stored emails matching the filters into emails_archive (see retention.py).
+
+    With `deleted_at` (epoch seconds) they're tombstoned as deleted in Gmail.
+    Returns how many were moved; raises the backend's own error type on failure.
+    """
+    backend = get_backend()
+    where, params = build_where(filters, backend)
+    if not where:
+        raise ValueError("Refusing to archive every stored email; pass some filters.")
+    return backend.archive_emails(where, params, deleted_at)
+
+def delete_emails(filters) -> int:
+    """Delete the stored emails matching the filters (and their bodies). Returns how many were deleted."""
+    backend = get_backend()
+    where, params = build_where(filters, backend)
+    if not where:
+        raise ValueError("Refusing to delete every stored email; pass some filters.")
+    return backend.delete_emails(where, params)
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
+import time
+import random
 import unittest
-from datetime import datetime, timedelta
+import tempfile
+import sqlite3
+import subprocess
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch, MagicMock
 
 # Add the parent directory (GUI) to sys.path so our modules can be imported.
@@ -9,8 +14,24 @@ import sys, os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 # Import functions from our project modules
+import config
 import gmail_api
+import profiling
+import remote_rules
+import accounts
+import scheduler
+import retention
+import body_store
+import message_cache
+import patterns
+import snapshot
+import browser
+import base64
+import gzip
+import json
 import rules_engine
+import sqlite_db
+import storage
 
 # ----------------------- Unit Tests -----------------------
 class TestGmailAPI(unittest.TestCase):
@@ -27,6 +48,64 @@ class TestGmailAPI(unittest.TestCase):
         dt = gmail_api.parse_date(date_str)
         self.assertIsNone(dt)
 
+    def test_parse_date_common_variants(self):
+        expected = datetime(2022, 11, 15, 12, 45, 26, tzinfo=timezone.utc)
+        for date_str in ["Tue, 15 Nov 2022 12:45:26 +0000 (UTC)", "15 Nov 2022 12:45:26 GMT",
+                         "Tue, 15 Nov 2022 07:45:26 -0500"]:
+            self.assertEqual(gmail_api.parse_date(date_str), expected, date_str)
+
+    def test_get_email_prefers_internal_date(self):
+        service = MagicMock()
+        service.users.return_value.messages.return_value.get.return_value.execute.return_value = {
+            "internalDate": "1668516326000",
+            "payload": {"headers": [{"name": "Date", "value": "not a date"}]}
+        }
+        email = gmail_api.get_email(service, "1")
+        self.assertEqual(email["received_date"], datetime(2022, 11, 15, 12, 45, 26, tzinfo=timezone.utc))
+
+    def test_pooled_http_shares_one_adapter_across_threads(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from concurrent.futures import ThreadPoolExecutor
+        from google.oauth2.credentials import Credentials
+        from googleapiclient.discovery import build
+        sent = []
+        class FakeAdapter(HTTPAdapter):
+            def send(self, request, **kwargs):
+                sent.append((request, kwargs["timeout"]))
+                response = requests.Response()
+                response.status_code = 200
+                response.headers["Content-Type"] = "application/json"
+                response.headers["Content-Encoding"] = "gzip"
+                response.raw = MagicMock()
+                response._content = json.dumps({"id": request.url.split("/")[-1].split("?")[0]}).encode()
+                response.url = request.url
+                return response
+        with patch.object(gmail_api, "_adapter", FakeAdapter()):
+            service = build("gmail", "v1", http=gmail_api.PooledHttp(Credentials(token="token")))
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(
+                    lambda msg_id: service.users().messages().get(userId="me", id=msg_id).execute(), ["a", "b", "c"]))
+        self.assertEqual([r["id"] for r in results], ["a", "b", "c"])
+        self.assertEqual(len(sent), 3)
+        for request, timeout in sent:
+            self.assertEqual(request.headers["Authorization"], "Bearer token")
+            self.assertIn("gzip", request.headers["Accept-Encoding"])
+            self.assertEqual(timeout, (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT))
+
+    def test_iter_email_pages_streams_until_count(self):
+        service = MagicMock()
+        pages = [
+            {"messages": [{"id": "1"}, {"id": "2"}], "nextPageToken": "p2"},
+            {"messages": [{"id": "3"}, {"id": "4"}], "nextPageToken": "p3"},
+            {"messages": [{"id": "5"}]}
+        ]
+        service.users().messages().list().execute.side_effect = pages
+        result = list(gmail_api.iter_email_pages(service, "3"))
+        self.assertEqual(result, [[{"id": "1"}, {"id": "2"}], [{"id": "3"}]])
+        # We had enough after two pages, so the third was never requested.
+        self.assertEqual(service.users().messages().list().execute.call_count, 2)
+
 class TestRulesEngineUnit(unittest.TestCase):
     def test_match_condition_contains(self):
         # Check if the 'contains' condition works for text.
@@ -46,6 +125,76 @@ class TestRulesEngineUnit(unittest.TestCase):
         email_date = datetime.now() - timedelta(days=10)
         self.assertTrue(rules_engine.match_condition(email_date, condition))
     
+    def test_subtract_months_is_calendar_aware(self):
+        self.assertEqual(rules_engine.subtract_months(datetime(2024, 3, 31), 1), datetime(2024, 2, 29))
+        self.assertEqual(rules_engine.subtract_months(datetime(2024, 1, 15), 2), datetime(2023, 11, 15))
+
+    def test_compiled_date_cutoff_matches_whole_day_semantics(self):
+        # The precomputed cutoff must agree with "(now - received).days" for every offset.
+        now = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+        for predicate in ["less than", "greater than"]:
+            condition = {"field": "Received Date/Time", "predicate": predicate, "value": "7", "unit": "days"}
+            compiled = rules_engine.compile_ruleset({"rules": [condition]}, now)["rules"][0]
+            for hours in range(0, 24 * 10, 5):
+                received = now - timedelta(hours=hours)
+                days = (now - received).days
+                expected = days < 7 if predicate == "less than" else days > 7
+                self.assertEqual(rules_engine.match_condition(received, compiled), expected, (predicate, hours))
+                self.assertEqual(rules_engine.match_condition(int(received.timestamp()), compiled), expected)
+
+    def test_compiling_keeps_the_ruleset_hash(self):
+        ruleset = {"match_policy": "All", "rules": [
+            {"field": "Received Date/Time", "predicate": "less than", "value": "3"},
+            {"field": "Subject", "predicate": "contains", "value": "Hi"}
+        ], "actions": []}
+        self.assertEqual(rules_engine.ruleset_hash(rules_engine.compile_ruleset(ruleset)),
+                         rules_engine.ruleset_hash(ruleset))
+
+    def test_plan_actions_folds_into_one_delta(self):
+        plan = rules_engine.plan_actions([
+            {"action": "mark as read"},
+            {"action": "move message", "destination": "updates"}
+        ])
+        self.assertEqual(plan["addLabelIds"], ["CATEGORY_UPDATES"])
+        self.assertEqual(plan["removeLabelIds"], ["UNREAD", "INBOX"])
+
+    def test_plan_actions_later_action_wins(self):
+        plan = rules_engine.plan_actions([{"action": "mark as read"}, {"action": "mark as unread"}])
+        self.assertEqual(plan["addLabelIds"], ["UNREAD"])
+        self.assertEqual(plan["removeLabelIds"], [])
+
+    def test_apply_actions_batches_and_reports_savings(self):
+        service = MagicMock()
+        email_ids = [str(i) for i in range(3)]
+        with patch.object(config, "BATCH_MODIFY_SIZE", 2):
+            result = rules_engine.apply_actions(service, email_ids, [
+                {"action": "mark as read"},
+                {"action": "move message", "destination": "forum"}
+            ])
+        batch_modify = service.users().messages().batchModify
+        self.assertEqual(batch_modify.call_count, 2)
+        self.assertEqual(batch_modify.call_args_list[0].kwargs["body"]["ids"], ["0", "1"])
+        self.assertIn("Email 2 moved to CATEGORY_FORUMS.", result)
+        self.assertIn("with 2 Gmail API call(s) (4 saved)", result)
+
+    def test_custom_labels_resolve_through_one_cached_list_call(self):
+        gmail_api.clear_label_cache()
+        self.addCleanup(gmail_api.clear_label_cache)
+        service = MagicMock()
+        labels = service.users.return_value.labels.return_value
+        labels.list.return_value.execute.return_value = {"labels": [
+            {"id": "INBOX", "name": "INBOX"}, {"id": "Label_123", "name": "Receipts"}
+        ]}
+        labels.create.return_value.execute.return_value = {"id": "Label_456", "name": "Travel"}
+        result = rules_engine.apply_actions(service, ["1"], [{"action": "move message", "destination": "receipts"}])
+        self.assertEqual(service.users().messages().batchModify.call_args.kwargs["body"]["addLabelIds"], ["Label_123"])
+        self.assertIn("Email 1 moved to receipts.", result)
+        # A missing label is created once, then comes from the cache like the rest.
+        self.assertEqual(gmail_api.label_id(service, "Travel"), "Label_456")
+        self.assertEqual(gmail_api.label_id(service, "travel"), "Label_456")
+        self.assertEqual(labels.list.call_count, 1)
+        self.assertEqual(labels.create.call_count, 1)
+
     def test_evaluate_email_all(self):
         # Test evaluating an email when ALL conditions must match.
         email = {
@@ -81,20 +230,929 @@ class TestRulesEngineUnit(unittest.TestCase):
         # Since the subject contains "Email", at least one condition is met.
         self.assertTrue(rules_engine.evaluate_email(email, ruleset))
 
+    def test_regex_and_glob_predicates(self):
+        email = {"from": "GitHub <Noreply@GitHub.com>", "subject": "Invoice #1234 for March", "message": ""}
+        one_regex = {"match_policy": "Any", "rules": [
+            {"field": "Subject", "predicate": "matches regex", "value": r"(invoice|receipt) #\d+"}]}
+        many_conditions = {"match_policy": "Any", "rules": [
+            {"field": "Subject", "predicate": "contains", "value": f"{word} #{digit}"}
+            for word in ("invoice", "receipt") for digit in range(10)]}
+        for subject in ("Invoice #1234 for March", "RECEIPT #9", "Invoice #", "Lunch"):
+            email["subject"] = subject
+            self.assertEqual(rules_engine.evaluate_email(email, rules_engine.compile_ruleset(one_regex)),
+                             rules_engine.evaluate_email(email, many_conditions))
+        # \S must not be case-folded into \s.
+        email["subject"] = "a b"
+        self.assertFalse(rules_engine.evaluate_email(email, {"rules": [
+            {"field": "Subject", "predicate": "matches regex", "value": r"a\Sb"}]}))
+        glob = lambda value: {"rules": [{"field": "From", "predicate": "matches glob", "value": value}]}
+        self.assertTrue(rules_engine.evaluate_email(email, glob("*<noreply@github.com>")))
+        self.assertTrue(rules_engine.evaluate_email(email, glob("*@github.com")))  # The bare address is tried too
+        self.assertFalse(rules_engine.evaluate_email(email, glob("github")))  # Globs match the whole value
+
+    def test_patterns_are_cached_and_guarded(self):
+        patterns.clear_cache()
+        with patch.object(config, "PATTERN_CACHE_SIZE", 2):
+            first = patterns.compile_pattern("matches regex", "a+")
+            self.assertIs(patterns.compile_pattern("matches regex", "a+"), first)
+            patterns.compile_pattern("matches regex", "b+")
+            patterns.compile_pattern("matches glob", "c*")
+            self.assertEqual(len(patterns._cache), 2)
+            self.assertNotIn(("matches regex", "a+"), patterns._cache)
+        for bad in ["(a+)+$", "(\\w*x)*", "(a|aa)+", "((a|b)c){2,}", "x" * (config.PATTERN_MAX_LENGTH + 1),
+                    "(unclosed"]:
+            with self.assertRaises(ValueError):
+                patterns.compile_pattern("matches regex", bad)
+        for fine in [r"(invoice|receipt) #\d+", r"(ab)+", r"[(|+]+", r"\(a+\)+", "(a|b){3}"]:
+            patterns.compile_pattern("matches regex", fine)
+        # Regexes only see the first PATTERN_MAX_TEXT characters.
+        with patch.object(config, "PATTERN_MAX_TEXT", 10):
+            self.assertFalse(patterns.pattern_matches("matches regex", "end", "x" * 20 + "end"))
+        ruleset = {"rules": [{"field": "Subject", "predicate": "matches regex", "value": "(a+)+"}]}
+        self.assertIn("Error in Subject condition", patterns.check_patterns(ruleset))
+        with patch('rules_engine.load_rules', return_value=ruleset):
+            self.assertIn("Error in Subject condition", rules_engine.process_email_rules())
+
+    def test_condition_order_never_changes_the_result(self):
+        rng = random.Random(7)
+        words = ["invoice", "lunch", "github", "alert"]
+        conditions = [
+            {"field": "Subject", "predicate": "contains", "value": "Invoice"},
+            {"field": "From", "predicate": "equals", "value": "a@example.com"},
+            {"field": "Message", "predicate": "does not contain", "value": "lunch"},
+            {"field": "Received Date/Time", "predicate": "less than", "value": "3", "unit": "days"},
+            {"field": "To", "predicate": "does not equal", "value": "me@example.com"},
+            {"field": "Message Body", "predicate": "contains", "value": "github"}
+        ]
+        emails = [{
+            "from": rng.choice(["Ann <a@example.com>", "b@example.com"]),
+            "to": rng.choice(["me@example.com", "you@example.com"]),
+            "subject": " ".join(rng.sample(words, 2)),
+            "message": " ".join(rng.sample(words, 2)),
+            "body": " ".join(rng.sample(words, 2)),
+            "received_date": datetime.now().astimezone() - timedelta(days=rng.randint(0, 6))
+        } for _ in range(50)]
+        reordered = 0
+        for _ in range(30):
+            ruleset = {"match_policy": rng.choice(["All", "Any"]), "rules": rng.sample(conditions, 4)}
+            stats = {rules_engine.condition_key(c): [rng.randint(0, 100), rng.randint(0, 100), rng.random()]
+                     for c in conditions}
+            stats = {key: [checked, min(passed, checked), seconds] for key, (checked, passed, seconds) in stats.items()}
+            compiled = rules_engine.compile_ruleset(ruleset, stats=stats)
+            reordered += compiled["plan"] != compiled["rules"]
+            self.assertEqual(compiled["plan"][-1]["field"] == "Message Body",
+                             any(c["field"] == "Message Body" for c in ruleset["rules"]))
+            for email in emails:
+                # Reference: every condition checked on its own, then combined.
+                results = [rules_engine.evaluate_email(email, {"rules": [c]}) for c in ruleset["rules"]]
+                expected = all(results) if ruleset["match_policy"] == "All" else any(results)
+                self.assertEqual(rules_engine.evaluate_email(email, compiled), expected)
+        self.assertGreater(reordered, 0)
+
+    def test_evaluation_stops_once_the_result_is_settled_unless_sampled(self):
+        email = {"from": "a@example.com", "subject": "Lunch", "message": "", "received_date": datetime.now()}
+        load_body = MagicMock(return_value="body")
+        for policy, first in (("All", {"field": "Subject", "predicate": "contains", "value": "invoice"}),
+                              ("Any", {"field": "Subject", "predicate": "contains", "value": "lunch"})):
+            ruleset = rules_engine.compile_ruleset({"match_policy": policy, "rules": [
+                {"field": "Message Body", "predicate": "contains", "value": "x"},
+                first,
+                {"field": "From", "predicate": "contains", "value": "example"}
+            ]})
+            self.assertEqual(rules_engine.evaluate_email(email, ruleset, load_body), policy == "Any")
+            load_body.assert_not_called()
+            # A sampled email checks (and times) everything, with the same result.
+            stats = {}
+            self.assertEqual(rules_engine.evaluate_email(email, ruleset, load_body, stats), policy == "Any")
+            self.assertEqual(len(stats), 3)
+            self.assertEqual(load_body.call_count, 1)
+            load_body.reset_mock()
+
+    def test_selective_cheap_conditions_run_first(self):
+        slow_rare = {"field": "Subject", "predicate": "contains", "value": "a"}
+        fast_rare = {"field": "From", "predicate": "contains", "value": "b"}
+        fast_common = {"field": "To", "predicate": "contains", "value": "c"}
+        stats = {rules_engine.condition_key(slow_rare): [100, 5, 0.01],
+                 rules_engine.condition_key(fast_rare): [100, 5, 0.001],
+                 rules_engine.condition_key(fast_common): [100, 95, 0.001]}
+        rules = [slow_rare, fast_common, fast_rare]
+        order = lambda policy: [c["value"] for c in rules_engine.compile_ruleset(
+            {"match_policy": policy, "rules": rules}, stats=stats)["plan"]]
+        self.assertEqual(order("All"), ["b", "a", "c"])  # Fails most often for its cost
+        self.assertEqual(order("Any"), ["c", "b", "a"])  # Passes most often for its cost
+        # Without stats the file order is kept.
+        self.assertEqual([c["value"] for c in rules_engine.compile_ruleset({"rules": rules})["plan"]], ["a", "c", "b"])
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = patch.multiple(config, PROFILE_DIR=self.tmp_dir.name, PROFILE_MODE="off")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_phase(self):
+        @profiling.profiled("demo")
+        def work():
+            return sum(len(str(i)) for i in range(20000))
+        return work()
+
+    def test_profiling_off_writes_nothing(self):
+        self.assertEqual(self.run_phase(), sum(len(str(i)) for i in range(20000)))
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+    def test_full_mode_dumps_pstats_and_allocations(self):
+        config.PROFILE_MODE = "full"
+        self.run_phase()
+        files = os.listdir(self.tmp_dir.name)
+        self.assertTrue(any(f.endswith(".pstats") for f in files))
+        self.assertTrue(any(f.endswith(".alloc.txt") for f in files))
+
+    def test_nested_full_mode_phases_profile_only_the_outer_one(self):
+        config.PROFILE_MODE = "full"
+        with profiling.profile_phase("outer"):
+            with profiling.profile_phase("inner"):
+                sum(range(1000))
+            self.run_phase()
+        files = os.listdir(self.tmp_dir.name)
+        self.assertEqual([f.split("-")[0] for f in files if f.endswith(".pstats")], ["outer"])
+        # The nested phases only record how long they took.
+        self.assertEqual(sorted(f.split("-")[0] for f in files if f.endswith(".time.txt")), ["demo", "inner"])
+        self.assertIsNone(profiling._active_profiler)
+
+    def test_sample_mode_writes_collapsed_stacks(self):
+        config.PROFILE_MODE = "sample"
+        with patch('tracemalloc.start') as mock_start:
+            self.run_phase()
+            self.run_phase()
+        mock_start.assert_not_called()  # Sample mode doesn't trace allocations
+        files = os.listdir(self.tmp_dir.name)
+        # Two runs in the same second still get a report each.
+        self.assertEqual(len([f for f in files if f.endswith(".samples.txt")]), 2)
+        self.assertFalse(any(f.endswith(".alloc.txt") for f in files))
+        self.assertFalse(any(f.endswith(".pstats") for f in files))
+
+class TestSQLiteStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = patch.multiple(config, DB_BACKEND="sqlite",
+                                 SQLITE_PATH=os.path.join(self.tmp_dir.name, "emails.db"),
+                                 MESSAGE_CACHE_FILE=os.path.join(self.tmp_dir.name, "messages.bin"),
+                                 RULE_STATS_FILE=os.path.join(self.tmp_dir.name, "rule_stats.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(sqlite_db.close_connection)
+        self.addCleanup(message_cache.close_cache)
+        self.assertIn("ready", storage.create_schema())
+
+    def make_email(self, email_id, subject="Hello", days_ago=1):
+        return {
+            "email_id": email_id,
+            "from": "Alice <alice@example.com>",
+            "to": "me@example.com",
+            "subject": subject,
+            "received_date": datetime.now().astimezone() - timedelta(days=days_ago),
+            "message": "Snippet text"
+        }
+
+    def test_upsert_and_stream_round_trip(self):
+        storage.upsert_emails([self.make_email("a"), self.make_email("b")])
+        storage.upsert_emails([self.make_email("a", subject="Updated")])
+        emails = list(storage.stream_emails(batch_size=1))
+        self.assertEqual([e["email_id"] for e in emails], ["a", "b"])
+        self.assertEqual(emails[0]["subject"], "Updated")
+        self.assertEqual(emails[0]["to"], "me@example.com")
+        self.assertIsInstance(emails[0]["received_date"], datetime)
+
+    def test_select_with_filters(self):
+        storage.upsert_emails([self.make_email(str(i), subject=f"Subject {i}") for i in range(5)])
+        emails = storage.select_emails([("email_id", "in", ["1", "3"]), ("subject", "like", "%3")])
+        self.assertEqual([e["email_id"] for e in emails], ["3"])
+
+    def test_keyset_pages_cover_every_email_in_order(self):
+        moment = datetime(2024, 5, 1, tzinfo=timezone.utc)
+        emails = [self.make_email(f"e{i}") for i in range(23)]
+        for i, email in enumerate(emails):
+            # Lots of ties on received_ts, plus a few emails with no date at all.
+            email["received_date"] = None if i % 7 == 0 else moment - timedelta(hours=i % 4)
+        storage.upsert_emails(emails)
+        stored = storage.select_emails()
+        expected = [e["email_id"] for e in sorted(stored, key=lambda e: (e["received_ts"] is not None,
+                                                                         e["received_ts"] or 0, e["id"]),
+                                                  reverse=True)]
+        pager = browser.EmailPager(page_size=4, max_rows=8)
+        seen = []
+        while pager.more_older:
+            added, dropped = pager.older()
+            seen.extend(e["email_id"] for e in added)
+            self.assertLessEqual(len(pager.rows), 8)
+        self.assertEqual(seen, expected)
+        self.assertTrue(pager.more_newer)
+        # Scrolling back up reloads the dropped emails in the same order.
+        while pager.more_newer:
+            pager.newer()
+            self.assertLessEqual(len(pager.rows), 8)
+        self.assertEqual([e["email_id"] for e in pager.rows], expected[:len(pager.rows)])
+
+    def test_browser_search_and_rule_column(self):
+        storage.upsert_emails([self.make_email("a", subject="Invoice 1"), self.make_email("b", subject="Hi"),
+                               self.make_email("c", subject="INVOICE 2", days_ago=2)])
+        pager = browser.EmailPager(browser.search_filters("Subject", " invoice "))
+        added, _ = pager.older()
+        self.assertEqual([e["email_id"] for e in added], ["a", "c"])
+        self.assertFalse(pager.more_older)
+        ruleset = rules_engine.compile_ruleset({
+            "match_policy": "All",
+            "rules": [{"field": "Subject", "predicate": "contains", "value": "1"}]
+        })
+        self.assertEqual([browser.matches_rules(e, ruleset) for e in added], [True, False])
+        self.assertIsNone(browser.matches_rules(added[0], None))
+
+    def test_browser_search_takes_wildcards_literally(self):
+        storage.upsert_emails([self.make_email("a", subject="50% off"), self.make_email("b", subject="500 off"),
+                               self.make_email("c", subject="my_file"), self.make_email("d", subject="myXfile"),
+                               self.make_email("e", subject="C:\\temp")])
+        for text, expected in (("50%", ["a"]), ("my_", ["c"]), ("c:\\t", ["e"])):
+            pager = browser.EmailPager(browser.search_filters("Subject", text))
+            self.assertEqual([e["email_id"] for e in pager.older()[0]], expected)
+
+    def test_known_email_ids_skips_stale_rows(self):
+        storage.upsert_emails([self.make_email("a"), self.make_email("b")])
+        self.assertEqual(storage.known_email_ids(["a", "b", "c"]), {"a", "b"})
+        # Rows fetched before the cutoff count as stale.
+        self.assertEqual(storage.known_email_ids(["a", "b"], fetched_since=int(time.time()) + 60), set())
+
+    def test_fetch_skips_already_stored_messages(self):
+        storage.upsert_emails([self.make_email("a")])
+        service = MagicMock()
+        with patch('rules_engine.authenticate_gmail', return_value=service), \
+             patch('gmail_api.iter_email_pages', return_value=[[{"id": "a"}, {"id": "b"}]]), \
+             patch('gmail_api.get_email', side_effect=lambda service, msg_id: self.make_email(msg_id)) as mock_get_email:
+            result = rules_engine.fetch_and_store_emails("2")
+            self.assertEqual([c.args[1] for c in mock_get_email.call_args_list], ["b"])
+            self.assertIn("Stored email b", result)
+            self.assertIn("Skipped 1 emails", result)
+            rules_engine.fetch_and_store_emails("2", force_refresh=True)
+            self.assertEqual(mock_get_email.call_count, 3)
+
+    def test_incremental_runs_only_check_new_or_aged_rows(self):
+        config_patch = patch.object(config, "RULES_STATE_FILE", os.path.join(self.tmp_dir.name, "state.json"))
+        config_patch.start()
+        self.addCleanup(config_patch.stop)
+        ruleset = {
+            "match_policy": "All",
+            "rules": [{"field": "Subject", "predicate": "contains", "value": "Hello"}],
+            "actions": [{"action": "mark as read"}]
+        }
+        with patch('time.time', return_value=time.time() - 300):
+            storage.upsert_emails([self.make_email("a"), self.make_email("b")])
+        with patch('rules_engine.load_rules', side_effect=lambda: dict(ruleset)), \
+             patch('rules_engine.authenticate_gmail'), \
+             patch('rules_engine.apply_actions', return_value="") as mock_apply:
+            rules_engine.process_email_rules()
+            self.assertEqual(mock_apply.call_args.args[1], ["a", "b"])
+            # Nothing changed, so the second run has nothing to look at.
+            self.assertIn("No new or changed emails", rules_engine.process_email_rules())
+            # Only the new row is checked on the next run.
+            storage.upsert_emails([self.make_email("c")])
+            rules_engine.process_email_rules()
+            self.assertEqual(mock_apply.call_args.args[1], ["c"])
+            # Changing the rules means a full run again.
+            ruleset["actions"] = [{"action": "mark as unread"}]
+            rules_engine.process_email_rules()
+            self.assertEqual(mock_apply.call_args.args[1], ["a", "b", "c"])
+
+    def test_incremental_date_rules_keep_their_state(self):
+        config_patch = patch.object(config, "RULES_STATE_FILE", os.path.join(self.tmp_dir.name, "state.json"))
+        config_patch.start()
+        self.addCleanup(config_patch.stop)
+        ruleset = {
+            "match_policy": "All",
+            "rules": [{"field": "Received Date/Time", "predicate": "greater than", "value": "5", "unit": "days"}],
+            "actions": [{"action": "mark as read"}]
+        }
+        with patch('time.time', return_value=time.time() - 300):
+            storage.upsert_emails([self.make_email("a", days_ago=10), self.make_email("b", days_ago=4)])
+        class ThreeDaysLater(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return datetime.now(tz) + timedelta(days=3)
+        with patch('rules_engine.load_rules', side_effect=lambda: dict(ruleset)), \
+             patch('rules_engine.authenticate_gmail'), \
+             patch('rules_engine.apply_actions', return_value="") as mock_apply:
+            rules_engine.process_email_rules()
+            self.assertEqual(mock_apply.call_args.args[1], ["a"])
+            # The cutoff moves every run, but it's still the same ruleset.
+            self.assertIn("No new or changed emails", rules_engine.process_email_rules())
+            # Three days on, only the email that has aged past the cutoff is checked.
+            with patch('rules_engine.datetime', ThreeDaysLater):
+                rules_engine.process_email_rules()
+            self.assertEqual(mock_apply.call_args.args[1], ["b"])
+            self.assertEqual(mock_apply.call_count, 2)
+
+    def test_parallel_workers_find_the_same_matches(self):
+        storage.upsert_emails([self.make_email(str(i), subject="Invoice" if i % 3 else "Lunch")
+                               for i in range(30)])
+        ruleset = rules_engine.compile_ruleset({
+            "match_policy": "All",
+            "rules": [{"field": "Subject", "predicate": "contains", "value": "invoice"}]
+        })
+        self.assertEqual(len(rules_engine.shard_filters([], 4)), 4)
+        results = list(rules_engine.find_matches(ruleset, [], workers=2))
+        self.assertEqual(sum(evaluated for evaluated, _ in results), 30)
+        parallel_ids = sorted(email_id for _, ids in results for email_id in ids)
+        sequential_ids = sorted(email_id for _, ids in rules_engine.find_matches(ruleset, []) for email_id in ids)
+        self.assertEqual(parallel_ids, sequential_ids)
+        self.assertEqual(len(parallel_ids), 20)
+
+    def test_rule_runs_save_condition_stats(self):
+        storage.upsert_emails([self.make_email(str(i), subject="Invoice" if i < 2 else "Lunch") for i in range(20)])
+        ruleset = {
+            "match_policy": "All",
+            "rules": [{"field": "From", "predicate": "contains", "value": "alice"},
+                      {"field": "Subject", "predicate": "does not contain", "value": "lunch"}],
+            "actions": [{"action": "mark as read"}]
+        }
+        with patch.multiple(config, INCREMENTAL_RULES=False, RULE_STATS_SAMPLE=1), \
+             patch('rules_engine.load_rules', return_value=ruleset), \
+             patch('rules_engine.authenticate_gmail'), \
+             patch('rules_engine.apply_actions', return_value="") as mock_apply:
+            rules_engine.process_email_rules()
+            self.assertEqual(mock_apply.call_args.args[1], ["0", "1"])
+            stats = rules_engine.load_rule_stats()
+            self.assertEqual(stats[rules_engine.condition_key(ruleset["rules"][0])][:2], [20, 20])
+            self.assertEqual(stats[rules_engine.condition_key(ruleset["rules"][1])][:2], [20, 2])
+            # The subject rarely passes, so it's checked first from now on, with the same matches.
+            plan = rules_engine.compile_ruleset(ruleset, stats=stats)["plan"]
+            self.assertEqual(plan[0]["field"], "Subject")
+            rules_engine.process_email_rules()
+            self.assertEqual(mock_apply.call_args.args[1], ["0", "1"])
+            # Sampled emails still check the sender even once the subject has settled the result.
+            self.assertEqual(rules_engine.load_rule_stats()[rules_engine.condition_key(ruleset["rules"][0])][:2], [40, 40])
+
+    def test_thread_mode_fetches_conversations_in_one_call(self):
+        page = [{"id": "a", "threadId": "t1"}, {"id": "b", "threadId": "t1"}, {"id": "c", "threadId": "t2"}]
+        thread = [dict(self.make_email(email_id), thread_id="t1") for email_id in ("a", "b")]
+        with patch.object(config, "THREAD_MODE", True), \
+             patch('rules_engine.authenticate_gmail'), \
+             patch('gmail_api.iter_email_pages', return_value=[page]), \
+             patch('gmail_api.get_thread', return_value=thread) as mock_get_thread, \
+             patch('gmail_api.get_email', side_effect=lambda service, msg_id: dict(
+                 self.make_email(msg_id), thread_id="t2")) as mock_get_email:
+            rules_engine.fetch_and_store_emails("3")
+        mock_get_thread.assert_called_once()
+        self.assertEqual([c.args[1] for c in mock_get_email.call_args_list], ["c"])
+        self.assertEqual({e["email_id"]: e["thread_id"] for e in storage.stream_emails()}, {"a": "t1", "b": "t1", "c": "t2"})
+
+    def test_thread_mode_acts_on_matching_threads(self):
+        emails = [("a", "t1", "Invoice"), ("b", "t1", "Lunch"), ("c", "t2", "Invoice"), ("d", None, "Invoice")]
+        storage.upsert_emails([dict(self.make_email(email_id, subject=subject), thread_id=thread_id)
+                               for email_id, thread_id, subject in emails])
+        ruleset = {"match_policy": "All", "rules": [{"field": "Subject", "predicate": "contains", "value": "invoice"}],
+                   "actions": [{"action": "mark as read"}]}
+        service = MagicMock()
+        service.users.return_value.threads.return_value.modify.return_value.execute.return_value = {"messages": [{}, {}]}
+        modify = service.users.return_value.threads.return_value.modify
+        for thread_match, expected in (("any", ["t1", "t2"]), ("all", ["t2"])):
+            modify.reset_mock()
+            with patch.multiple(config, THREAD_MODE=True, THREAD_MATCH=thread_match, INCREMENTAL_RULES=False), \
+                 patch('rules_engine.load_rules', return_value=ruleset), \
+                 patch('rules_engine.authenticate_gmail', return_value=service), \
+                 patch('rules_engine.apply_actions', return_value="") as mock_apply:
+                result = rules_engine.process_email_rules()
+            self.assertEqual([c.kwargs["id"] for c in modify.call_args_list], expected)
+            self.assertEqual(modify.call_args.kwargs["body"], {"removeLabelIds": ["UNREAD"]})
+            self.assertIn(f"Applied actions to {len(expected)} threads", result)
+            # Emails stored without a thread ID still get their actions one by one.
+            self.assertEqual(mock_apply.call_args.args[1], ["d"])
+
+    def test_retention_archives_emails_past_the_hot_window(self):
+        storage.upsert_emails([self.make_email("new", days_ago=1), self.make_email("old", days_ago=100)])
+        storage.save_body("old", "zlib", b"body")
+        archived = lambda: sqlite_db.get_connection().execute(
+            "SELECT email_id, archived_at IS NOT NULL, deleted_at FROM emails_archive;").fetchall()
+        self.assertIn("Retention is off", retention.apply_retention())
+        with patch.object(config, "RETENTION_DAYS", 30):
+            self.assertIn("Archived 1 emails", retention.apply_retention())
+            self.assertIn("No emails older than 30 days", retention.apply_retention())
+        self.assertEqual([e["email_id"] for e in storage.stream_emails()], ["new"])
+        self.assertEqual(archived(), [("old", 1, None)])
+        self.assertIsNone(storage.load_body("old"))
+        # Archived emails count as stored, so a fetch won't bring them back...
+        self.assertEqual(storage.known_email_ids(["old", "new", "x"], fetched_since=int(time.time()) + 60), {"old"})
+        # ...and emails already past the window aren't stored in the first place.
+        with patch.object(config, "RETENTION_DAYS", 30):
+            self.assertEqual(rules_engine.store_emails([self.make_email("ancient", days_ago=90)]),
+                             ["Skipped 1 emails older than 30 days."])
+        self.assertEqual([e["email_id"] for e in storage.stream_emails()], ["new"])
+        # Or export them to a compressed file instead.
+        storage.upsert_emails([self.make_email("older", days_ago=200)])
+        archive_dir = os.path.join(self.tmp_dir.name, "archive")
+        with patch.multiple(config, RETENTION_DAYS=30, RETENTION_ARCHIVE="export", ARCHIVE_DIR=archive_dir):
+            self.assertIn("Archived 1 emails", retention.apply_retention())
+        with gzip.open(os.path.join(archive_dir, os.listdir(archive_dir)[0]), "rt") as f:
+            self.assertEqual([json.loads(line)["email_id"] for line in f], ["older"])
+        self.assertEqual([e["email_id"] for e in storage.stream_emails()], ["new"])
+
+    def test_emails_deleted_in_gmail_are_tombstoned(self):
+        storage.upsert_emails([self.make_email("a"), self.make_email("b"), self.make_email("c")])
+        storage.archive_emails([("email_id", "=", "c")])
+        service = MagicMock()
+        service.users.return_value.getProfile.return_value.execute.return_value = {"historyId": "100"}
+        history_list = service.users.return_value.history.return_value.list
+        history_list.return_value.execute.return_value = {
+            "history": [{"messagesDeleted": [{"message": {"id": "a"}}, {"message": {"id": "c"}},
+                                             {"message": {"id": "x"}}]}],
+            "historyId": "150"
+        }
+        with patch.object(config, "HISTORY_STATE_FILE", os.path.join(self.tmp_dir.name, "history.json")):
+            self.assertIn("Started tracking", retention.sync_deletions(service))
+            history_list.assert_not_called()
+            # "c" was already archived; it's tombstoned where it is.
+            self.assertIn("Marked 2 stored emails as deleted", retention.sync_deletions(service))
+            self.assertEqual(history_list.call_args.kwargs["startHistoryId"], "100")
+            self.assertEqual(retention.load_history_state(), {"default": "150"})
+        self.assertEqual([e["email_id"] for e in storage.stream_emails()], ["b"])
+        rows = sqlite_db.get_connection().execute(
+            "SELECT email_id, deleted_at IS NOT NULL FROM emails_archive ORDER BY email_id;").fetchall()
+        self.assertEqual(rows, [("a", 1), ("c", 1)])
+
+    def test_action_queue_claims_each_row_once(self):
+        actions = [{"action": "mark as read"}]
+        self.assertEqual(storage.enqueue_actions(["a", "b", "c"], "rules1", actions), 3)
+        # Queuing the same matches again adds nothing.
+        self.assertEqual(storage.enqueue_actions(["a", "b"], "rules1", actions), 0)
+        first = storage.claim_actions(2)
+        second = storage.claim_actions(2)
+        self.assertEqual([row["email_id"] for row in first], ["a", "b"])
+        self.assertEqual([row["email_id"] for row in second], ["c"])
+        self.assertEqual(first[0]["actions"], actions)
+        self.assertEqual(storage.claim_actions(2), [])
+        storage.finish_actions([row["id"] for row in first])
+        storage.finish_actions([row["id"] for row in second], "Error: quota")
+        # The failed row is back in the queue for a retry; the done ones are not.
+        self.assertEqual([row["email_id"] for row in storage.claim_actions(10)], ["c"])
+
+    def test_expired_claims_on_the_last_attempt_fail(self):
+        storage.enqueue_actions(["a"], "rules1", [{"action": "mark as read"}])
+        with patch.object(config, "ACTION_MAX_ATTEMPTS", 1):
+            self.assertEqual(len(storage.claim_actions(10)), 1)
+            # The worker dies; once its lease is over the row can't be retried, so it fails.
+            with patch('time.time', return_value=time.time() + config.ACTION_LEASE_SECONDS + 1):
+                self.assertEqual(storage.claim_actions(10), [])
+        status, error = sqlite_db.get_connection().execute(
+            "SELECT status, last_error FROM pending_actions;").fetchone()
+        self.assertEqual(status, "failed")
+        self.assertIn("lease expired", error)
+
+    def test_claim_refuses_to_commit_the_callers_transaction(self):
+        connection = sqlite_db.get_connection()
+        connection.execute("BEGIN;")
+        self.addCleanup(connection.rollback)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            storage.claim_actions(10)
+
+    def test_queued_date_rule_runs_queue_each_match_once(self):
+        storage.upsert_emails([self.make_email("a", days_ago=10)])
+        ruleset = {
+            "match_policy": "All",
+            "rules": [{"field": "Received Date/Time", "predicate": "greater than", "value": "5", "unit": "days"}],
+            "actions": [{"action": "mark as read"}]
+        }
+        with patch.multiple(config, ACTION_QUEUE=True, INCREMENTAL_RULES=False), \
+             patch('rules_engine.load_rules', return_value=ruleset), \
+             patch('rules_engine.process_action_queue', return_value=""):
+            rules_engine.process_email_rules()
+            rules_engine.process_email_rules()
+        self.assertEqual(sqlite_db.get_connection().execute("SELECT COUNT(*) FROM pending_actions;").fetchone()[0], 1)
+
+    def test_queued_rule_run_sends_actions_through_the_outbox(self):
+        storage.upsert_emails([self.make_email("a"), self.make_email("b", subject="Other")])
+        ruleset = {
+            "match_policy": "All",
+            "rules": [{"field": "Subject", "predicate": "contains", "value": "Hello"}],
+            "actions": [{"action": "mark as read"}]
+        }
+        with patch.multiple(config, ACTION_QUEUE=True, INCREMENTAL_RULES=False), \
+             patch('rules_engine.load_rules', return_value=ruleset), \
+             patch('rules_engine.authenticate_gmail') as mock_auth:
+            batch_modify = mock_auth.return_value.users.return_value.messages.return_value.batchModify
+            output = rules_engine.process_email_rules()
+            self.assertIn("Queued actions done: 1.", output)
+            self.assertEqual(batch_modify.call_args.kwargs["body"]["ids"], ["a"])
+            # A second run finds the same match but doesn't send it again.
+            self.assertIn("Queued actions done: 0.", rules_engine.process_email_rules())
+            self.assertEqual(batch_modify.call_count, 1)
+            # Full runs apply everything again, however often they run.
+            for run in range(2):
+                self.assertIn("Queued actions done: 1.", rules_engine.process_email_rules(full_run=True))
+            self.assertEqual(batch_modify.call_count, 3)
+
+    def test_done_actions_are_pruned_after_their_keep_time(self):
+        storage.enqueue_actions(["a"], "rules1", [])
+        storage.finish_actions([row["id"] for row in storage.claim_actions(10)])
+        count = lambda: sqlite_db.get_connection().execute("SELECT COUNT(*) FROM pending_actions;").fetchone()[0]
+        self.assertEqual(count(), 1)  # Kept for a while, so incremental runs don't resend it
+        storage.enqueue_actions(["b"], "rules1", [])
+        later = time.time() + config.ACTION_DONE_KEEP_DAYS * 86400 + 1
+        with patch('time.time', return_value=later):
+            storage.finish_actions([row["id"] for row in storage.claim_actions(10)])
+        self.assertEqual([row[0] for row in sqlite_db.get_connection().execute(
+            "SELECT email_id FROM pending_actions;")], ["b"])
+
+    def test_normalized_columns_are_stored_and_used(self):
+        storage.upsert_emails([self.make_email("1", subject="Straße Report"), self.make_email("2")])
+        email = storage.select_emails([("email_id", "=", "1")])[0]
+        self.assertEqual(email["subject_norm"], "strasse report")
+        self.assertEqual((email["from_email"], email["from_domain"]), ("alice@example.com", "example.com"))
+        ruleset = rules_engine.compile_ruleset({"match_policy": "All", "rules": [
+            {"field": "From", "predicate": "equals", "value": "ALICE@example.com"},
+            {"field": "Subject", "predicate": "equals", "value": "STRASSE report"}
+        ]})
+        filters = rules_engine.build_pushdown_filters(ruleset)
+        self.assertEqual([e["email_id"] for e in storage.select_emails(filters)], ["1"])
+        self.assertTrue(rules_engine.evaluate_email(email, ruleset))
+        # Emails that didn't come from the database are normalized on the fly, with the same result.
+        self.assertTrue(rules_engine.evaluate_email(self.make_email("3", subject="Straße Report"), ruleset))
+
+    def test_accounts_keep_their_own_emails(self):
+        with accounts.using_account("work@example.com"):
+            storage.upsert_emails([self.make_email("w1")])
+        storage.upsert_emails([self.make_email("h1")])
+        ruleset = {
+            "match_policy": "All",
+            "rules": [{"field": "Subject", "predicate": "contains", "value": "Hello"}],
+            "actions": [{"action": "mark as read"}]
+        }
+        with patch.object(config, "INCREMENTAL_RULES", False), \
+             patch('rules_engine.load_rules', return_value=ruleset), \
+             patch('rules_engine.authenticate_gmail'), \
+             patch('rules_engine.apply_actions', return_value="") as mock_apply, \
+             patch('scheduler.fetch_and_store_emails', return_value="Fetched."):
+            output = scheduler.sync_accounts(["work@example.com", "default"])
+        self.assertEqual(sorted(call.args[1] for call in mock_apply.call_args_list), [["h1"], ["w1"]])
+        self.assertIn("[work@example.com] Email w1 matches rules.", output)
+        self.assertEqual(accounts.token_path("work@example.com"), os.path.join(config.TOKEN_DIR, "work@example.com.pickle"))
+        self.assertEqual(accounts.token_path("default"), "token.pickle")
+        with self.assertRaises(ValueError):
+            accounts.token_path("../evil")
+
+    def test_accounts_can_store_the_same_message_id(self):
+        with accounts.using_account("work@example.com"):
+            storage.upsert_emails([self.make_email("same", subject="Work copy")])
+            self.assertEqual(storage.known_email_ids(["same"]), {"same"})
+            storage.enqueue_actions(["same"], "rules1", [])
+        self.assertEqual(storage.known_email_ids(["same"]), set())
+        storage.upsert_emails([self.make_email("same", subject="Home copy")])
+        self.assertEqual(storage.enqueue_actions(["same"], "rules1", []), 1)
+        rows = sorted((e["account"], e["subject"]) for e in storage.select_emails())
+        self.assertEqual(rows, [("default", "Home copy"), ("work@example.com", "Work copy")])
+        # Each account keeps its own copy of the body, and deleting one leaves the other.
+        storage.save_body("same", "zlib", b"home")
+        with accounts.using_account("work@example.com"):
+            self.assertIsNone(storage.load_body("same"))
+            storage.save_body("same", "zlib", b"work")
+            storage.delete_emails([("account", "=", "work@example.com")])
+            self.assertIsNone(storage.load_body("same"))
+        self.assertEqual(storage.load_body("same"), ("zlib", b"home"))
+
+    def test_old_databases_are_rekeyed_by_account(self):
+        sqlite_db.close_connection()
+        path = os.path.join(self.tmp_dir.name, "old.db")
+        old = sqlite3.connect(path)
+        old.executescript("""
+            CREATE TABLE emails (id INTEGER PRIMARY KEY AUTOINCREMENT, email_id TEXT UNIQUE, from_address TEXT,
+                                 to_address TEXT, subject TEXT, received_date TEXT, snippet TEXT);
+            INSERT INTO emails (email_id, subject) VALUES ('old', 'Quarterly report');
+            CREATE TABLE pending_actions (id INTEGER PRIMARY KEY AUTOINCREMENT, email_id TEXT NOT NULL,
+                                          rule_key TEXT NOT NULL, actions TEXT NOT NULL,
+                                          status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+                                          claimed_until INTEGER, last_error TEXT, UNIQUE (email_id, rule_key));
+            INSERT INTO pending_actions (email_id, rule_key, actions) VALUES ('old', 'rules1', '[]');
+            CREATE TABLE email_bodies (email_id TEXT PRIMARY KEY, codec TEXT NOT NULL, body BLOB NOT NULL,
+                                       stored_at INTEGER);
+            INSERT INTO email_bodies (email_id, codec, body) VALUES ('old', 'zlib', x'00');
+        """)
+        old.close()
+        with patch.object(config, "SQLITE_PATH", path):
+            self.assertIn("ready", storage.create_schema())
+            connection = sqlite_db.get_connection()
+            for table in ["emails", "emails_archive", "pending_actions", "email_bodies"]:
+                self.assertFalse(sqlite_db.unique_without_account(connection, table))
+            with accounts.using_account("work@example.com"):
+                storage.upsert_emails([self.make_email("old", subject="Work report")])
+            # The old row, its full-text entry and the triggers all survived the rebuild.
+            self.assertEqual([e["email_id"] for e in storage.select_emails([("subject_norm", "match", "report")])],
+                             ["old", "old"])
+            self.assertEqual(len(storage.claim_actions(10)), 1)
+            self.assertEqual(storage.load_body("old"), ("zlib", b"\x00"))
+            # Running it again leaves the rebuilt tables alone.
+            self.assertIn("ready", storage.create_schema())
+            sqlite_db.close_connection()
+
+    def test_message_body_is_fetched_once_and_only_when_needed(self):
+        self.addCleanup(body_store.clear_cache)
+        storage.upsert_emails([self.make_email("1"), self.make_email("2", subject="Other")])
+        text = "Your order #123 has shipped. " * 50
+        service = MagicMock()
+        service.users.return_value.messages.return_value.get.return_value.execute.return_value = {"payload": {
+            "mimeType": "multipart/alternative", "parts": [
+                {"mimeType": "text/plain", "body": {"data": base64.urlsafe_b64encode(text.encode()).decode()}},
+                {"mimeType": "text/html", "body": {"data": ""}}
+            ]}}
+        ruleset = rules_engine.compile_ruleset({"match_policy": "All", "rules": [
+            {"field": "Subject", "predicate": "contains", "value": "hello"},
+            {"field": "Message Body", "predicate": "contains", "value": "HAS SHIPPED"}
+        ]})
+        load_body = lambda email: body_store.get_body(email["email_id"], lambda: service)
+        matches = [ids for _, ids in rules_engine.find_matches(ruleset, [], load_body=load_body) if ids]
+        self.assertEqual(matches, [["1"]])
+        # Email 2 failed on its subject, so only email 1's body was downloaded.
+        get = service.users.return_value.messages.return_value.get
+        self.assertEqual(get.call_count, 1)
+        codec, data = storage.load_body("1")
+        self.assertLess(len(data), len(text))
+        self.assertEqual(body_store.decompress(codec, data), text)
+        # Later checks come from the cache (or the table), not Gmail.
+        body_store.clear_cache()
+        self.assertEqual(body_store.get_body("1", lambda: service), text)
+        self.assertEqual(get.call_count, 1)
+
+    def test_message_cache_survives_restarts_and_evicts_old_entries(self):
+        path = os.path.join(self.tmp_dir.name, "lru.bin")
+        cache = message_cache.MessageCache(path, max_bytes=2000)
+        for i in range(5):
+            cache.put(f"m{i}", {"email": {"subject": "x" * 100}})
+        cache.get("m0")  # m0 is now the most recently used
+        cache.close()
+        # Reopening rebuilds the index from the file: a garbled record is skipped,
+        # and a torn write at the end is dropped.
+        with open(path, "ab") as f:
+            f.write(b"\x05\x00\x00\x00{oops")
+        cache = message_cache.MessageCache(path, max_bytes=2000)
+        cache.put("m4b", {"email": {"subject": "after"}})
+        cache.close()
+        with open(path, "ab") as f:
+            f.write(b"\x50\x00\x00\x00{\"key")
+        size = os.path.getsize(path)
+        cache = message_cache.MessageCache(path, max_bytes=2000)
+        self.assertEqual(os.path.getsize(path), size - 9)
+        self.assertEqual(cache.get("m4b")["email"]["subject"], "after")
+        self.assertEqual(cache.get("m3")["email"]["subject"], "x" * 100)
+        for i in range(5, 15):
+            cache.put(f"m{i}", {"email": {"subject": "x" * 100}})
+        self.assertLessEqual(os.path.getsize(path), 2000)
+        self.assertIsNone(cache.get("m1"))
+        self.assertIsNotNone(cache.get("m14"))
+        cache.close()
+
+    def test_fetch_reads_downloaded_messages_from_the_cache(self):
+        page = [{"id": "1"}, {"id": "2"}, {"id": "3"}]
+        download = lambda service, msg_id: dict(self.make_email(msg_id), history_id=str(100 + int(msg_id)))
+        with patch('rules_engine.authenticate_gmail'), \
+             patch('gmail_api.iter_email_pages', return_value=[page]), \
+             patch('gmail_api.get_email', side_effect=download) as mock_get, \
+             patch('gmail_api.changed_messages', return_value={"3"}) as mock_changed, \
+             patch('storage.upsert_emails', return_value="Error inserting emails: database is down"):
+            rules_engine.fetch_and_store_emails("3")
+            self.assertEqual(mock_get.call_count, 3)
+            # The database was down, so the retry finds nothing stored, but only the message
+            # that changed in Gmail since is downloaded again.
+            output = rules_engine.fetch_and_store_emails("3")
+            self.assertEqual(mock_changed.call_args.args[1], 101)
+            self.assertEqual(mock_get.call_count, 4)
+            self.assertIn("Read 2 emails from the local message cache", output)
+            # If Gmail's history doesn't go back far enough, nothing is trusted.
+            mock_changed.return_value = None
+            rules_engine.fetch_and_store_emails("3")
+        self.assertEqual(mock_get.call_count, 7)
+
+    @unittest.skipUnless(snapshot.pa, "pyarrow isn't installed")
+    def test_snapshot_simulation_matches_the_rules_engine(self):
+        emails = [self.make_email(str(i), subject="Invoice" if i % 2 else "Lunch", days_ago=i) for i in range(10)]
+        emails[3]["from"] = "Bob <BOB@Example.org>"
+        storage.upsert_emails(emails)
+        path = os.path.join(self.tmp_dir.name, "emails.arrow")
+        self.assertIn("Exported 10 emails", snapshot.export_snapshot(path))
+        table = snapshot.load_snapshot(path)
+        for policy in ("All", "Any"):
+            ruleset = {"match_policy": policy, "rules": [
+                {"field": "Subject", "predicate": "contains", "value": "INVOICE"},
+                {"field": "From", "predicate": "does not equal", "value": "bob@example.org"},
+                {"field": "Received Date/Time", "predicate": "less than", "value": "5", "unit": "days"},
+                {"field": "Message Body", "predicate": "contains", "value": "x"}
+            ]}
+            result = snapshot.simulate_rules(ruleset, table)
+            expected = [ids for _, ids in rules_engine.find_matches(rules_engine.compile_ruleset(ruleset), [])]
+            self.assertEqual(sorted(result["matched_ids"]), sorted(sum(expected, [])))
+            self.assertEqual([count for _, count in result["conditions"]], [5, 9, 5, 0])
+        self.assertIn("Would match", snapshot.simulate(path, ruleset))
+
+    def test_or_groups_in_filters(self):
+        storage.upsert_emails([self.make_email(str(i)) for i in range(4)])
+        emails = storage.select_emails([[[("email_id", "=", "1")], [("email_id", "in", ["2", "3"])]],
+                                        ("email_id", "!=", "3")])
+        self.assertEqual([e["email_id"] for e in emails], ["1", "2"])
+
+    def test_build_where_rejects_unknown_columns(self):
+        with self.assertRaises(ValueError):
+            storage.build_where([("subject; DROP TABLE emails", "=", "x")], sqlite_db)
+
+    def test_fulltext_filter_finds_substrings(self):
+        storage.upsert_emails([
+            self.make_email("1", subject="Your INVOICE is ready"),
+            self.make_email("2", subject="Lunch plans"),
+            self.make_email("3", subject="Re: invoices for March")
+        ])
+        storage.upsert_emails([self.make_email("2", subject="Updated invoice")])
+        self.assertIn("subject_norm", storage.fulltext_columns())
+        emails = storage.select_emails([("subject_norm", "match", "nvoic")])
+        self.assertEqual(sorted(e["email_id"] for e in emails), ["1", "2", "3"])
+
+    def test_fulltext_prefilter_uses_case_folded_text(self):
+        storage.upsert_emails([self.make_email("1", subject="Straße closed"), self.make_email("2", subject="Lunch")])
+        for value in ("STRASSE", "straße"):
+            ruleset = rules_engine.compile_ruleset({"match_policy": "All", "rules": [
+                {"field": "Subject", "predicate": "contains", "value": value}]})
+            filters = rules_engine.build_pushdown_filters(ruleset)
+            self.assertEqual(filters, [("subject_norm", "match", "strasse")])
+            emails = storage.select_emails(filters)
+            self.assertEqual([e["email_id"] for e in emails], ["1"])
+            self.assertTrue(rules_engine.evaluate_email(emails[0], ruleset))
+
+    def test_old_raw_fulltext_index_is_rebuilt(self):
+        connection = sqlite_db.get_connection()
+        for statement in sqlite_db.FULLTEXT_DROP:
+            connection.execute(statement)
+        connection.execute("CREATE VIRTUAL TABLE emails_fts USING fts5(subject, snippet, content='emails', "
+                           "content_rowid='id', tokenize='trigram');")
+        connection.commit()
+        storage.upsert_emails([self.make_email("1", subject="Straße")])
+        self.assertEqual(storage.fulltext_columns(), set())
+        self.assertIn("ready", storage.create_schema())
+        self.assertEqual(storage.fulltext_columns(), {"subject_norm", "snippet_norm"})
+        self.assertEqual([e["email_id"] for e in storage.select_emails([("subject_norm", "match", "strasse")])],
+                         ["1"])
+
+    def test_pushdown_only_narrows_candidates(self):
+        storage.upsert_emails([
+            self.make_email("1", subject="Invoice 42"),
+            self.make_email("2", subject="Newsletter")
+        ])
+        ruleset = {
+            "match_policy": "All",
+            "rules": [
+                {"field": "Subject", "predicate": "contains", "value": "invoice"},
+                {"field": "Subject", "predicate": "contains", "value": "42"}
+            ]
+        }
+        # "42" is too short for the index, so only the first condition is pushed down.
+        self.assertEqual(rules_engine.build_pushdown_filters(ruleset), [("subject_norm", "match", "invoice")])
+        ruleset["match_policy"] = "Any"
+        self.assertEqual(rules_engine.build_pushdown_filters(ruleset), [])
+
+    def test_date_rules_become_range_lookups(self):
+        storage.upsert_emails([self.make_email("old", days_ago=40), self.make_email("new", days_ago=2)])
+        ruleset = rules_engine.compile_ruleset({
+            "match_policy": "All",
+            "rules": [{"field": "Received Date/Time", "predicate": "greater than", "value": "1", "unit": "months"}]
+        })
+        filters = rules_engine.build_pushdown_filters(ruleset)
+        self.assertEqual(filters[0][:2], ("received_ts", "<"))
+        emails = storage.select_emails(filters)
+        self.assertEqual([e["email_id"] for e in emails], ["old"])
+        self.assertTrue(rules_engine.evaluate_email(emails[0], ruleset))
+
+class TestRemoteRules(unittest.TestCase):
+    def test_all_policy_compiles_to_gmail_query(self):
+        exclusion = {"field": "Subject", "predicate": "does not contain", "value": "weekly digest"}
+        query, residual = remote_rules.build_gmail_query({
+            "match_policy": "All",
+            "rules": [
+                {"field": "From", "predicate": "contains", "value": "github"},
+                exclusion,
+                {"field": "Received Date/Time", "predicate": "less than", "value": "7", "unit": "days"}
+            ]
+        })
+        self.assertEqual(query, 'from:("github") -subject:("weekly digest") newer_than:8d')
+        # Gmail only leaves out whole words, so the exclusion is checked again locally, and
+        # so is the date, since Gmail's day boundaries aren't ours.
+        self.assertEqual([c["predicate"] for c in residual], ["does not contain", "less than"])
+
+    def test_date_boundaries_are_checked_locally(self):
+        ruleset = {"match_policy": "All", "actions": [{"action": "mark as read"}], "rules": [
+            {"field": "From", "predicate": "contains", "value": "alice"},
+            {"field": "Received Date/Time", "predicate": "greater than", "value": "3", "unit": "days"}]}
+        ages = {"3.5": 3.5, "4.5": 4.5}
+        email = lambda service, msg_id: {"email_id": msg_id, "from": "alice@example.com", "to": "", "subject": "",
+                                         "message": "", "received_date": datetime.now().astimezone() -
+                                         timedelta(days=ages[msg_id])}
+        with patch('remote_rules.load_rules', return_value=ruleset), \
+             patch('remote_rules.authenticate_gmail'), \
+             patch('remote_rules.iter_email_pages', return_value=[[{"id": "3.5"}, {"id": "4.5"}]]) as mock_list, \
+             patch('remote_rules.get_email', side_effect=email), \
+             patch('remote_rules.apply_actions', return_value="") as mock_apply:
+            output = remote_rules.apply_rules_remotely()
+        self.assertEqual(mock_list.call_args.args[1], 'from:("alice") older_than:3d')
+        # Gmail lists the 3.5-day-old email, but it's only "greater than 3 days" locally after 4 whole days.
+        self.assertEqual(mock_apply.call_args.args[1], ["4.5"])
+        self.assertIn("1 emails matched", output)
+
+    def test_invalid_patterns_are_refused_before_querying_gmail(self):
+        ruleset = {"match_policy": "All", "actions": [], "rules": [
+            {"field": "From", "predicate": "contains", "value": "alice"},
+            {"field": "Subject", "predicate": "matches regex", "value": "(a|aa)+"}]}
+        with patch('remote_rules.load_rules', return_value=ruleset), \
+             patch('remote_rules.authenticate_gmail') as mock_auth:
+            self.assertIn("Error in Subject condition", remote_rules.apply_rules_remotely())
+        mock_auth.assert_not_called()
+
+    def test_whole_message_terms_are_verified_locally(self):
+        for field in ["Message", "Message Body"]:
+            condition = {"field": field, "predicate": "contains", "value": "invoice"}
+            self.assertEqual(remote_rules.build_gmail_query({"match_policy": "All", "rules": [condition]}),
+                             ('"invoice"', [condition]))
+
+    def test_rules_that_would_list_the_whole_mailbox_are_refused(self):
+        self.assertEqual(remote_rules.build_gmail_query({"match_policy": "Any", "rules": []}), (None, None))
+        residual_only = [{"field": "Subject", "predicate": "does not equal", "value": "x"}]
+        self.assertEqual(remote_rules.build_gmail_query({"match_policy": "All", "rules": residual_only}),
+                         (None, None))
+        # Exclusions alone would list nearly every message.
+        negated_only = [{"field": "Subject", "predicate": "does not contain", "value": "x"},
+                        {"field": "From", "predicate": "does not contain", "value": "y"}]
+        self.assertEqual(remote_rules.build_gmail_query({"match_policy": "All", "rules": negated_only}),
+                         (None, None))
+
+    def test_equals_is_verified_locally(self):
+        condition = {"field": "Subject", "predicate": "equals", "value": "Hi"}
+        query, residual = remote_rules.build_gmail_query({"match_policy": "All", "rules": [condition]})
+        self.assertEqual(query, 'subject:("Hi")')
+        self.assertEqual(residual, [condition])
+
+    def test_any_policy_uses_or_group_or_refuses(self):
+        rules = [
+            {"field": "From", "predicate": "contains", "value": "a"},
+            {"field": "To", "predicate": "contains", "value": "b"}
+        ]
+        self.assertEqual(remote_rules.build_gmail_query({"match_policy": "Any", "rules": rules}),
+                         ('{from:("a") to:("b")}', []))
+        for extra in ({"field": "Subject", "predicate": "does not contain", "value": "x"},
+                      {"field": "Received Date/Time", "predicate": "greater than", "value": "2", "unit": "months"}):
+            self.assertEqual(remote_rules.build_gmail_query({"match_policy": "Any", "rules": rules + [extra]}),
+                             (None, None))
+
+class TestStartup(unittest.TestCase):
+    GUI_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    HEAVY_MODULES = ["googleapiclient", "google_auth_oauthlib", "google.auth.transport.requests", "httplib2", "requests", "mysql"]
+
+    def run_python(self, *args):
+        return subprocess.run([sys.executable, *args], cwd=self.GUI_DIR, capture_output=True, text=True, timeout=60)
+
+    def test_gui_import_skips_heavy_libraries(self):
+        for entry in ["gui_components", "main"]:
+            result = self.run_python("-c", f"import sys, {entry}; print(' '.join(sys.modules))")
+            self.assertEqual(result.returncode, 0, result.stderr)
+            loaded = result.stdout.split()
+            self.assertEqual([name for name in self.HEAVY_MODULES if name in loaded], [], entry)
+
+    # Wall-clock timing depends on the machine, so it's a benchmark you ask for: RUN_BENCHMARKS=1.
+    @unittest.skipUnless(os.environ.get("RUN_BENCHMARKS"), "set RUN_BENCHMARKS=1 to run timing benchmarks")
+    def test_gui_import_time_budget(self):
+        # -X importtime prints "import time: self | cumulative | module" (microseconds) to stderr.
+        result = self.run_python("-X", "importtime", "-c", "import gui_components")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        cumulative = [int(line.split("|")[1]) for line in result.stderr.splitlines()
+                      if line.rstrip().endswith("| gui_components")]
+        self.assertEqual(len(cumulative), 1)
+        self.assertLess(cumulative[0], 300000)  # About 90ms measured; the heavy libraries alone add 300ms+
+
 # ----------------------- Integration Tests -----------------------
 class TestIntegration(unittest.TestCase):
+    def setUp(self):
+        # Keep the incremental-run state out of the working directory.
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        patcher = patch.multiple(config, RULES_STATE_FILE=os.path.join(tmp_dir.name, "rules_state.json"),
+                                 MESSAGE_CACHE_FILE=os.path.join(tmp_dir.name, "messages.bin"),
+                                 RULE_STATS_FILE=os.path.join(tmp_dir.name, "rule_stats.json"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(message_cache.close_cache)
+
     @patch('gmail_api.authenticate_gmail')
-    @patch('gmail_api.list_emails')
+    @patch('gmail_api.iter_email_pages')
     @patch('gmail_api.get_email')
-    @patch('mysql_db.insert_email_mysql')
+    @patch('storage.upsert_emails')
     def test_fetch_and_store_emails_integration(self, mock_insert_email, mock_get_email, mock_list_emails, mock_authenticate):
         # Setup mocks to fake Gmail API responses.
         fake_service = MagicMock()
         mock_authenticate.return_value = fake_service
         
-        # Simulate list_emails returning one fake message.
+        # Simulate iter_email_pages returning one page with one fake message.
         fake_message = {"id": "12345"}
-        mock_list_emails.return_value = [fake_message]
+        mock_list_emails.return_value = [[fake_message]]
         
         # Simulate get_email returning fake email details.
         fake_email_data = {
@@ -108,7 +1166,7 @@ class TestIntegration(unittest.TestCase):
         mock_get_email.return_value = fake_email_data
         
         # Simulate a successful insert into the database.
-        mock_insert_email.return_value = "Stored email 12345"
+        mock_insert_email.return_value = "Stored 1 emails."
         
         # Call the function to fetch and store emails.
         from rules_engine import fetch_and_store_emails
@@ -116,8 +1174,8 @@ class TestIntegration(unittest.TestCase):
         self.assertIn("Stored email 12345", result)
     
     @patch('rules_engine.authenticate_gmail')
-    @patch('rules_engine.fetch_emails_mysql')
-    @patch('rules_engine.process_actions')
+    @patch('storage.stream_emails')
+    @patch('rules_engine.apply_actions')
     def test_process_email_rules_integration(self, mock_process_actions, mock_fetch_emails, mock_authenticate):
         # Setup mocks to fake the rules processing flow.
         fake_service = MagicMock()